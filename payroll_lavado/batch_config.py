@@ -0,0 +1,106 @@
+import datetime
+import hashlib
+import json
+
+
+class FrozenRecord(dict):
+    # a read-only record of the batch configuration with the attribute access of frappe._dict
+    def __getattr__(self, key):
+        return self.get(key)
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError("the batch configuration snapshot is read-only")
+
+    __setattr__ = __setitem__ = __delitem__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.items())))
+
+    def __reduce__(self):
+        return FrozenRecord, (dict(self),)
+
+
+def freeze_value(value):
+    if isinstance(value, dict):
+        return FrozenRecord({key: freeze_value(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_value(item) for item in value)
+    return value
+
+
+def get_serializable_value(value):
+    if isinstance(value, datetime.timedelta):
+        total_seconds = int(value.total_seconds())
+        return f"{total_seconds // 3600:02d}:{total_seconds % 3600 // 60:02d}:{total_seconds % 60:02d}"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+class BatchConfigSnapshot:
+    # the batch relevant configuration captured when the batch is created and stored with it as canonical json,
+    # the batch workers and the resumes compute against it instead of querying the live configuration.
+    # config_hash identifies the content, version the layout of the snapshot
+    version: int = 1
+
+    def __init__(self, penalty_policy_groups: list, penalty_policies: list, shift_types: list,
+                 payroll_activity_type: str, standard_working_hours: float, version: int = None):
+        if version is not None and version != self.version:
+            raise ValueError(f"unsupported batch configuration snapshot version {version}, "
+                             f"expected {self.version}")
+        config = {"version": self.version,
+                  "penalty_policy_groups": penalty_policy_groups,
+                  "penalty_policies": penalty_policies,
+                  "shift_types": shift_types,
+                  "payroll_activity_type": payroll_activity_type,
+                  "standard_working_hours": standard_working_hours}
+        object.__setattr__(self, "config_json", json.dumps(config, sort_keys=True, separators=(",", ":"),
+                                                           default=get_serializable_value))
+        object.__setattr__(self, "config", freeze_value(json.loads(self.config_json)))
+        object.__setattr__(self, "config_hash", hashlib.sha256(self.config_json.encode()).hexdigest())
+
+    def __setattr__(self, key, value):
+        raise TypeError("the batch configuration snapshot is read-only")
+
+    def __hash__(self):
+        return hash(self.config_hash)
+
+    def __eq__(self, other):
+        return isinstance(other, BatchConfigSnapshot) and self.config_hash == other.config_hash
+
+    def __reduce__(self):
+        return BatchConfigSnapshot.from_json, (self.config_json,)
+
+    @staticmethod
+    def from_json(config_json: str):
+        config = json.loads(config_json)
+        return BatchConfigSnapshot(penalty_policy_groups=config["penalty_policy_groups"],
+                                   penalty_policies=config["penalty_policies"],
+                                   shift_types=config["shift_types"],
+                                   payroll_activity_type=config["payroll_activity_type"],
+                                   standard_working_hours=config["standard_working_hours"],
+                                   version=config.get("version"))
+
+    def to_json(self) -> str:
+        return self.config_json
+
+    @property
+    def penalty_policy_groups(self) -> tuple:
+        return self.config["penalty_policy_groups"]
+
+    @property
+    def penalty_policies(self) -> tuple:
+        return self.config["penalty_policies"]
+
+    @property
+    def shift_types(self) -> tuple:
+        return self.config["shift_types"]
+
+    @property
+    def payroll_activity_type(self) -> str:
+        return self.config["payroll_activity_type"]
+
+    @property
+    def standard_working_hours(self) -> float:
+        return self.config["standard_working_hours"]
@@ -0,0 +1,237 @@
+import bisect
+import datetime
+
+
+class EmployeeChangelogIndex:
+    # per employee, the changelog records sorted by change_date with a parallel list of dates for bisect;
+    # the applied record on a date is the latest one with change_date <= that date
+    def __init__(self, changelog_records: list):
+        self.employees_change_dates = {}
+        self.employees_changelog_records = {}
+        for record in sorted(changelog_records, key=lambda changelog: changelog['change_date']):
+            self.employees_change_dates.setdefault(record['employee'], []).append(record['change_date'])
+            self.employees_changelog_records.setdefault(record['employee'], []).append(record)
+
+    def get_employee_changelog_record(self, employee_id: str, attendance_date):
+        change_dates = self.employees_change_dates.get(employee_id)
+        if not change_dates:
+            return None
+        record_index = bisect.bisect_right(change_dates, attendance_date) - 1
+        if record_index < 0:
+            return None
+        return self.employees_changelog_records[employee_id][record_index]
+
+
+class PenaltyPolicyIndex:
+    # compiled once per batch from the ordered policies list (group, subgroup, tolerance_duration desc,
+    # occurrence_number desc) so the per-attendance lookups don't scan and lower() the whole policies list
+    tolerance_subgroups: tuple = ("attendance check-in", "attendance check-out")
+
+    def __init__(self, penalty_policies: list, penalty_policy_groups: list):
+        self.groups = {}
+        self.policies = {}
+        self.designations_policies = {}
+        self.designations_named_policies = {}
+        self.designations_subgroups_groups = {}
+        self.designations_ladders = {}
+
+        for group in penalty_policy_groups:
+            self.groups.setdefault(group['name'].lower(), group)
+
+        for policy in penalty_policies:
+            self.policies.setdefault(policy['policy_name'].lower(), policy)
+            for designation in policy['designations']:
+                designation_key = designation['designation_name'].lower()
+                designation_policies = self.designations_policies.setdefault(designation_key, [])
+                if designation_policies and designation_policies[-1] is policy:
+                    continue
+                designation_policies.append(policy)
+
+        for designation_key, designation_policies in self.designations_policies.items():
+            named_policies = {}
+            subgroups_groups = {}
+            ladders_policies = {}
+            for policy in designation_policies:
+                named_policies.setdefault(policy['policy_name'].lower(), policy)
+                subgroup_key = policy['policy_subgroup'].lower()
+                if subgroup_key not in subgroups_groups:
+                    group = self.groups.get(policy['penalty_group'].lower())
+                    if group:
+                        subgroups_groups[subgroup_key] = group
+                ladders_policies.setdefault((policy['penalty_group'].lower(), subgroup_key), []).append(policy)
+            self.designations_named_policies[designation_key] = named_policies
+            self.designations_subgroups_groups[designation_key] = subgroups_groups
+            self.designations_ladders[designation_key] = {
+                ladder_key: PenaltyPolicyLadder(ladder_policies)
+                for ladder_key, ladder_policies in ladders_policies.items()}
+
+    def get_group(self, group_name: str):
+        return self.groups.get(group_name.lower())
+
+    def get_policy(self, policy_name: str):
+        return self.policies.get(policy_name.lower())
+
+    def get_designation_policies(self, designation: str) -> list:
+        return self.designations_policies.get(designation.lower(), [])
+
+    def get_designation_policy(self, designation: str, policy_name: str):
+        return self.designations_named_policies.get(designation.lower(), {}).get(policy_name.lower())
+
+    def get_designation_subgroup_group(self, designation: str, subgroup_name: str):
+        return self.designations_subgroups_groups.get(designation.lower(), {}).get(subgroup_name.lower())
+
+    def find_policy(self, designation: str, group_name: str, subgroup_name: str, occurrence_number: int,
+                    gap_duration_in_minutes):
+        ladder = self.designations_ladders.get(designation.lower(), {}).get((group_name.lower(),
+                                                                             subgroup_name.lower()))
+        if not ladder:
+            return None
+        if subgroup_name.lower() not in self.tolerance_subgroups:
+            gap_duration_in_minutes = None
+        return ladder.find_policy(occurrence_number=occurrence_number,
+                                  gap_duration_in_minutes=gap_duration_in_minutes)
+
+
+class PenaltyPolicyLadder:
+    # the policies of one (group, subgroup) split into tolerance tiers (tolerance desc), every tier keeps its
+    # policies by occurrence desc; the first policy in that order which matches is the applied one
+    def __init__(self, policies: list):
+        ordered_policies = sorted(policies, key=lambda policy: (-(policy['tolerance_duration'] or 0),
+                                                                -(policy['occurrence_number'] or 0)))
+        self.negative_tolerances = []
+        self.tiers = []
+        for policy in ordered_policies:
+            negative_tolerance = -(policy['tolerance_duration'] or 0)
+            if not self.negative_tolerances or self.negative_tolerances[-1] != negative_tolerance:
+                self.negative_tolerances.append(negative_tolerance)
+                self.tiers.append(([], []))
+            negative_occurrences, tier_policies = self.tiers[-1]
+            negative_occurrences.append(-(policy['occurrence_number'] or 0))
+            tier_policies.append(policy)
+
+    def find_policy(self, occurrence_number: int, gap_duration_in_minutes=None):
+        first_tier_index = 0
+        if gap_duration_in_minutes is not None:
+            first_tier_index = bisect.bisect_left(self.negative_tolerances, -gap_duration_in_minutes)
+        for negative_occurrences, tier_policies in self.tiers[first_tier_index:]:
+            policy_index = bisect.bisect_left(negative_occurrences, -occurrence_number)
+            if policy_index < len(tier_policies):
+                return tier_policies[policy_index]
+        return None
+
+
+class PenaltyOccurrenceWindow:
+    # sorted penalty dates per (employee, penalty group, policy subgroup), the occurrence number of a penalty is
+    # the count of the penalties inside its group's reset duration window
+    def __init__(self, penalty_records: list = None):
+        self.penalty_dates = {}
+        for penalty_record in sorted(penalty_records or [], key=lambda record: record['penalty_date']):
+            self.penalty_dates.setdefault(self.get_key(employee=penalty_record['employee'],
+                                                       policy_group=penalty_record['penalty_group'],
+                                                       policy_subgroup=penalty_record['policy_subgroup']),
+                                          []).append(penalty_record['penalty_date'])
+
+    @staticmethod
+    def get_key(employee: str, policy_group: str, policy_subgroup: str) -> tuple:
+        return employee.lower(), policy_group.lower(), (policy_subgroup or "").lower()
+
+    def add_penalty(self, employee: str, policy_group: str, policy_subgroup: str, penalty_date):
+        bisect.insort(self.penalty_dates.setdefault(self.get_key(employee=employee, policy_group=policy_group,
+                                                                 policy_subgroup=policy_subgroup), []),
+                      penalty_date)
+
+    def get_employee_penalties(self, employee: str) -> dict:
+        # a copy of the employee's penalty dates, restored when the employee's changes are rolled back
+        employee_key = employee.lower()
+        return {key: list(penalty_dates) for key, penalty_dates in self.penalty_dates.items()
+                if key[0] == employee_key}
+
+    def restore_employee_penalties(self, employee: str, employee_penalties: dict):
+        employee_key = employee.lower()
+        self.penalty_dates = {key: penalty_dates for key, penalty_dates in self.penalty_dates.items()
+                              if key[0] != employee_key}
+        self.penalty_dates.update(employee_penalties)
+
+    def count_penalties(self, employee: str, policy_group: str, policy_subgroup: str, from_date, to_date) -> int:
+        penalty_dates = self.penalty_dates.get(self.get_key(employee=employee, policy_group=policy_group,
+                                                            policy_subgroup=policy_subgroup))
+        if not penalty_dates:
+            return 0
+        return bisect.bisect_right(penalty_dates, to_date) - bisect.bisect_left(penalty_dates, from_date)
+
+
+class PenaltyRecordIndex:
+    # the penalty records of an employees chunk within the batch dates: the records per (employee, date), the
+    # (employee, date, policy) keys of the automatic records and the records linked to an Additional Salary.
+    # The records added by an employee rolled back to its savepoint stay here, that employee is not processed
+    # again in the same run
+    def __init__(self, penalty_records: list):
+        self.dates_penalty_records = {}
+        self.automatic_penalty_keys = set()
+        self.linked_penalty_records = set()
+        for penalty_record in penalty_records:
+            self.dates_penalty_records.setdefault((penalty_record['employee'].lower(),
+                                                   penalty_record['penalty_date']), []).append(penalty_record)
+            if penalty_record['action_type'] == "Automatic":
+                self.add_automatic_penalty(employee=penalty_record['employee'],
+                                           penalty_date=penalty_record['penalty_date'],
+                                           penalty_policy=penalty_record['penalty_policy'])
+            if penalty_record['linked_additional_salary']:
+                self.linked_penalty_records.add(penalty_record['name'])
+
+    def get_date_penalty_records(self, employee: str, penalty_date) -> list:
+        return self.dates_penalty_records.get((employee.lower(), penalty_date), [])
+
+    def has_automatic_penalty(self, employee: str, penalty_date, penalty_policy: str) -> bool:
+        return (employee.lower(), penalty_date, penalty_policy.lower()) in self.automatic_penalty_keys
+
+    def add_automatic_penalty(self, employee: str, penalty_date, penalty_policy: str):
+        self.automatic_penalty_keys.add((employee.lower(), penalty_date, penalty_policy.lower()))
+
+    def is_linked_to_additional_salary(self, penalty_record_name: str) -> bool:
+        return penalty_record_name in self.linked_penalty_records
+
+    def add_additional_salary_link(self, penalty_record_name: str):
+        self.linked_penalty_records.add(penalty_record_name)
+
+
+class AffectedAttendanceDates:
+    # the per employee date ranges an incremental batch reprocesses: a change on a date reaches the following
+    # downstream_days too, the occurrence numbers of the penalties inside the reset duration window may shift
+    def __init__(self, downstream_days: int = 0, employees_dates_ranges: dict = None):
+        self.downstream_days = datetime.timedelta(days=downstream_days)
+        self.employees_dates_ranges = {}
+        for employee, dates_ranges in (employees_dates_ranges or {}).items():
+            for from_date, to_date in dates_ranges:
+                self.add_dates_range(employee=employee, from_date=from_date, to_date=to_date)
+
+    def add_date(self, employee: str, changed_date):
+        self.add_dates_range(employee=employee, from_date=changed_date, to_date=changed_date + self.downstream_days)
+
+    def add_dates_range(self, employee: str, from_date, to_date):
+        # keeps the ranges sorted and merged
+        dates_ranges = self.employees_dates_ranges.setdefault(employee, [])
+        range_index = bisect.bisect_left(dates_ranges, (from_date, to_date))
+        if range_index > 0 and dates_ranges[range_index - 1][1] >= from_date:
+            range_index -= 1
+            from_date = dates_ranges[range_index][0]
+            to_date = max(to_date, dates_ranges[range_index][1])
+            del dates_ranges[range_index]
+        while range_index < len(dates_ranges) and dates_ranges[range_index][0] <= to_date:
+            to_date = max(to_date, dates_ranges[range_index][1])
+            del dates_ranges[range_index]
+        dates_ranges.insert(range_index, (from_date, to_date))
+
+    def get_employees(self) -> list:
+        return sorted(self.employees_dates_ranges)
+
+    def get_employees_dates_ranges(self, employee_ids: list) -> dict:
+        return {employee: self.employees_dates_ranges[employee] for employee in employee_ids
+                if employee in self.employees_dates_ranges}
+
+    def is_affected(self, employee: str, attendance_date) -> bool:
+        dates_ranges = self.employees_dates_ranges.get(employee)
+        if not dates_ranges:
+            return False
+        range_index = bisect.bisect_right(dates_ranges, (attendance_date, datetime.date.max)) - 1
+        return range_index >= 0 and dates_ranges[range_index][1] >= attendance_date
@@ -0,0 +1,186 @@
+import contextlib
+import heapq
+import math
+import time
+
+write_statements: tuple = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class DurationHistogram:
+    # durations counted in log-scale buckets 10% wide, the histograms of the batch jobs merge by adding the
+    # bucket counts and the percentiles are accurate to a bucket width
+    bucket_growth: float = 1.1
+    min_seconds: float = 0.0001
+
+    def __init__(self, buckets: dict = None, max_seconds: float = 0):
+        self.buckets = {int(bucket): count for bucket, count in (buckets or {}).items()}
+        self.max_seconds = max_seconds
+
+    def get_bucket(self, seconds: float) -> int:
+        if seconds <= self.min_seconds:
+            return 0
+        return math.ceil(math.log(seconds / self.min_seconds, self.bucket_growth))
+
+    def add(self, seconds: float):
+        bucket = self.get_bucket(seconds)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+    def get_count(self) -> int:
+        return sum(self.buckets.values())
+
+    def get_percentile(self, percentile: float) -> float:
+        # the upper bound of the bucket holding the percentile, never above the max
+        count = self.get_count()
+        if not count:
+            return 0
+        rank = math.ceil(count * percentile / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.min_seconds * self.bucket_growth ** bucket, self.max_seconds)
+        return self.max_seconds
+
+    def to_dict(self) -> dict:
+        return {"buckets": {str(bucket): count for bucket, count in self.buckets.items()},
+                "max_seconds": self.max_seconds}
+
+
+class BatchMetrics:
+    # the wall time, database queries and written rows of every batch phase. The spans nest, a phase is
+    # charged its own time only (a penalty evaluation span excludes the additional salaries created inside it)
+    # and every query goes to the innermost running span. The phase times of every processed employee are
+    # kept as histograms with the slowest employees, so the metrics of the batch jobs merge into one summary
+    slowest_employees_number: int = 10
+
+    def __init__(self):
+        self.phases = {}
+        self.employees_histograms = {}
+        self.slowest_employees = []
+        self.spans_stack = []
+        self.employee_id = None
+        self.employee_phases_seconds = {}
+        self.employee_start_time = None
+
+    def get_phase(self, phase: str) -> dict:
+        return self.phases.setdefault(phase, {"seconds": 0, "queries": 0, "rows_written": 0, "calls": 0})
+
+    @contextlib.contextmanager
+    def span(self, phase: str):
+        # [phase, start time, nested spans seconds]
+        span = [phase, time.perf_counter(), 0]
+        self.spans_stack.append(span)
+        try:
+            yield
+        finally:
+            self.spans_stack.pop()
+            elapsed_seconds = time.perf_counter() - span[1]
+            own_seconds = elapsed_seconds - span[2]
+            phase_metrics = self.get_phase(phase)
+            phase_metrics["seconds"] += own_seconds
+            phase_metrics["calls"] += 1
+            if self.spans_stack:
+                self.spans_stack[-1][2] += elapsed_seconds
+            if self.employee_id:
+                self.employee_phases_seconds[phase] = self.employee_phases_seconds.get(phase, 0) + own_seconds
+
+    def start_employee(self, employee_id: str):
+        self.employee_id = employee_id
+        self.employee_phases_seconds = {}
+        self.employee_start_time = time.perf_counter()
+
+    def end_employee(self):
+        employee_seconds = time.perf_counter() - self.employee_start_time
+        for phase, seconds in self.employee_phases_seconds.items():
+            self.employees_histograms.setdefault(phase, DurationHistogram()).add(seconds)
+        self.employees_histograms.setdefault("employee", DurationHistogram()).add(employee_seconds)
+        self.add_slowest_employee(employee_id=self.employee_id, seconds=employee_seconds)
+        self.employee_id = None
+
+    def add_slowest_employee(self, employee_id: str, seconds: float):
+        if len(self.slowest_employees) < self.slowest_employees_number:
+            heapq.heappush(self.slowest_employees, (seconds, employee_id))
+        elif seconds > self.slowest_employees[0][0]:
+            heapq.heapreplace(self.slowest_employees, (seconds, employee_id))
+
+    def add_query(self, query: str, rows_written: int):
+        phase_metrics = self.get_phase(self.spans_stack[-1][0] if self.spans_stack else "other")
+        phase_metrics["queries"] += 1
+        if query.lstrip()[:7].upper().startswith(write_statements):
+            phase_metrics["rows_written"] += max(rows_written or 0, 0)
+
+    @contextlib.contextmanager
+    def count_queries(self, db):
+        # wraps db.sql for the running job, the written rows are read from the cursor of a write statement
+        sql = db.sql
+
+        def count_sql(query, *args, **kwargs):
+            try:
+                return sql(query, *args, **kwargs)
+            finally:
+                cursor = getattr(db, "_cursor", None)
+                self.add_query(query=str(query), rows_written=getattr(cursor, "rowcount", 0))
+
+        db.sql = count_sql
+        try:
+            yield self
+        finally:
+            db.sql = sql
+
+    def merge(self, other):
+        for phase, other_phase_metrics in other.phases.items():
+            phase_metrics = self.get_phase(phase)
+            for key, value in other_phase_metrics.items():
+                phase_metrics[key] += value
+        for phase, histogram in other.employees_histograms.items():
+            self.employees_histograms.setdefault(phase, DurationHistogram()).merge(histogram)
+        for seconds, employee_id in other.slowest_employees:
+            self.add_slowest_employee(employee_id=employee_id, seconds=seconds)
+
+    def is_empty(self) -> bool:
+        return not self.phases and not self.employees_histograms
+
+    def to_dict(self) -> dict:
+        return {"phases": self.phases,
+                "employees_histograms": {phase: histogram.to_dict()
+                                         for phase, histogram in self.employees_histograms.items()},
+                "slowest_employees": [[employee_id, seconds]
+                                      for seconds, employee_id in sorted(self.slowest_employees, reverse=True)]}
+
+    @staticmethod
+    def from_dict(metrics_dict: dict):
+        batch_metrics = BatchMetrics()
+        for phase, phase_metrics in (metrics_dict.get("phases") or {}).items():
+            batch_metrics.get_phase(phase).update(phase_metrics)
+        for phase, histogram in (metrics_dict.get("employees_histograms") or {}).items():
+            batch_metrics.employees_histograms[phase] = DurationHistogram(buckets=histogram["buckets"],
+                                                                          max_seconds=histogram["max_seconds"])
+        for employee_id, seconds in metrics_dict.get("slowest_employees") or []:
+            batch_metrics.add_slowest_employee(employee_id=employee_id, seconds=seconds)
+        return batch_metrics
+
+    def get_summary(self) -> dict:
+        # the phases by their time, slowest first, with the per employee p50/p95/max of the employee phases
+        phases = []
+        for phase, phase_metrics in sorted(self.phases.items(), key=lambda item: -item[1]["seconds"]):
+            phase_summary = dict(phase_metrics, phase=phase, seconds=round(phase_metrics["seconds"], 3))
+            histogram = self.employees_histograms.get(phase)
+            if histogram:
+                phase_summary.update({"employee_p50": round(histogram.get_percentile(50), 3),
+                                      "employee_p95": round(histogram.get_percentile(95), 3),
+                                      "employee_max": round(histogram.max_seconds, 3)})
+            phases.append(phase_summary)
+        employee_histogram = self.employees_histograms.get("employee") or DurationHistogram()
+        return {"phases": phases,
+                "employees": employee_histogram.get_count(),
+                "employee_p50": round(employee_histogram.get_percentile(50), 3),
+                "employee_p95": round(employee_histogram.get_percentile(95), 3),
+                "employee_max": round(employee_histogram.max_seconds, 3),
+                "slowest_employees": [[employee_id, round(seconds, 3)]
+                                      for seconds, employee_id in sorted(self.slowest_employees, reverse=True)]}
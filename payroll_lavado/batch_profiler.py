@@ -0,0 +1,124 @@
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+profile_modes: tuple = ("Sampling", "Deterministic")
+
+
+def get_frame_name(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class StackSampler:
+    # samples the stack of the profiled thread every interval seconds from a daemon thread, the stacks are
+    # counted in the collapsed format of the flame graph tools: "root;caller;callee count"
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples_number = 0
+        self.active = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lavado-stack-sampler", daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            if self.active:
+                self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        frame_names = []
+        while frame is not None:
+            frame_names.append(get_frame_name(frame))
+            frame = frame.f_back
+        if frame_names:
+            self.stacks[";".join(reversed(frame_names))] += 1
+            self.samples_number += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.active = False
+        self.stop_event.set()
+        self.thread.join()
+
+    def get_collapsed_stacks(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def get_leaf_counts(self) -> collections.Counter:
+        leaf_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        return leaf_counts
+
+
+class BatchProfiler:
+    # profiles the calling thread while resumed: the stack sampler always runs for the collapsed stacks summary,
+    # the deterministic mode also records every call with cProfile. Pausing between the profiled sections
+    # (like a sample of employees) keeps the rest of the batch out of the profile
+    summary_rows_number: int = 30
+
+    def __init__(self, mode: str = "Sampling", interval: float = 0.005):
+        if mode not in profile_modes:
+            raise ValueError(f"unknown profile mode '{mode}', expected one of {profile_modes}")
+        self.mode = mode
+        self.stack_sampler = StackSampler(thread_id=threading.get_ident(), interval=interval)
+        self.call_profiler = cProfile.Profile() if mode == "Deterministic" else None
+        self.profiled_seconds = 0
+        self.resume_time = None
+
+    def start(self):
+        self.stack_sampler.start()
+        self.resume()
+
+    def resume(self):
+        self.resume_time = time.perf_counter()
+        self.stack_sampler.active = True
+        if self.call_profiler:
+            self.call_profiler.enable()
+
+    def pause(self):
+        if self.resume_time is None:
+            return
+        if self.call_profiler:
+            self.call_profiler.disable()
+        self.stack_sampler.active = False
+        self.profiled_seconds += time.perf_counter() - self.resume_time
+        self.resume_time = None
+
+    def stop(self):
+        self.pause()
+        self.stack_sampler.stop()
+
+    def get_profile_file(self) -> tuple:
+        # (file extension, content): the cProfile stats readable by pstats/snakeviz, or the collapsed stacks
+        if self.call_profiler:
+            self.call_profiler.create_stats()
+            return "prof", marshal.dumps(self.call_profiler.stats)
+        return "collapsed.txt", self.stack_sampler.get_collapsed_stacks().encode()
+
+    def get_summary(self) -> str:
+        samples_number = self.stack_sampler.samples_number or 1
+        lines = [f"profile mode: {self.mode}, profiled seconds: {round(self.profiled_seconds, 3)}, "
+                 f"samples: {self.stack_sampler.samples_number} every {self.stack_sampler.interval}s", "",
+                 "top functions by own samples:"]
+        for frame_name, count in self.stack_sampler.get_leaf_counts().most_common(self.summary_rows_number):
+            lines.append(f"{count * 100 / samples_number:6.2f}% {count:8d} {frame_name}")
+        lines += ["", "top collapsed stacks:"]
+        for stack, count in self.stack_sampler.stacks.most_common(self.summary_rows_number):
+            lines.append(f"{stack} {count}")
+        if self.call_profiler:
+            stats_stream = io.StringIO()
+            self.call_profiler.create_stats()
+            pstats.Stats(self.call_profiler, stream=stats_stream).sort_stats("cumulative").print_stats(
+                self.summary_rows_number)
+            lines += ["", "top functions by cumulative time:", stats_stream.getvalue()]
+        return "\n".join(lines)
@@ -0,0 +1,80 @@
+import collections
+import time
+
+import frappe
+
+batch_progress_event: str = "lavado_batch_progress"
+
+
+class BatchProgress:
+    # the processed employees and attendance rows of a running batch counted in the cache by all of its jobs,
+    # so following a batch never queries the batch objects. Every job adds its counts to the cache and
+    # publishes the batch totals at most once per publish interval; the rates and the ETA come from the
+    # totals read by the job over the last rate window
+    cache_key_prefix: str = "lavado_batch_progress"
+    cache_expiry_seconds: int = 24 * 60 * 60
+    counters: tuple = ("total", "done", "failed", "rows")
+
+    def __init__(self, batch_id: str, publish_interval_seconds: float = 2, rate_window_seconds: float = 60):
+        self.batch_id = batch_id
+        self.publish_interval_seconds = publish_interval_seconds
+        self.rate_window_seconds = rate_window_seconds
+        self.pending_counts = {"done": 0, "failed": 0, "rows": 0}
+        # (monotonic time, done + failed employees, rows) of the published totals
+        self.readings = collections.deque()
+        self.last_publish_time = 0
+
+    def get_cache_key(self, counter: str) -> str:
+        return frappe.cache().make_key(f"{self.cache_key_prefix}|{self.batch_id}|{counter}")
+
+    def start(self, employees_number: int):
+        # called once per batch run, before its jobs process any employee
+        for counter in self.counters:
+            frappe.cache().set(self.get_cache_key(counter), employees_number if counter == "total" else 0,
+                               ex=self.cache_expiry_seconds)
+        self.publish(force=True)
+
+    def add_employee(self, failed: bool = False, attendance_rows: int = 0):
+        self.pending_counts["failed" if failed else "done"] += 1
+        self.pending_counts["rows"] += attendance_rows
+        self.publish()
+
+    def flush(self):
+        for counter, count in self.pending_counts.items():
+            if count:
+                frappe.cache().incrby(self.get_cache_key(counter), count)
+                self.pending_counts[counter] = 0
+
+    def get_totals(self) -> dict:
+        values = frappe.cache().mget([self.get_cache_key(counter) for counter in self.counters])
+        return {counter: int(value or 0) for counter, value in zip(self.counters, values)}
+
+    def get_rates(self, now: float, processed: int, rows: int) -> tuple:
+        # (employees per second, rows per second) since the oldest reading of the rate window
+        self.readings.append((now, processed, rows))
+        while len(self.readings) > 2 and now - self.readings[1][0] >= self.rate_window_seconds:
+            self.readings.popleft()
+        first_time, first_processed, first_rows = self.readings[0]
+        if now - first_time <= 0:
+            return 0, 0
+        return (processed - first_processed) / (now - first_time), (rows - first_rows) / (now - first_time)
+
+    def publish(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_publish_time < self.publish_interval_seconds:
+            return
+        self.last_publish_time = now
+        self.flush()
+        totals = self.get_totals()
+        processed = totals["done"] + totals["failed"]
+        remaining = max(totals["total"] - processed, 0)
+        employees_per_second, rows_per_second = self.get_rates(now=now, processed=processed, rows=totals["rows"])
+        frappe.publish_realtime(batch_progress_event, {
+            "batch_id": self.batch_id,
+            "total": totals["total"],
+            "done": totals["done"],
+            "failed": totals["failed"],
+            "remaining": remaining,
+            "employees_per_second": round(employees_per_second, 2),
+            "rows_per_second": round(rows_per_second, 1),
+            "eta_seconds": round(remaining / employees_per_second) if employees_per_second > 0 else None})
@@ -0,0 +1,108 @@
+import frappe
+
+batch_rollback_title: str = "LavaDo Payroll Batch Rollback"
+
+
+class BatchRollback:
+    # removes what a batch created for its failed and interrupted employees before the batch is resumed: the
+    # object ids are collected with one query per object type, deleted in chunks with one commit per chunk and
+    # looked up again afterwards to verify nothing was left behind. Submitted documents are never deleted
+    object_types: tuple = ("Additional Salary", "Lava Penalty Record", "Timesheet")
+    child_tables: dict = {"Timesheet": ("Timesheet Detail",)}
+
+    def __init__(self, batch_id: str, chunk_size: int = 500):
+        self.batch_id = batch_id
+        self.chunk_size = chunk_size
+        self.failed_employee_ids = []
+        self.objects_ids = {}
+
+    def collect(self):
+        self.failed_employee_ids = frappe.db.sql_list("""
+                                        SELECT DISTINCT object_id FROM `tabLava Batch Object`
+                                        WHERE batch_id = %(batch_id)s AND object_type = 'Employee'
+                                            AND status IN ('Failed', 'In progress')
+                                        """, {'batch_id': self.batch_id})
+        for object_type in self.object_types:
+            self.objects_ids[object_type] = frappe.db.sql_list("""
+                                        SELECT DISTINCT o.object_id FROM `tabLava Batch Object` o
+                                        WHERE o.batch_id = %(batch_id)s AND o.object_type = %(object_type)s
+                                            AND o.parenttype = 'Employee'
+                                            AND o.parent IN (
+                                                SELECT e.object_id FROM `tabLava Batch Object` e
+                                                WHERE e.batch_id = %(batch_id)s AND e.object_type = 'Employee'
+                                                    AND e.status IN ('Failed', 'In progress'))
+                                        """, {'batch_id': self.batch_id, 'object_type': object_type})
+
+    def get_chunks(self, ids: list):
+        for chunk_start in range(0, len(ids), self.chunk_size):
+            yield tuple(ids[chunk_start:chunk_start + self.chunk_size])
+
+    def delete_objects(self, object_type: str, object_ids: tuple):
+        names = frappe.db.sql_list(f"""
+                            SELECT name FROM `tab{object_type}` WHERE name IN %(names)s AND docstatus != 1
+                            """, {'names': object_ids})
+        if not names:
+            return
+        names = tuple(names)
+        if object_type == "Additional Salary":
+            frappe.db.sql("""
+                        UPDATE `tabLava Penalty Record` SET additional_salary = NULL
+                        WHERE additional_salary IN %(names)s
+                        """, {'names': names})
+        for child_table in self.child_tables.get(object_type, ()):
+            frappe.db.sql(f"""
+                        DELETE FROM `tab{child_table}` WHERE parenttype = %(parenttype)s AND parent IN %(names)s
+                        """, {'parenttype': object_type, 'names': names})
+        frappe.db.sql(f"DELETE FROM `tab{object_type}` WHERE name IN %(names)s", {'names': names})
+        frappe.db.sql("""
+                    DELETE FROM `tabVersion` WHERE ref_doctype = %(object_type)s AND docname IN %(names)s
+                    """, {'object_type': object_type, 'names': names})
+
+    def delete_batch_objects(self, employee_ids: tuple):
+        frappe.db.sql("""
+                    DELETE FROM `tabLava Batch Object`
+                    WHERE batch_id = %(batch_id)s AND parenttype = 'Employee' AND parent IN %(employee_ids)s
+                    """, {'batch_id': self.batch_id, 'employee_ids': employee_ids})
+        frappe.db.sql("""
+                    DELETE FROM `tabLava Batch Object`
+                    WHERE batch_id = %(batch_id)s AND object_type = 'Employee' AND object_id IN %(employee_ids)s
+                    """, {'batch_id': self.batch_id, 'employee_ids': employee_ids})
+
+    def get_left_behind(self) -> dict:
+        left_behind = {}
+        for object_type, object_ids in self.objects_ids.items():
+            left_names = []
+            for object_ids_chunk in self.get_chunks(object_ids):
+                left_names.extend(frappe.db.sql_list(f"SELECT name FROM `tab{object_type}` WHERE name IN %(names)s",
+                                                     {'names': object_ids_chunk}))
+            if left_names:
+                left_behind[object_type] = left_names
+        left_batch_objects = 0
+        for employee_ids_chunk in self.get_chunks(self.failed_employee_ids):
+            left_batch_objects += frappe.db.sql("""
+                                    SELECT COUNT(*) FROM `tabLava Batch Object`
+                                    WHERE batch_id = %(batch_id)s
+                                        AND ((parenttype = 'Employee' AND parent IN %(employee_ids)s)
+                                            OR (object_type = 'Employee' AND object_id IN %(employee_ids)s))
+                                    """, {'batch_id': self.batch_id, 'employee_ids': employee_ids_chunk})[0][0]
+        if left_batch_objects:
+            left_behind["Lava Batch Object"] = left_batch_objects
+        return left_behind
+
+    def run(self) -> dict:
+        self.collect()
+        for object_type, object_ids in self.objects_ids.items():
+            for object_ids_chunk in self.get_chunks(object_ids):
+                self.delete_objects(object_type=object_type, object_ids=object_ids_chunk)
+                frappe.db.commit()
+        for employee_ids_chunk in self.get_chunks(self.failed_employee_ids):
+            self.delete_batch_objects(employee_ids=employee_ids_chunk)
+            frappe.db.commit()
+
+        left_behind = self.get_left_behind()
+        if left_behind:
+            frappe.log_error(message=f"batch {self.batch_id} rollback left behind: {left_behind}",
+                             title=batch_rollback_title)
+        return {"employees": len(self.failed_employee_ids),
+                "objects": {object_type: len(object_ids) for object_type, object_ids in self.objects_ids.items()},
+                "left_behind": left_behind}
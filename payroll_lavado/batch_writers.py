@@ -0,0 +1,178 @@
+import frappe
+from frappe.utils import now_datetime
+
+
+def make_series_names(series_prefix: str, names_number: int, digits: int = 5) -> list:
+    # reserve a block of the naming series at once instead of a series update per inserted record
+    current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", (series_prefix,))
+    if current and current[0][0] is not None:
+        first_number = current[0][0] + 1
+        frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s",
+                      (names_number, series_prefix))
+    else:
+        first_number = 1
+        frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (series_prefix, names_number))
+    return [f"{series_prefix}{str(number).zfill(digits)}"
+            for number in range(first_number, first_number + names_number)]
+
+
+def bulk_insert_records(doctype: str, fields: list, records: list, names: list):
+    if not records:
+        return
+    timestamp = now_datetime()
+    user = frappe.session.user
+    frappe.db.bulk_insert(doctype,
+                          fields=["name", "creation", "modified", "owner", "modified_by"] + fields,
+                          values=[[name, timestamp, timestamp, user, user] + [record.get(field) for field in fields]
+                                  for name, record in zip(names, records)])
+
+
+class BatchObjectWriter:
+    # buffers the "Lava Batch Object" rows of a batch and writes them with multi-row inserts, the status
+    # transitions of already written rows are applied with one UPDATE per status and object type.
+    # The rows are only written by an explicit flush, at the batch commit points
+    series_prefix: str = "BATCH-OBJ-"
+    fields: list = ["batch_id", "object_type", "object_id", "status", "notes", "parent", "parenttype", "parentfield"]
+
+    def __init__(self, batch_id: str):
+        self.batch_id = batch_id
+        self.pending_records = []
+        self.pending_records_keys = {}
+        self.pending_statuses = {}
+
+    def add(self, object_type: str, object_id: str, status: str, notes: str = "", parent_id: str = None):
+        record = {"batch_id": self.batch_id, "object_type": object_type, "object_id": object_id,
+                  "status": status, "notes": notes}
+        if parent_id:
+            record.update({"parenttype": "Employee", "parentfield": "name", "parent": parent_id})
+        self.pending_records.append(record)
+        self.pending_records_keys[(object_type, object_id)] = record
+
+    def discard_parent_records(self, parent_id: str):
+        # the pending rows of an employee whose changes are rolled back
+        self.pending_records = [record for record in self.pending_records if record.get("parent") != parent_id]
+        self.pending_records_keys = {(record["object_type"], record["object_id"]): record
+                                     for record in self.pending_records}
+
+    def set_status(self, object_type: str, object_id: str, status: str):
+        pending_record = self.pending_records_keys.get((object_type, object_id))
+        if pending_record:
+            pending_record["status"] = status
+            return
+        for statuses_objects in self.pending_statuses.values():
+            statuses_objects.get(object_type, set()).discard(object_id)
+        self.pending_statuses.setdefault(status, {}).setdefault(object_type, set()).add(object_id)
+
+    def flush(self):
+        if self.pending_records:
+            names = make_series_names(series_prefix=self.series_prefix, names_number=len(self.pending_records))
+            bulk_insert_records(doctype="Lava Batch Object", fields=self.fields, records=self.pending_records,
+                                names=names)
+            self.pending_records = []
+            self.pending_records_keys = {}
+
+        for status, statuses_objects in self.pending_statuses.items():
+            for object_type, object_ids in statuses_objects.items():
+                if not object_ids:
+                    continue
+                frappe.db.sql("""
+                            UPDATE `tabLava Batch Object` SET status = %(status)s, modified = %(modified)s
+                            WHERE batch_id = %(batch_id)s AND object_type = %(object_type)s
+                                AND object_id IN %(object_ids)s
+                            """, {'status': status, 'modified': now_datetime(), 'batch_id': self.batch_id,
+                                  'object_type': object_type, 'object_ids': tuple(object_ids)})
+        self.pending_statuses = {}
+
+
+class AttendanceFieldsWriter:
+    # collects the computed "lava_*" attendance fields that differ from the stored values and writes them with
+    # chunked UPDATE ... CASE statements at the batch commit points, the unchanged attendance rows are skipped
+    fields: list = ["lava_entry_duration_difference", "lava_exit_duration_difference", "lava_planned_working_hours"]
+    tolerance: float = 0.000001
+
+    def __init__(self, chunk_size: int = 500):
+        self.chunk_size = chunk_size
+        self.pending_records = {}
+        self.updated_records_number = 0
+        self.unchanged_records_number = 0
+
+    def is_changed(self, stored_value, value) -> bool:
+        if stored_value is None or value is None:
+            return stored_value is not value
+        return abs(stored_value - value) > self.tolerance
+
+    def add(self, attendance, values: dict, parent_id: str) -> bool:
+        # attendance still holds the stored values
+        if not any(self.is_changed(attendance.get(field), values.get(field)) for field in self.fields):
+            self.unchanged_records_number += 1
+            return False
+        self.pending_records[attendance['name']] = (parent_id, values)
+        return True
+
+    def discard_parent_records(self, parent_id: str):
+        self.pending_records = {name: (record_parent_id, values)
+                                for name, (record_parent_id, values) in self.pending_records.items()
+                                if record_parent_id != parent_id}
+
+    def flush(self):
+        names = list(self.pending_records)
+        for chunk_start in range(0, len(names), self.chunk_size):
+            chunk_names = names[chunk_start:chunk_start + self.chunk_size]
+            set_clauses = []
+            values = []
+            for field in self.fields:
+                set_clauses.append(f"`{field}` = CASE `name` {' '.join(['WHEN %s THEN %s'] * len(chunk_names))} "
+                                   f"ELSE `{field}` END")
+                for name in chunk_names:
+                    values.extend([name, self.pending_records[name][1].get(field)])
+            frappe.db.sql(f"UPDATE `tabAttendance` SET {', '.join(set_clauses)} WHERE `name` IN %s",
+                          values + [tuple(chunk_names)])
+        self.updated_records_number += len(names)
+        self.pending_records = {}
+
+
+action_log_levels: dict = {"Debug": 10, "Info": 20, "Warning": 30, "Error": 40}
+
+
+class ActionLogWriter:
+    # keeps the "Lava Action Log" lines of the running job in memory and writes them with multi-row inserts,
+    # every max_buffer_size lines or flush_interval seconds, and when the job ends or fails
+    fields: list = ["action", "action_type", "notes"]
+
+    def __init__(self, level: str = "Info", max_buffer_size: int = 200, flush_interval: int = 30):
+        self.level = level
+        self.max_buffer_size = max_buffer_size
+        self.flush_interval = flush_interval
+        self.pending_records = []
+        self.last_flush_time = now_datetime()
+        # disabled while an employee is processed inside a savepoint, so a rollback doesn't drop flushed lines
+        self.auto_flush = True
+
+    def is_enabled_for(self, level: str) -> bool:
+        return action_log_levels.get(level, 0) >= action_log_levels.get(self.level, 0)
+
+    def add(self, action: str, action_type: str, notes: str = None, level: str = "Info"):
+        if not self.is_enabled_for(level):
+            return
+        self.pending_records.append({"action": action, "action_type": action_type, "notes": notes})
+        if self.auto_flush:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if len(self.pending_records) >= self.max_buffer_size or \
+                (now_datetime() - self.last_flush_time).total_seconds() >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = now_datetime()
+        if not self.pending_records:
+            return
+        bulk_insert_records(doctype="Lava Action Log", fields=self.fields, records=self.pending_records,
+                            names=[frappe.generate_hash(length=10).upper() for _ in self.pending_records])
+        self.pending_records = []
+
+
+def get_action_log_writer() -> ActionLogWriter:
+    if not getattr(frappe.local, "lavado_action_log_writer", None):
+        frappe.local.lavado_action_log_writer = ActionLogWriter()
+    return frappe.local.lavado_action_log_writer
@@ -0,0 +1,302 @@
+"""
+Runs the payroll batch over a synthetic dataset and stores the results as json for run to run comparisons:
+
+    python -m payroll_lavado.benchmarks.batch_benchmark --employees 1000 --mode memory
+    python -m payroll_lavado.benchmarks.batch_benchmark --size large --mode site --site bench.localhost \\
+        --sites-path ~/frappe-bench/sites --compare benchmark-results/previous.json
+
+Both modes run PayrollLavaDoManager.create_resume_batch_process synchronously with the queries and commits counted.
+The memory mode runs it against MemoryDataAccess, the data access answered from the generated records (it needs
+frappe importable, not a site). The site mode loads the records into a local MariaDB site and removes them
+afterwards unless --keep-data is given.
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from payroll_lavado.benchmarks.synthetic_data import SyntheticPayrollDataset, dataset_sizes
+
+employees_chunk_size: int = 100
+compared_metrics: tuple = ("employees_per_second", "queries_per_employee", "commits_per_employee", "peak_rss_mb")
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_benchmark_batch_options() -> dict:
+    from payroll_lavado.payroll_batch import PayrollLavaDoManager
+
+    return PayrollLavaDoManager.parse_batch_options(json.dumps({
+        "chk-clear-error-log-records": 0, "chk-clear-action-log-records": 0, "chk-batch-objects": 0,
+        "chk-biometric-process": 0, "chk-batch-debug-mode": 1, "chk-auto-attendance": 0, "batch_id": "",
+        "action_type": "New Batch", "branches": "", "shifts": "", "employees": ""}))
+
+
+def run_memory_benchmark(dataset: SyntheticPayrollDataset) -> dict:
+    from payroll_lavado.benchmarks.memory_data_access import MemoryDataAccess
+    from payroll_lavado.payroll_batch import PayrollLavaDoManager, flush_action_logs
+
+    data_access = MemoryDataAccess(dataset)
+    batch_options = get_benchmark_batch_options()
+    with data_access.patch_frappe():
+        start_time = time.perf_counter()
+        failed_employees_number = 0
+        for company in dataset.companies:
+            manager = PayrollLavaDoManager()
+            manager.create_resume_batch_process(company=company["name"], start_date=dataset.start_date,
+                                                end_date=dataset.end_date, batch_options=batch_options)
+            failed_employees_number += int(data_access.cache.get(
+                manager.batch_progress.get_cache_key("failed")) or 0)
+        flush_action_logs()
+        seconds = time.perf_counter() - start_time
+    return {"seconds": seconds, "attendance_rows": dataset.employees_number * dataset.days_number,
+            "failed_employees": failed_employees_number,
+            "penalties": data_access.saved_documents.get("Lava Penalty Record", 0),
+            "queries": data_access.queries_number, "commits": data_access.commits_number}
+
+
+class QueryCounter:
+    # counts the frappe.db.sql and frappe.db.commit calls of the running batch, a commit runs its own query
+    def __init__(self, db):
+        self.db = db
+        self.queries_number = 0
+        self.commits_number = 0
+
+    def __enter__(self):
+        self.sql = self.db.sql
+        self.commit = self.db.commit
+
+        def count_sql(*args, **kwargs):
+            self.queries_number += 1
+            return self.sql(*args, **kwargs)
+
+        def count_commit(*args, **kwargs):
+            self.commits_number += 1
+            return self.commit(*args, **kwargs)
+
+        self.db.sql = count_sql
+        self.db.commit = count_commit
+        return self
+
+    def __exit__(self, *exc_info):
+        self.db.sql = self.sql
+        self.db.commit = self.commit
+
+
+def load_dataset_into_site(dataset: SyntheticPayrollDataset):
+    import frappe
+
+    for company in dataset.companies:
+        if not frappe.db.exists("Company", company["name"]):
+            frappe.get_doc({"doctype": "Company", "company_name": company["name"], "abbr": company["abbr"],
+                            "default_currency": "USD", "country": "United States"}).insert(ignore_permissions=True)
+    for designation in dataset.designations:
+        if not frappe.db.exists("Designation", designation):
+            frappe.get_doc({"doctype": "Designation", "designation_name": designation}).insert(
+                ignore_permissions=True)
+    if not frappe.db.exists("Salary Component", dataset.salary_component):
+        frappe.get_doc({"doctype": "Salary Component", "salary_component": dataset.salary_component,
+                        "salary_component_abbr": dataset.prefix, "type": "Deduction"}).insert(ignore_permissions=True)
+    for shift_type in dataset.shift_types:
+        if not frappe.db.exists("Shift Type", shift_type["name"]):
+            frappe.get_doc(dict(shift_type, doctype="Shift Type")).insert(ignore_permissions=True)
+
+    timestamp = frappe.utils.now_datetime()
+    user = frappe.session.user
+    base_fields = ["name", "creation", "modified", "owner", "modified_by"]
+
+    def bulk_insert(doctype: str, fields: list, records: list):
+        frappe.db.bulk_insert(doctype, fields=base_fields + fields,
+                              values=[[record["name"], timestamp, timestamp, user, user]
+                                      + [record.get(field) for field in fields] for record in records])
+
+    bulk_insert("Lava Penalty Group", ["title", "reset_duration", "deduction_rule", "docstatus"],
+                [dict(group, docstatus=1) for group in dataset.penalty_groups])
+    bulk_insert("Lava Penalty Policy", ["title", "penalty_group", "penalty_subgroup", "occurrence_number",
+                                        "tolerance_duration", "deduction_amount", "deduction_factor",
+                                        "salary_component", "company", "enabled", "docstatus"],
+                [dict(policy, title=policy["name"], enabled=1, docstatus=1) for policy in dataset.penalty_policies])
+    bulk_insert("Policy Designations", ["designation", "parent", "parenttype", "parentfield", "idx"],
+                [{"name": f"{policy['name']}-{designation_index}", "designation": designation,
+                  "parent": policy["name"], "parenttype": "Lava Penalty Policy", "parentfield": "designations",
+                  "idx": designation_index}
+                 for policy in dataset.penalty_policies
+                 for designation_index, designation in enumerate(policy["designations"], start=1)])
+
+    for chunk_start in range(0, len(dataset.employees), employees_chunk_size):
+        employees_chunk = dataset.employees[chunk_start:chunk_start + employees_chunk_size]
+        bulk_insert("Employee", ["employee_name", "first_name", "company", "designation", "default_shift",
+                                 "status", "gender", "date_of_birth", "date_of_joining"],
+                    [dict(employee, first_name=employee["employee_name"], default_shift=employee["shift_type"],
+                          status="Active", gender="Male", date_of_birth=datetime.date(1990, 1, 1),
+                          date_of_joining=dataset.start_date - datetime.timedelta(days=365))
+                     for employee in employees_chunk])
+        bulk_insert("Lava Employee Payroll Changelog", ["employee", "company", "branch", "shift_type",
+                                                        "change_date", "designation", "hourly_rate"],
+                    [changelog for employee in employees_chunk for changelog in dataset.get_changelogs(employee)])
+        bulk_insert("Attendance", ["employee", "employee_name", "company", "attendance_date", "status",
+                                   "docstatus", "shift", "in_time", "out_time", "late_entry", "early_exit",
+                                   "working_hours"],
+                    [dict(attendance, employee_name=employee["employee_name"]) for employee in employees_chunk
+                     for attendance in dataset.get_attendance_list(employee)])
+        frappe.db.commit()
+
+
+def remove_dataset_from_site(dataset: SyntheticPayrollDataset):
+    import frappe
+
+    companies = tuple(company["name"] for company in dataset.companies)
+    employee_ids = frappe.db.sql_list("SELECT name FROM `tabEmployee` WHERE company IN %(companies)s",
+                                      {"companies": companies})
+    for chunk_start in range(0, len(employee_ids), 1000):
+        employees_chunk = tuple(employee_ids[chunk_start:chunk_start + 1000])
+        frappe.db.sql("""
+                    DELETE FROM `tabTimesheet Detail` WHERE parent IN (
+                        SELECT name FROM `tabTimesheet` WHERE employee IN %(employees)s)
+                    """, {"employees": employees_chunk})
+        for doctype in ("Timesheet", "Additional Salary", "Lava Penalty Record", "Attendance",
+                        "Lava Employee Payroll Changelog"):
+            frappe.db.sql(f"DELETE FROM `tab{doctype}` WHERE employee IN %(employees)s",
+                          {"employees": employees_chunk})
+        frappe.db.sql("DELETE FROM `tabEmployee` WHERE name IN %(employees)s", {"employees": employees_chunk})
+        frappe.db.commit()
+    batch_ids = frappe.db.sql_list("SELECT name FROM `tabLava Payroll LavaDo Batch` WHERE company IN %(companies)s",
+                                   {"companies": companies})
+    if batch_ids:
+        frappe.db.sql("DELETE FROM `tabLava Batch Object` WHERE batch_id IN %(batch_ids)s",
+                      {"batch_ids": tuple(batch_ids)})
+        frappe.db.sql("DELETE FROM `tabLava Payroll LavaDo Batch` WHERE name IN %(batch_ids)s",
+                      {"batch_ids": tuple(batch_ids)})
+    policy_names = tuple(policy["name"] for policy in dataset.penalty_policies)
+    frappe.db.sql("""
+                DELETE FROM `tabPolicy Designations` WHERE parenttype = 'Lava Penalty Policy' AND parent IN %(names)s
+                """, {"names": policy_names})
+    frappe.db.sql("DELETE FROM `tabLava Penalty Policy` WHERE name IN %(names)s", {"names": policy_names})
+    frappe.db.sql("DELETE FROM `tabLava Penalty Group` WHERE name IN %(names)s",
+                  {"names": tuple(group["name"] for group in dataset.penalty_groups)})
+    frappe.db.commit()
+
+
+def run_site_benchmark(dataset: SyntheticPayrollDataset, site: str, sites_path: str, keep_data: bool) -> dict:
+    import frappe
+    from payroll_lavado.payroll_batch import PayrollLavaDoManager, flush_action_logs
+
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    try:
+        load_dataset_into_site(dataset)
+        batch_options = get_benchmark_batch_options()
+        with QueryCounter(frappe.db) as query_counter:
+            start_time = time.perf_counter()
+            for company in dataset.companies:
+                PayrollLavaDoManager().create_resume_batch_process(company=company["name"],
+                                                                   start_date=dataset.start_date,
+                                                                   end_date=dataset.end_date,
+                                                                   batch_options=batch_options)
+            flush_action_logs()
+            seconds = time.perf_counter() - start_time
+        failed_employees_number = frappe.db.sql("""
+                                    SELECT COUNT(*) FROM `tabLava Batch Object` o
+                                    INNER JOIN `tabLava Payroll LavaDo Batch` b ON b.name = o.batch_id
+                                    WHERE b.company IN %(companies)s AND o.object_type = 'Employee'
+                                        AND o.status = 'Failed'
+                                    """, {"companies": tuple(company["name"] for company in dataset.companies)})[0][0]
+        penalties_number = frappe.db.sql("""
+                                    SELECT COUNT(*) FROM `tabLava Penalty Record` pr
+                                    INNER JOIN `tabEmployee` e ON e.name = pr.employee
+                                    WHERE e.company IN %(companies)s
+                                    """, {"companies": tuple(company["name"] for company in dataset.companies)})[0][0]
+        return {"seconds": seconds, "attendance_rows": dataset.employees_number * dataset.days_number,
+                "failed_employees": failed_employees_number, "penalties": penalties_number,
+                "queries": query_counter.queries_number, "commits": query_counter.commits_number}
+    finally:
+        if not keep_data:
+            remove_dataset_from_site(dataset)
+        frappe.destroy()
+
+
+def make_report(mode: str, dataset: SyntheticPayrollDataset, result: dict) -> dict:
+    employees_number = dataset.employees_number
+    return {
+        "mode": mode,
+        "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_revision": get_git_revision(),
+        "employees": employees_number,
+        "companies": dataset.companies_number,
+        "days": dataset.days_number,
+        "seed": dataset.seed,
+        "attendance_rows": result["attendance_rows"],
+        "failed_employees": result["failed_employees"],
+        "penalties": result["penalties"],
+        "seconds": round(result["seconds"], 3),
+        "employees_per_second": round(employees_number / result["seconds"], 2) if result["seconds"] else None,
+        "queries_per_employee": round(result["queries"] / employees_number, 2),
+        "commits_per_employee": round(result["commits"] / employees_number, 3),
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def compare_reports(report: dict, previous_report: dict) -> dict:
+    # the change ratio of every metric against the previous run, > 1 means the metric grew
+    return {metric: round(report[metric] / previous_report[metric], 3)
+            for metric in compared_metrics if report.get(metric) and previous_report.get(metric)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="payroll batch benchmark over synthetic data")
+    parser.add_argument("--employees", type=int, help="number of employees, overrides --size")
+    parser.add_argument("--size", choices=list(dataset_sizes), default="small")
+    parser.add_argument("--companies", type=int, default=1)
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mode", choices=["memory", "site"], default="memory")
+    parser.add_argument("--site", help="the site of the site mode")
+    parser.add_argument("--sites-path", default=".")
+    parser.add_argument("--keep-data", action="store_true", help="keep the loaded records on the site")
+    parser.add_argument("--output", help="the report json file, by default under benchmark-results/")
+    parser.add_argument("--compare", help="a previous report json file to compare with")
+    args = parser.parse_args()
+    if args.mode == "site" and not args.site:
+        parser.error("--site is required by the site mode")
+
+    dataset = SyntheticPayrollDataset(employees_number=args.employees or dataset_sizes[args.size],
+                                      companies_number=args.companies, days_number=args.days, seed=args.seed)
+    if args.mode == "site":
+        result = run_site_benchmark(dataset=dataset, site=args.site, sites_path=args.sites_path,
+                                    keep_data=args.keep_data)
+    else:
+        result = run_memory_benchmark(dataset)
+    report = make_report(mode=args.mode, dataset=dataset, result=result)
+    if args.compare:
+        with open(args.compare) as previous_report_file:
+            report["compared_with"] = {"file": args.compare,
+                                       "ratios": compare_reports(report, json.load(previous_report_file))}
+
+    output = args.output or os.path.join("benchmark-results", f"{datetime.datetime.now():%Y%m%d-%H%M%S}-"
+                                                              f"{args.mode}-{dataset.employees_number}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    print(json.dumps(report, indent=1))
+    print(f"report stored in {output}")
+
+
+if __name__ == "__main__":
+    main()
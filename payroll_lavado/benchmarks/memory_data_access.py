@@ -0,0 +1,269 @@
+"""
+An in-memory stand-in for the data access of PayrollLavaDoManager, used by the memory mode of the batch benchmark:
+frappe.db, frappe.get_all, the documents, the cache and the error log are replaced while the real batch runs, the
+reads are answered from a SyntheticPayrollDataset and every call is counted. A query is one data access call (an
+sql statement, a get_all, a document save or a savepoint), a document insert counts as one query where the site
+runs several statements. The replaced names are restored when the context exits, it needs frappe importable but
+no site.
+"""
+import contextlib
+import datetime
+import itertools
+from unittest import mock
+
+import frappe
+from frappe import _dict as fdict
+
+from payroll_lavado import batch_writers, payroll_batch
+from payroll_lavado.batch_metrics import write_statements
+from payroll_lavado.benchmarks.synthetic_data import SyntheticPayrollDataset
+
+
+def get_day_seconds(time_value: datetime.datetime) -> int:
+    if time_value is None:
+        return -1
+    return time_value.hour * 3600 + time_value.minute * 60 + time_value.second
+
+
+class MemoryDocument:
+    # a saved document only gets its name, the documents are not kept
+    def __init__(self, data_access, doctype: str, values: dict = None):
+        self.data_access = data_access
+        self.doctype = doctype
+        self.name = None
+        for field, value in (values or {}).items():
+            setattr(self, field, value)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field, default)
+
+    def append(self, field: str, value: dict):
+        rows = getattr(self, field, None)
+        if rows is None:
+            rows = []
+            setattr(self, field, rows)
+        rows.append(fdict(value))
+
+    def save(self, **kwargs):
+        self.data_access.save_document(self)
+        return self
+
+    def insert(self, **kwargs):
+        return self.save()
+
+    def db_set(self, field: str, value, **kwargs):
+        setattr(self, field, value)
+        self.data_access.count_query()
+
+
+class MemoryCache:
+    # the redis calls of the batch progress counters
+    def __init__(self):
+        self.values = {}
+
+    def make_key(self, key: str) -> str:
+        return key
+
+    def set(self, key: str, value, ex: int = None, nx: bool = False):
+        if nx and key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def get(self, key: str):
+        return self.values.get(key)
+
+    def mget(self, keys: list) -> list:
+        return [self.values.get(key) for key in keys]
+
+    def incrby(self, key: str, amount: int) -> int:
+        self.values[key] = int(self.values.get(key) or 0) + amount
+        return self.values[key]
+
+    def expire(self, key: str, seconds: int):
+        pass
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class MemoryDatabase:
+    # frappe.db of the running batch: the reads are answered by the data access, the writes are only counted
+    def __init__(self, data_access):
+        self.data_access = data_access
+
+    def sql(self, query: str, values=None, as_dict: bool = False, **kwargs):
+        self.data_access.count_query()
+        return self.data_access.get_query_result(query=query, values=values or {}, as_dict=as_dict)
+
+    def sql_list(self, query: str, values=None, **kwargs) -> list:
+        return [row[0] for row in self.sql(query, values)]
+
+    def bulk_insert(self, doctype: str, fields: list, values: list, **kwargs):
+        self.data_access.count_query()
+        self.data_access.rows_written += len(values)
+
+    def commit(self):
+        # like the site, where a commit runs its own statement
+        self.data_access.count_query()
+        self.data_access.commits_number += 1
+
+    def rollback(self, save_point: str = None):
+        self.data_access.count_query()
+
+    def savepoint(self, save_point: str):
+        self.data_access.count_query()
+
+    def truncate(self, doctype: str):
+        self.data_access.count_query()
+
+    def exists(self, doctype: str, filters=None, **kwargs):
+        self.data_access.count_query()
+        # the payroll activity type is created by the setup, the other checks find nothing
+        return doctype == "Activity Type"
+
+    def get_value(self, doctype: str, filters=None, fieldname="name", **kwargs):
+        self.data_access.count_query()
+        return None
+
+    def set_value(self, doctype: str, name: str, fieldname, value=None, **kwargs):
+        self.data_access.count_query()
+
+    def get_single_value(self, doctype: str, fieldname: str, **kwargs):
+        self.data_access.count_query()
+        return self.data_access.standard_working_hours if fieldname == "standard_working_hours" else None
+
+
+class MemoryDataAccess:
+    def __init__(self, dataset: SyntheticPayrollDataset, standard_working_hours: float = 8.0):
+        self.dataset = dataset
+        self.standard_working_hours = standard_working_hours
+        self.employees = {employee["name"]: employee for employee in dataset.employees}
+        self.database = MemoryDatabase(self)
+        self.cache = MemoryCache()
+        self.series = {}
+        self.document_numbers = itertools.count(1)
+        self.queries_number = 0
+        self.commits_number = 0
+        self.rows_written = 0
+        self.saved_documents = {}
+        self.error_logs = []
+
+    def count_query(self):
+        self.queries_number += 1
+
+    @contextlib.contextmanager
+    def patch_frappe(self):
+        with contextlib.ExitStack() as patches:
+            for target, attribute, replacement in (
+                    (frappe, "db", self.database),
+                    (frappe, "cache", lambda: self.cache),
+                    (frappe, "session", fdict(user="Administrator")),
+                    (frappe, "get_all", self.get_all),
+                    (frappe, "get_doc", self.get_doc),
+                    (frappe, "new_doc", self.new_doc),
+                    (frappe, "log_error", self.log_error),
+                    (frappe, "throw", self.throw),
+                    (frappe, "publish_realtime", lambda *args, **kwargs: None),
+                    # frappe.utils.now_datetime reads the system timezone from the site
+                    (payroll_batch, "now_datetime", datetime.datetime.now),
+                    (batch_writers, "now_datetime", datetime.datetime.now)):
+                patches.enter_context(mock.patch.object(target, attribute, replacement))
+            frappe.local.lavado_action_log_writer = None
+            try:
+                yield self
+            finally:
+                frappe.local.lavado_action_log_writer = None
+
+    def save_document(self, document: MemoryDocument):
+        self.count_query()
+        if not document.name:
+            document.name = f"MEMORY-{document.doctype.upper().replace(' ', '-')}-{next(self.document_numbers):07d}"
+            self.saved_documents[document.doctype] = self.saved_documents.get(document.doctype, 0) + 1
+
+    def new_doc(self, doctype: str) -> MemoryDocument:
+        return MemoryDocument(self, doctype)
+
+    def get_doc(self, doctype, name: str = None) -> MemoryDocument:
+        self.count_query()
+        if isinstance(doctype, dict):
+            return MemoryDocument(self, doctype["doctype"], doctype)
+        return MemoryDocument(self, doctype, {"name": name})
+
+    def log_error(self, message: str = None, title: str = None, **kwargs):
+        self.count_query()
+        self.error_logs.append((title, message))
+
+    @staticmethod
+    def throw(msg: str, exc=frappe.ValidationError, title: str = None, **kwargs):
+        raise exc(msg)
+
+    def get_all(self, doctype: str, filters: dict = None, fields: list = None, **kwargs) -> list:
+        self.count_query()
+        filters = filters or {}
+        if doctype == "Shift Type":
+            # the auto attendance settings are valid, it is not run by the benchmark
+            records = [dict(shift_type, enable_auto_attendance=1, process_attendance_after=self.dataset.start_date,
+                            last_sync_of_checkin=datetime.datetime.combine(self.dataset.end_date, datetime.time()))
+                       for shift_type in self.dataset.shift_types]
+        elif doctype == "Lava Penalty Group":
+            records = sorted(self.dataset.penalty_groups, key=lambda group: group["title"])
+        elif doctype == "Lava Employee Payroll Changelog":
+            employee_ids = filters["employee"][1]
+            max_date = filters["change_date"][1]
+            records = [changelog for employee_id in sorted(employee_ids)
+                       for changelog in self.dataset.get_changelogs(self.employees[employee_id])
+                       if changelog["change_date"] <= max_date]
+        elif doctype == "Lava Payroll LavaDo Batch":
+            records = []
+        else:
+            raise ValueError(f"the memory data access has no '{doctype}' records")
+        if fields and fields != ["*"]:
+            records = [{field: record.get(field) for field in fields} for record in records]
+        return [fdict(record) for record in records]
+
+    def get_query_result(self, query: str, values: dict, as_dict: bool):
+        statement = query.lstrip().split(None, 1)[0].upper()
+        if "`tabSeries`" in query:
+            return self.get_series_result(statement=statement, values=values)
+        if statement in write_statements:
+            return ()
+        if "`tabSalary Structure Assignment`" in query:
+            # the employees without changelog records, the dataset gives every employee its changelog
+            return []
+        if "AS employee_id" in query:
+            return [fdict(employee_id=employee["name"])
+                    for employee in self.dataset.get_company_employees(values["company"])]
+        if "`tabLava Penalty Policy` AS p" in query:
+            return [fdict(row) for row in self.dataset.get_penalty_policy_rows(values["company"])]
+        if "MAX(modified)" in query:
+            return [fdict(attendance=None, changelog=None, penalty_record=None)]
+        if "FROM `tabAttendance`" in query:
+            return self.get_attendance_rows(employee_ids=values["employee_ids"])
+        if "`tabLava Penalty Record` pr" in query:
+            # the dataset has no penalty records before the batch
+            return []
+        raise ValueError(f"the memory data access can't answer the query: {query.strip()[:200]}")
+
+    def get_series_result(self, statement: str, values):
+        series_prefix = values[0]
+        if statement == "SELECT":
+            return ((self.series[series_prefix],),) if series_prefix in self.series else ()
+        if statement == "UPDATE":
+            names_number, series_prefix = values
+            self.series[series_prefix] += names_number
+        else:
+            series_prefix, names_number = values
+            self.series[series_prefix] = names_number
+        return ()
+
+    def get_attendance_rows(self, employee_ids: tuple) -> tuple:
+        # the attendance query result tuples, with the in/out seconds and the checked flag computed by the database
+        rows = []
+        for employee_id in sorted(employee_ids):
+            for attendance in self.dataset.get_attendance_list(self.employees[employee_id]):
+                rows.append(tuple(attendance.get(field) for field in payroll_batch.attendance_fields) + (
+                    get_day_seconds(attendance["in_time"]), get_day_seconds(attendance["out_time"]),
+                    int(attendance["status"] not in ("Absent", "On Leave") and attendance["docstatus"] == 1)))
+        return tuple(rows)
@@ -0,0 +1,140 @@
+"""
+Deterministic synthetic payroll data for the batch benchmarks: companies, designations, shift types, penalty groups
+and policies, employees with their changelog records and a month of attendance. The same seed and sizes always
+give the same records, the attendance is generated per employee so large datasets are never held in memory.
+"""
+import datetime
+import random
+
+dataset_sizes: dict = {"small": 100, "medium": 1000, "large": 10000, "xlarge": 50000}
+
+benchmark_shift_times: list = [("Morning", 8, 16), ("Evening", 14, 22), ("Night", 22, 6)]
+benchmark_penalty_groups: list = [
+    # (subgroup, title, reset duration, deduction rule)
+    ("attendance check-in", "Late Entry", 30, "Biggest"),
+    ("attendance check-out", "Early Exit", 30, "Smallest"),
+    ("attendance absence", "Absence", 30, "Deduction in days"),
+]
+
+
+class SyntheticPayrollDataset:
+    def __init__(self, employees_number: int, companies_number: int = 1, start_date: datetime.date = None,
+                 days_number: int = 31, designations_number: int = 5, seed: int = 1, prefix: str = "BENCH"):
+        self.employees_number = employees_number
+        self.companies_number = max(1, companies_number)
+        self.start_date = start_date or datetime.date(2024, 1, 1)
+        self.days_number = days_number
+        self.end_date = self.start_date + datetime.timedelta(days=days_number - 1)
+        self.seed = seed
+        self.prefix = prefix
+        self.salary_component = f"{prefix} Penalty"
+        self.companies = [{"name": f"{prefix} Company {number}", "abbr": f"{prefix}{number}"}
+                          for number in range(1, self.companies_number + 1)]
+        self.designations = [f"{prefix} Designation {number}" for number in range(1, designations_number + 1)]
+        self.shift_types = [{"name": f"{prefix} {name}",
+                             "start_time": datetime.timedelta(hours=start_hour),
+                             "end_time": datetime.timedelta(hours=end_hour)}
+                            for name, start_hour, end_hour in benchmark_shift_times]
+        self.penalty_groups = [{"name": f"{prefix} {title}", "title": f"{prefix} {title}",
+                                "reset_duration": reset_duration, "deduction_rule": deduction_rule}
+                               for _, title, reset_duration, deduction_rule in benchmark_penalty_groups]
+        self.penalty_policies = self.make_penalty_policies()
+        self.employees = self.make_employees()
+
+    def make_penalty_policies(self) -> list:
+        # per company and group a ladder of three occurrences, the late/early groups with a 0 and a 30 minutes
+        # tolerance tier
+        penalty_policies = []
+        for company in self.companies:
+            for (subgroup, _, _, _), group in zip(benchmark_penalty_groups, self.penalty_groups):
+                tolerances = (0, 30) if subgroup != "attendance absence" else (0,)
+                for tolerance_duration in tolerances:
+                    for occurrence_number in (1, 2, 3):
+                        penalty_policies.append({
+                            "name": f"{group['title']} {company['abbr']} T{tolerance_duration} O{occurrence_number}",
+                            "penalty_group": group["name"],
+                            "penalty_subgroup": subgroup,
+                            "occurrence_number": occurrence_number,
+                            "tolerance_duration": tolerance_duration,
+                            "deduction_amount": 10 * occurrence_number,
+                            "deduction_factor": 0.25 * occurrence_number,
+                            "salary_component": self.salary_component,
+                            "company": company["name"],
+                            "designations": list(self.designations)})
+        return penalty_policies
+
+    def make_employees(self) -> list:
+        randomizer = random.Random(self.seed)
+        employees = []
+        for employee_number in range(self.employees_number):
+            employees.append({
+                "name": f"{self.prefix}-EMP-{employee_number + 1:06d}",
+                "employee_name": f"{self.prefix} Employee {employee_number + 1}",
+                "company": self.companies[employee_number % self.companies_number]["name"],
+                "designation": randomizer.choice(self.designations),
+                "shift_type": self.shift_types[employee_number % len(self.shift_types)]["name"],
+                "hourly_rate": round(randomizer.uniform(5, 40), 2)})
+        return employees
+
+    def get_company_employees(self, company: str) -> list:
+        return [employee for employee in self.employees if employee["company"] == company]
+
+    def get_changelogs(self, employee: dict) -> list:
+        # the employee's first changelog before the period, every tenth employee changes designation mid period
+        employee_number = int(employee["name"].rsplit("-", 1)[1])
+        changelogs = [{"name": f"{employee['name']}-CHANGELOG-0000001", "employee": employee["name"],
+                       "company": employee["company"], "branch": None, "shift_type": employee["shift_type"],
+                       "change_date": self.start_date - datetime.timedelta(days=30),
+                       "designation": employee["designation"], "salary_structure_assignment": None,
+                       "hourly_rate": employee["hourly_rate"]}]
+        if employee_number % 10 == 0:
+            changelogs.append(dict(changelogs[0], name=f"{employee['name']}-CHANGELOG-0000002",
+                                   change_date=self.start_date + datetime.timedelta(days=self.days_number // 2),
+                                   designation=self.designations[employee_number % len(self.designations)],
+                                   hourly_rate=round(employee["hourly_rate"] * 1.1, 2)))
+        return changelogs
+
+    def get_attendance_list(self, employee: dict) -> list:
+        employee_number = int(employee["name"].rsplit("-", 1)[1])
+        randomizer = random.Random(self.seed * 1000003 + employee_number)
+        shift_type = next(shift_type for shift_type in self.shift_types if shift_type["name"] == employee["shift_type"])
+        attendance_list = []
+        for day_number in range(self.days_number):
+            attendance_date = self.start_date + datetime.timedelta(days=day_number)
+            status = randomizer.choices(["Present", "Half Day", "Absent", "On Leave"], weights=[85, 5, 6, 4])[0]
+            attendance = {"name": f"{self.prefix}-ATT-{employee_number:06d}-{day_number + 1:02d}",
+                          "employee": employee["name"], "company": employee["company"],
+                          "attendance_date": attendance_date, "status": status, "docstatus": 1,
+                          "shift": shift_type["name"], "in_time": None, "out_time": None,
+                          "late_entry": 0, "early_exit": 0, "working_hours": 0,
+                          "lava_entry_duration_difference": 0, "lava_exit_duration_difference": 0,
+                          "lava_planned_working_hours": 0}
+            if status in ("Present", "Half Day"):
+                shift_start = datetime.datetime.combine(attendance_date, datetime.time()) + shift_type["start_time"]
+                shift_end = shift_start + datetime.timedelta(hours=8)
+                # at least a minute late or early, a zero minutes difference is rejected by the batch
+                late_seconds = randomizer.randint(60, 5400) if randomizer.random() < 0.15 else 0
+                early_seconds = randomizer.randint(60, 3600) if randomizer.random() < 0.1 else 0
+                in_time = shift_start + datetime.timedelta(seconds=late_seconds or -randomizer.randint(0, 600))
+                out_time = shift_end - datetime.timedelta(seconds=early_seconds or -randomizer.randint(0, 600))
+                attendance.update({"in_time": in_time, "out_time": out_time, "late_entry": int(late_seconds > 0),
+                                   "early_exit": int(early_seconds > 0),
+                                   "working_hours": round((out_time - in_time).total_seconds() / 3600, 2)})
+            attendance_list.append(attendance)
+        return attendance_list
+
+    def get_penalty_policy_rows(self, company: str) -> list:
+        # the rows of the policies query of PayrollLavaDoManager.get_penalty_policies, a row per policy designation
+        groups = {group["name"]: group for group in self.penalty_groups}
+        policies = sorted((policy for policy in self.penalty_policies if policy["company"] == company),
+                          key=lambda policy: (policy["penalty_group"], policy["penalty_subgroup"],
+                                              -policy["tolerance_duration"], -policy["occurrence_number"],
+                                              policy["name"]))
+        return [{"name": policy["name"], "policy_title": policy["name"], "penalty_group": policy["penalty_group"],
+                 "occurrence_number": policy["occurrence_number"], "deduction_factor": policy["deduction_factor"],
+                 "deduction_amount": policy["deduction_amount"], "penalty_subgroup": policy["penalty_subgroup"],
+                 "tolerance_duration": policy["tolerance_duration"], "salary_component": policy["salary_component"],
+                 "deduction_rule": groups[policy["penalty_group"]]["deduction_rule"],
+                 "reset_duration": groups[policy["penalty_group"]]["reset_duration"],
+                 "designation_name": designation}
+                for policy in policies for designation in sorted(policy["designations"])]
@@ -0,0 +1,129 @@
+"""
+Compares the scalar and the vectorized attendance working hours breakdowns on generated attendance rows shaped
+like the batch's attendance query result. The headline speedup times what the batch runs in each mode: the scalar
+path over the row dicts, and the vectorized one from the query result tuples (their columns taken, converted into
+arrays and computed in one pass). The vectorized pass alone is reported separately:
+
+    python -m payroll_lavado.benchmarks.working_hours_benchmark --rows 1000000
+"""
+import argparse
+import datetime
+import random
+import time
+
+import numpy
+
+from payroll_lavado.working_hours import ShiftTypeCache, AttendanceBreakdowns, calc_attendance_breakdown, \
+    calc_working_hours_breakdowns, get_int_column, get_query_columns
+
+# the columns of the batch's attendance query, the in/out seconds of the day are computed by the database
+attendance_query_fields: list = ["name", "employee", "attendance_date", "status", "docstatus", "shift",
+                                 "in_time", "out_time", "late_entry", "early_exit", "working_hours",
+                                 "lava_entry_duration_difference", "lava_exit_duration_difference",
+                                 "lava_planned_working_hours", "in_seconds", "out_seconds", "breakdown_checked"]
+
+benchmark_shift_types: list = [
+    {"name": "Morning", "start_time": datetime.timedelta(hours=8), "end_time": datetime.timedelta(hours=16)},
+    {"name": "Evening", "start_time": datetime.timedelta(hours=14), "end_time": datetime.timedelta(hours=22)},
+    {"name": "Night", "start_time": datetime.timedelta(hours=22), "end_time": datetime.timedelta(hours=6)},
+]
+
+
+def get_day_seconds(time_value: datetime.datetime) -> int:
+    return time_value.hour * 3600 + time_value.minute * 60 + time_value.second
+
+
+def generate_attendance_rows(rows_number: int, seed: int = 1) -> list:
+    # the attendance query result tuples, in the attendance_query_fields order
+    randomizer = random.Random(seed)
+    statuses = ["Present"] * 8 + ["Half Day", "Absent", "On Leave"]
+    first_date = datetime.datetime(2024, 1, 1)
+    rows = []
+    for row_number in range(rows_number):
+        shift_type = benchmark_shift_types[row_number % len(benchmark_shift_types)]
+        shift_start = first_date + shift_type["start_time"]
+        in_time = shift_start + datetime.timedelta(seconds=randomizer.randint(-600, 3600))
+        out_time = shift_start + datetime.timedelta(hours=8, seconds=randomizer.randint(-3600, 600))
+        status = randomizer.choice(statuses)
+        docstatus = 1 if randomizer.random() < 0.95 else 0
+        rows.append((f"HR-ATT-{row_number:07d}", "HR-EMP-00001", first_date.date(), status, docstatus,
+                     shift_type["name"], in_time, out_time, int(randomizer.random() < 0.3),
+                     int(randomizer.random() < 0.2), 0, 0, 0, 0, get_day_seconds(in_time), get_day_seconds(out_time),
+                     int(status not in ("Absent", "On Leave") and docstatus == 1)))
+    return rows
+
+
+def get_best_seconds(function, repeat: int) -> tuple:
+    # (the fastest of the repeated runs, the last result)
+    best_seconds = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start_time
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+    return best_seconds, result
+
+
+def run_benchmark(rows_number: int, chunk_rows: int = 3100, repeat: int = 3) -> dict:
+    # chunk_rows is the attendance of an employees chunk (100 employees by 31 days), like the batch both paths
+    # run chunk by chunk
+    shift_type_cache = ShiftTypeCache(benchmark_shift_types)
+    rows = generate_attendance_rows(rows_number)
+    chunks = [rows[chunk_start:chunk_start + chunk_rows] for chunk_start in range(0, rows_number, chunk_rows)]
+    # the batch builds the row dicts in both modes, they are not timed
+    chunks_attendance_lists = [[dict(zip(attendance_query_fields, row)) for row in chunk] for chunk in chunks]
+
+    scalar_seconds, chunks_scalar_breakdowns = get_best_seconds(lambda: [
+        [calc_attendance_breakdown(attendance, shift_type_cache.get_shift_type(attendance["shift"]))
+         for attendance in attendance_list] for attendance_list in chunks_attendance_lists], repeat=repeat)
+    vectorized_seconds, chunks_attendance_breakdowns = get_best_seconds(lambda: [
+        AttendanceBreakdowns(columns=get_query_columns(attendance_query_fields, chunk),
+                             shift_type_cache=shift_type_cache) for chunk in chunks], repeat=repeat)
+
+    # the vectorized pass alone, over all the rows already converted into arrays
+    columns = get_query_columns(attendance_query_fields, rows)
+    shift_types = [shift_type_cache.get_shift_type(shift_name) for shift_name in columns["shift"]]
+    arrays = {
+        "in_seconds": get_int_column(columns["in_seconds"], dtype=numpy.float64),
+        "out_seconds": get_int_column(columns["out_seconds"], dtype=numpy.float64),
+        "shift_start_seconds": numpy.array([shift_type.start_seconds for shift_type in shift_types],
+                                           dtype=numpy.float64),
+        "shift_end_seconds": numpy.array([shift_type.end_seconds for shift_type in shift_types], dtype=numpy.float64),
+        "entry_differences": numpy.zeros(rows_number),
+        "exit_differences": numpy.zeros(rows_number),
+        "late_entries": numpy.array(columns["late_entry"], dtype=bool),
+        "early_exits": numpy.array(columns["early_exit"], dtype=bool),
+        "checked": numpy.array(columns["breakdown_checked"], dtype=bool),
+    }
+    vectorized_pass_seconds, _ = get_best_seconds(lambda: calc_working_hours_breakdowns(**arrays), repeat=repeat)
+
+    mismatched_rows = [(chunk_index, row_index)
+                       for chunk_index, (scalar_breakdowns, attendance_breakdowns) in enumerate(
+                           zip(chunks_scalar_breakdowns, chunks_attendance_breakdowns))
+                       for row_index, breakdown in enumerate(scalar_breakdowns)
+                       if attendance_breakdowns.get_breakdown(row_index) != breakdown]
+    if mismatched_rows:
+        raise AssertionError(f"{len(mismatched_rows)} breakdowns differ from the scalar path, "
+                             f"first (chunk, row): {mismatched_rows[:5]}")
+    return {
+        "rows": rows_number,
+        "chunk_rows": chunk_rows,
+        "scalar_seconds": round(scalar_seconds, 3),
+        "vectorized_seconds": round(vectorized_seconds, 3),
+        "vectorized_pass_seconds": round(vectorized_pass_seconds, 3),
+        "speedup": round(scalar_seconds / vectorized_seconds, 2) if vectorized_seconds else None,
+        "pass_speedup": round(scalar_seconds / vectorized_pass_seconds, 2) if vectorized_pass_seconds else None,
+        "flagged_rows": sum(len(attendance_breakdowns.zero_entry_rows) + len(attendance_breakdowns.zero_exit_rows)
+                            + len(attendance_breakdowns.negative_rows)
+                            for attendance_breakdowns in chunks_attendance_breakdowns),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="attendance working hours breakdowns benchmark")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--chunk-rows", type=int, default=3100)
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args()
+    print(run_benchmark(rows_number=arguments.rows, chunk_rows=arguments.chunk_rows, repeat=arguments.repeat))
@@ -0,0 +1,236 @@
+import json
+import time
+from datetime import date
+
+import frappe
+from pymysql import ProgrammingError
+
+from payroll_lavado.batch_writers import get_action_log_writer
+
+batch_biometric_process_title: str = "run_biometric_attendance_records_process"
+biometric_record_doctype: str = "Lava Biometric Attendance Record"
+
+
+class BiometricRecordsProcess:
+    # processes the not processed biometric attendance records of a period. The records are split into ranges
+    # of consecutive names with a keyset cursor (name > the last read name), so marking records as Processed
+    # never shifts the next page. With more than one worker the ranges are queued in the cache and claimed with
+    # atomic moves into the claiming worker's processing list, by the enqueued range jobs and by the running
+    # job itself, which then waits for the ranges taken by the other jobs. A worker keeps a heartbeat while it
+    # processes, the ranges of a worker whose heartbeat expired (a crashed or killed job) are queued again and
+    # processed by the waiting job. Every range reports its progress in the action log and the records left
+    # not processed are counted at the end
+    cache_key_prefix: str = "lavado_biometric_process"
+    cache_expiry_seconds: int = 24 * 60 * 60
+    heartbeat_seconds: int = 5 * 60
+
+    def __init__(self, start_date: date, end_date: date, workers: int = 1, range_size: int = 500,
+                 page_size: int = 100, wait_timeout: int = 6 * 60 * 60, run_id: str = None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.workers = max(1, workers)
+        self.range_size = range_size
+        self.page_size = page_size
+        self.wait_timeout = wait_timeout
+        self.run_id = run_id or frappe.generate_hash(length=10)
+        self.worker_id = frappe.generate_hash(length=10)
+        self.claiming = False
+        self.processed_records_number = 0
+        self.failed_records_number = 0
+
+    def get_filters(self) -> dict:
+        return {'start_date': self.start_date.strftime('%Y-%m-%d'), 'end_date': self.end_date.strftime('%Y-%m-%d')}
+
+    def get_ranges(self) -> list:
+        # (first name, last name, records number) of every range_size not processed records
+        ranges = []
+        cursor = ""
+        while True:
+            names = frappe.db.sql_list(f"""
+                                SELECT name FROM `tab{biometric_record_doctype}`
+                                WHERE status != 'Processed' AND timestamp BETWEEN %(start_date)s AND %(end_date)s
+                                    AND name > %(cursor)s
+                                ORDER BY name LIMIT %(range_size)s
+                                """, dict(self.get_filters(), cursor=cursor, range_size=self.range_size))
+            if not names:
+                return ranges
+            ranges.append((names[0], names[-1], len(names)))
+            cursor = names[-1]
+
+    def process_range(self, range_index: int, ranges_number: int, first_name: str, last_name: str,
+                      records_number: int):
+        processed_records_number = 0
+        failed_records_number = 0
+        cursor = ""
+        while True:
+            checkin_records = frappe.db.sql(f"""
+                                SELECT name, employee_biometric_id FROM `tab{biometric_record_doctype}`
+                                WHERE status != 'Processed' AND timestamp BETWEEN %(start_date)s AND %(end_date)s
+                                    AND name >= %(first_name)s AND name <= %(last_name)s AND name > %(cursor)s
+                                ORDER BY name LIMIT %(page_size)s
+                                """, dict(self.get_filters(), first_name=first_name, last_name=last_name,
+                                          cursor=cursor, page_size=self.page_size), as_dict=1)
+            if not checkin_records:
+                break
+            cursor = checkin_records[-1].name
+            for checkin_record in checkin_records:
+                try:
+                    checkin_doc = frappe.get_doc(biometric_record_doctype, checkin_record.name)
+                    checkin_doc.process()
+                    processed_records_number += 1
+                except Exception:
+                    failed_records_number += 1
+                    frappe.log_error(message=f"record id: '{checkin_record.name}', "
+                                             f"employee_biometric_id: '{checkin_record.employee_biometric_id}'. "
+                                             f"Error: '{frappe.get_traceback()}'", title=batch_biometric_process_title)
+            frappe.db.commit()
+            self.heartbeat()
+
+        self.processed_records_number += processed_records_number
+        self.failed_records_number += failed_records_number
+        get_action_log_writer().add(
+            action=f"Biometric attendance range {range_index}/{ranges_number} ('{first_name}' to '{last_name}'): "
+                   f"{processed_records_number} processed, {failed_records_number} failed "
+                   f"of {records_number} records", action_type="LOG",
+            level="Warning" if failed_records_number else "Info")
+        return processed_records_number, failed_records_number
+
+    def get_cache_key(self, key_name: str) -> str:
+        return f"{self.cache_key_prefix}|{self.run_id}|{key_name}"
+
+    def make_cache_key(self, key_name: str) -> str:
+        return frappe.cache().make_key(self.get_cache_key(key_name))
+
+    def queue_ranges(self, ranges: list):
+        ranges_key = self.get_cache_key("ranges")
+        for range_index, (first_name, last_name, records_number) in enumerate(ranges, start=1):
+            frappe.cache().lpush(ranges_key, json.dumps([range_index, len(ranges), first_name, last_name,
+                                                         records_number]))
+        for key_name in ("ranges", "done_ranges", "processed", "failed"):
+            frappe.cache().expire(self.make_cache_key(key_name), self.cache_expiry_seconds)
+
+    def heartbeat(self):
+        if self.claiming:
+            frappe.cache().set(self.make_cache_key(f"heartbeat|{self.worker_id}"), 1, ex=self.heartbeat_seconds)
+
+    def process_queued_ranges(self):
+        processing_key = self.make_cache_key(f"processing|{self.worker_id}")
+        frappe.cache().rpush(self.get_cache_key("workers"), self.worker_id)
+        frappe.cache().expire(self.make_cache_key("workers"), self.cache_expiry_seconds)
+        self.claiming = True
+        try:
+            while True:
+                # the heartbeat is set before claiming, a claimed range never belongs to a worker without one
+                self.heartbeat()
+                queued_range = frappe.cache().rpoplpush(self.make_cache_key("ranges"), processing_key)
+                if not queued_range:
+                    return
+                range_values = json.loads(queued_range)
+                processed_records_number, failed_records_number = self.process_range(*range_values)
+                self.complete_range(range_index=range_values[0], processed_records_number=processed_records_number,
+                                    failed_records_number=failed_records_number)
+                frappe.cache().lrem(processing_key, 1, queued_range)
+        finally:
+            self.claiming = False
+            frappe.cache().delete(self.make_cache_key(f"heartbeat|{self.worker_id}"))
+
+    def complete_range(self, range_index: int, processed_records_number: int, failed_records_number: int):
+        # counted once, a range queued again after its worker's heartbeat expired may still be completed twice
+        if not frappe.cache().set(self.make_cache_key(f"done|{range_index}"), 1, nx=True,
+                                  ex=self.cache_expiry_seconds):
+            return
+        frappe.cache().incrby(self.make_cache_key("processed"), processed_records_number)
+        frappe.cache().incrby(self.make_cache_key("failed"), failed_records_number)
+        frappe.cache().incrby(self.make_cache_key("done_ranges"), 1)
+
+    def requeue_stopped_workers_ranges(self) -> int:
+        # the claimed ranges of the other workers without a heartbeat moved back to the queue
+        requeued_ranges_number = 0
+        worker_ids = {frappe.safe_decode(worker_id)
+                      for worker_id in frappe.cache().lrange(self.get_cache_key("workers"), 0, -1)}
+        for worker_id in worker_ids - {self.worker_id}:
+            if frappe.cache().get(self.make_cache_key(f"heartbeat|{worker_id}")):
+                continue
+            while frappe.cache().rpoplpush(self.make_cache_key(f"processing|{worker_id}"),
+                                           self.make_cache_key("ranges")):
+                requeued_ranges_number += 1
+        return requeued_ranges_number
+
+    def get_cache_counter(self, key_name: str) -> int:
+        return int(frappe.cache().get(self.make_cache_key(key_name)) or 0)
+
+    def wait_for_ranges(self, ranges_number: int) -> bool:
+        wait_start_time = time.monotonic()
+        while self.get_cache_counter("done_ranges") < ranges_number:
+            if time.monotonic() - wait_start_time > self.wait_timeout:
+                return False
+            requeued_ranges_number = self.requeue_stopped_workers_ranges()
+            if requeued_ranges_number:
+                get_action_log_writer().add(
+                    action=f"Biometric attendance: {requeued_ranges_number} ranges of stopped workers queued again",
+                    action_type="LOG", level="Warning")
+                self.process_queued_ranges()
+                continue
+            time.sleep(5)
+        return True
+
+    def get_not_processed_records_number(self, last_name: str) -> int:
+        return frappe.db.sql(f"""
+                        SELECT COUNT(*) FROM `tab{biometric_record_doctype}`
+                        WHERE status != 'Processed' AND timestamp BETWEEN %(start_date)s AND %(end_date)s
+                            AND name <= %(last_name)s
+                        """, dict(self.get_filters(), last_name=last_name))[0][0]
+
+    def run(self) -> dict:
+        try:
+            ranges = self.get_ranges()
+        except ProgrammingError as ex:
+            if ex.args != ('DocType', biometric_record_doctype):
+                raise
+            frappe.log_error(message=f"'{biometric_record_doctype}' doctype not found. "
+                                     "Make sure lava_custom is installed or disable biometric attendance "
+                                     "processing",
+                             title=batch_biometric_process_title)
+            return {}
+        if not ranges:
+            return {"ranges": 0, "records": 0, "processed": 0, "failed": 0, "not_processed": 0}
+
+        completed = True
+        if self.workers == 1 or len(ranges) == 1:
+            for range_index, (first_name, last_name, records_number) in enumerate(ranges, start=1):
+                self.process_range(range_index=range_index, ranges_number=len(ranges), first_name=first_name,
+                                   last_name=last_name, records_number=records_number)
+        else:
+            self.queue_ranges(ranges)
+            for _ in range(min(self.workers, len(ranges)) - 1):
+                frappe.enqueue(method='payroll_lavado.biometric_process.run_biometric_records_ranges',
+                               queue="long", timeout=36000000, start_date=self.start_date, end_date=self.end_date,
+                               run_id=self.run_id, page_size=self.page_size)
+            self.process_queued_ranges()
+            completed = self.wait_for_ranges(ranges_number=len(ranges))
+            self.processed_records_number = self.get_cache_counter("processed")
+            self.failed_records_number = self.get_cache_counter("failed")
+
+        summary = {"ranges": len(ranges), "records": sum(records_number for _, _, records_number in ranges),
+                   "processed": self.processed_records_number, "failed": self.failed_records_number,
+                   "not_processed": self.get_not_processed_records_number(last_name=ranges[-1][1])}
+        if not completed:
+            get_action_log_writer().add(
+                action=f"Biometric attendance ranges not completed after {self.wait_timeout} seconds: "
+                       f"{len(ranges) - self.get_cache_counter('done_ranges')} of {len(ranges)} ranges are "
+                       f"still running", action_type="LOG", level="Warning")
+        if summary["not_processed"]:
+            get_action_log_writer().add(
+                action=f"{summary['not_processed']} biometric attendance records of the period are still "
+                       f"not processed, {summary['failed']} failed while processing", action_type="LOG",
+                level="Warning")
+        return summary
+
+
+def run_biometric_records_ranges(start_date: date, end_date: date, run_id: str, page_size: int = 100):
+    try:
+        BiometricRecordsProcess(start_date=start_date, end_date=end_date, run_id=run_id,
+                                page_size=page_size).process_queued_ranges()
+    finally:
+        get_action_log_writer().flush()
+        frappe.db.commit()
@@ -1,78 +1,187 @@
-import frappe
 import datetime
+import json
+import time
+
+import frappe
+import redis
+from frappe.utils import getdate
+
+changelog_queue_key_prefix: str = "lavado_employee_changelog"
+changelog_queue_expiry_seconds: int = 24 * 60 * 60
+changelog_queue_lock_seconds: int = 10 * 60
+changelog_fields: list = ["name", "change_date", "designation", "branch", "salary_structure_assignment",
+                          "shift_type"]
+
+
+def get_queue_key(key_name: str) -> str:
+    return frappe.cache().make_key(f"{changelog_queue_key_prefix}|{key_name}")
+
+
+def queue_employee_change_log(employee_id: str, source_doctype: str, source_id: str, change_date=None):
+    # the changes of an employee are coalesced in the cache: the first queued change adds the employee to the
+    # pending employees. The queue is processed by the per minute scheduled job once no change was queued for
+    # the debounce interval, nothing is enqueued from the saving request
+    source = json.dumps([source_doctype, source_id, str(change_date) if change_date else None])
+    # the cache wrapper's rpush doesn't return the list length, the redis client's one does
+    if redis.Redis.rpush(frappe.cache(), get_queue_key(employee_id), source) == 1:
+        frappe.cache().rpush(f"{changelog_queue_key_prefix}|employees", employee_id)
+    now = time.time()
+    frappe.cache().set(get_queue_key("last_change_time"), now, ex=changelog_queue_expiry_seconds)
+    frappe.cache().set(get_queue_key("first_change_time"), now, nx=True, ex=changelog_queue_expiry_seconds)
+    for key_name in (employee_id, "employees"):
+        frappe.cache().expire(get_queue_key(key_name), changelog_queue_expiry_seconds)
+
+
+def is_queue_due(debounce_seconds: int, max_wait_seconds: int) -> bool:
+    # no change was queued for debounce_seconds, or the oldest pending change waits for max_wait_seconds
+    first_change_time = float(frappe.cache().get(get_queue_key("first_change_time")) or 0)
+    if not first_change_time:
+        # the employees left by a stopped run
+        return bool(frappe.cache().llen(f"{changelog_queue_key_prefix}|employees"))
+    now = time.time()
+    last_change_time = float(frappe.cache().get(get_queue_key("last_change_time")) or 0)
+    return now - last_change_time >= debounce_seconds or now - first_change_time >= max_wait_seconds
+
 
+def pop_employee_sources(employee_id: str) -> list:
+    # the queued (source doctype, source id, change date) of the employee in their saving order, a source saved
+    # more than once is kept at its last position
+    sources = {}
+    while True:
+        source = frappe.cache().lpop(f"{changelog_queue_key_prefix}|{employee_id}")
+        if not source:
+            return [(source_doctype, source_id, change_date)
+                    for (source_doctype, source_id), change_date in sources.items()]
+        source_doctype, source_id, change_date = json.loads(source)
+        sources.pop((source_doctype, source_id), None)
+        sources[(source_doctype, source_id)] = change_date
 
-def create_employee_change_log(employee_id: str, source_doctype: str, source_id: str):
-    employee_doc = frappe.get_doc("Employee", employee_id)
-    effective_change_date = None
 
-    if source_doctype.lower() == "employee":
-        employee_old_doc = employee_doc.get_doc_before_save()
-        effective_change_date = datetime.date.today()
-        if employee_old_doc:
-            if employee_old_doc.designation.lower() == employee_doc.designation.lower() and \
-                    employee_old_doc.company == employee_doc.company:
+def process_employee_change_log_queue(debounce_seconds: int = 30, max_wait_seconds: int = 5 * 60):
+    # scheduled every minute, a queue not due yet is left to the next run instead of waiting in the worker.
+    # The lock keeps the runs from overlapping, it expires by itself if the job is killed
+    lock_key = get_queue_key("lock")
+    if not frappe.cache().set(lock_key, 1, nx=True, ex=changelog_queue_lock_seconds):
+        return
+    try:
+        if not is_queue_due(debounce_seconds=debounce_seconds, max_wait_seconds=max_wait_seconds):
+            return
+        # the changes queued from now on are due by the next runs
+        frappe.cache().delete(get_queue_key("first_change_time"))
+        while True:
+            employee_id = frappe.cache().lpop(f"{changelog_queue_key_prefix}|employees")
+            if not employee_id:
                 return
+            frappe.cache().expire(lock_key, changelog_queue_lock_seconds)
+            employee_id = frappe.safe_decode(employee_id)
+            sources = pop_employee_sources(employee_id)
+            try:
+                EmployeeChangelogResolver(employee_id=employee_id).apply_sources(sources)
+                frappe.db.commit()
+            except Exception as ex:
+                frappe.db.rollback()
+                frappe.log_error(message=f"creating the changelog records of employee {employee_id} for "
+                                         f"{sources}; Error: '{ex}'", title="employee_change_log")
+    finally:
+        frappe.cache().delete(lock_key)
+
+
+class EmployeeChangelogResolver:
+    # the changelog records of the employee's coalesced changes, applied in their saving order. The employee,
+    # its latest salary structure and shift assignments and its latest changelog record are read once with
+    # the needed columns only; the source assignment of a change replaces the latest one for that change
+    def __init__(self, employee_id: str):
+        self.employee = frappe.db.get_value("Employee", employee_id, ["name", "company", "designation", "branch"],
+                                            as_dict=1)
+        self.latest_salary_structure_assignment = None
+        self.latest_shift_assignment = None
+        self.latest_changelog_record = None
+        if self.employee:
+            self.latest_salary_structure_assignment = self.get_salary_structure_assignment()
+            self.latest_shift_assignment = self.get_shift_assignment()
+            self.latest_changelog_record = self.get_latest_changelog_record()
+
+    def get_salary_structure_assignment(self, name: str = None):
+        # the named assignment or the employee's latest one in the company, with the salary structure's hour rate
+        condition = "ssa.name = %(name)s" if name else "ssa.employee = %(employee)s AND ssa.company = %(company)s"
+        salary_structure_assignments = frappe.db.sql(f"""
+                                SELECT ssa.name, ssa.from_date, ss.name AS salary_structure, ss.hour_rate
+                                FROM `tabSalary Structure Assignment` AS ssa
+                                    INNER JOIN `tabSalary Structure` AS ss ON ss.name = ssa.salary_structure
+                                WHERE {condition}
+                                ORDER BY ssa.from_date DESC LIMIT 1
+                                """, {'name': name, 'employee': self.employee.name,
+                                      'company': self.employee.company}, as_dict=1)
+        return salary_structure_assignments[0] if salary_structure_assignments else None
+
+    def get_shift_assignment(self, name: str = None):
+        filters = {'name': name} if name else {'employee': self.employee.name, 'company': self.employee.company}
+        shift_assignments = frappe.get_all("Shift Assignment", filters=filters, fields=["shift_type", "start_date"],
+                                           order_by="start_date desc", limit=1)
+        return shift_assignments[0] if shift_assignments else None
+
+    def get_latest_changelog_record(self):
+        changelog_records = frappe.get_all("Lava Employee Payroll Changelog",
+                                           filters={"company": self.employee.company,
+                                                    "employee": self.employee.name},
+                                           fields=changelog_fields, order_by="modified desc", limit=1)
+        return changelog_records[0] if changelog_records else None
 
-    salary_structure_assignment = None
-    if source_doctype.lower() == "salary structure assignment":
-        salary_structure_assignment = frappe.get_doc("Salary Structure Assignment", source_id)
-        effective_change_date = salary_structure_assignment.from_date
-    else:
-        salary_structure_assignments = frappe.get_all("Salary Structure Assignment",
-                                                      filters={'employee': employee_id, 'company': employee_doc.company}
-                                                      , fields=['*'], order_by="from_date desc")
-        if salary_structure_assignments:
-            salary_structure_assignment = salary_structure_assignments[0]
-        else:
+    def apply_sources(self, sources: list):
+        for source_doctype, source_id, change_date in sources:
+            self.apply_source(source_doctype=source_doctype, source_id=source_id,
+                              change_date=getdate(change_date) if change_date else None)
+
+    def apply_source(self, source_doctype: str, source_id: str, change_date: datetime.date = None):
+        if not self.employee:
             return
-    salary_structure_doc = frappe.get_doc("Salary Structure", salary_structure_assignment.salary_structure)
-
-    shift_type_doc = None
-    if source_doctype.lower() == "shift assignment":
-        shift_assignment = frappe.get_doc("Shift Assignment", source_id)
-        shift_type_doc = frappe.get_doc("Shift Type", shift_assignment.shift_type)
-        effective_change_date = shift_assignment.start_date
-    else:
-        shift_assignments = frappe.get_all("Shift Assignment",
-                                           filters={'employee': employee_id, 'company': employee_doc.company}
-                                           , fields=['*'], order_by="start_date desc")
-        if shift_assignments:
-            shift_type_doc = frappe.get_doc("Shift Type", shift_assignments[0].shift_type)
-        else:
+        effective_change_date = change_date or datetime.date.today()
+
+        salary_structure_assignment = self.latest_salary_structure_assignment
+        if source_doctype.lower() == "salary structure assignment":
+            salary_structure_assignment = self.get_salary_structure_assignment(name=source_id)
+            if salary_structure_assignment:
+                effective_change_date = salary_structure_assignment.from_date
+        if not salary_structure_assignment:
             return
 
-    existing_change_log_docs = frappe.db.get_all("Lava Employee Payroll Changelog",
-                                                 filters={"company": employee_doc.company, "employee": employee_id},
-                                                 order_by="modified desc")
-
-    if source_doctype.lower() == "employee transfer":
-        employee_transfer_doc = frappe.get_doc("Employee Transfer", source_id)
-        effective_change_date = employee_transfer_doc.transfer_date
-
-    if existing_change_log_docs:
-        existing_change_log_doc = frappe.get_doc("Lava Employee Payroll Changelog", existing_change_log_docs[0])
-        if existing_change_log_doc.designation == employee_doc.designation and \
-                existing_change_log_doc.branch == employee_doc.branch and \
-                existing_change_log_doc.salary_structure_assignment == salary_structure_doc.name and \
-                existing_change_log_doc.shift_type == shift_type_doc.name:
-            return  # no need to save a new record
-        else:
-            # delete the existing record to get ready for the new record on the same date
-            if existing_change_log_doc.change_date == effective_change_date:
-                frappe.delete_doc("Lava Employee Payroll Changelog", name=existing_change_log_doc.name)
+        shift_assignment = self.latest_shift_assignment
+        if source_doctype.lower() == "shift assignment":
+            shift_assignment = self.get_shift_assignment(name=source_id)
+            if shift_assignment:
+                effective_change_date = shift_assignment.start_date
+        if not shift_assignment:
+            return
 
-    employee_change_log_record = frappe.new_doc('Lava Employee Payroll Changelog')
-    employee_change_log_record.employee = employee_id
-    employee_change_log_record.company = employee_doc.company
-    employee_change_log_record.designation = employee_doc.designation
-    employee_change_log_record.branch = employee_doc.branch
+        if source_doctype.lower() == "employee transfer":
+            effective_change_date = getdate(frappe.db.get_value("Employee Transfer", source_id, "transfer_date"))
 
-    employee_change_log_record.change_date = effective_change_date
+        existing_changelog_record = self.latest_changelog_record
+        if existing_changelog_record:
+            if existing_changelog_record.designation == self.employee.designation and \
+                    existing_changelog_record.branch == self.employee.branch and \
+                    existing_changelog_record.salary_structure_assignment == salary_structure_assignment.name and \
+                    existing_changelog_record.shift_type == shift_assignment.shift_type:
+                return  # no need to save a new record
+            # delete the existing record to get ready for the new record on the same date
+            if existing_changelog_record.change_date == effective_change_date:
+                frappe.delete_doc("Lava Employee Payroll Changelog", name=existing_changelog_record.name,
+                                  ignore_permissions=True)
 
-    employee_change_log_record.salary_structure_assignment = salary_structure_assignment.name
-    employee_change_log_record.hourly_rate = salary_structure_doc.hour_rate or 0
+        employee_change_log_record = frappe.new_doc('Lava Employee Payroll Changelog')
+        employee_change_log_record.employee = self.employee.name
+        employee_change_log_record.company = self.employee.company
+        employee_change_log_record.designation = self.employee.designation
+        employee_change_log_record.branch = self.employee.branch
+        employee_change_log_record.change_date = effective_change_date
+        employee_change_log_record.salary_structure_assignment = salary_structure_assignment.name
+        employee_change_log_record.hourly_rate = salary_structure_assignment.hour_rate or 0
+        employee_change_log_record.shift_type = shift_assignment.shift_type
+        employee_change_log_record.insert(ignore_permissions=True)
+        self.latest_changelog_record = frappe._dict({field: employee_change_log_record.get(field)
+                                                     for field in changelog_fields})
 
-    employee_change_log_record.shift_type = shift_type_doc.name
 
-    employee_change_log_record.insert(ignore_permissions=True)
+def create_employee_change_log(employee_id: str, source_doctype: str, source_id: str, change_date=None):
+    EmployeeChangelogResolver(employee_id=employee_id).apply_source(
+        source_doctype=source_doctype, source_id=source_id, change_date=getdate(change_date) if change_date else None)
@@ -113,6 +113,14 @@ doc_events = {
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "payroll_lavado.employee_change_log.process_employee_change_log_queue"
+        ]
+    }
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"payroll_lavado.tasks.all"
@@ -0,0 +1,14 @@
+import frappe
+
+
+def execute():
+    # the batch used to find the Additional Salary of a penalty by its reason text, link the already created ones
+    frappe.reload_doc("payroll_lavado", "doctype", "lava_penalty_record")
+    frappe.db.sql("""
+                UPDATE `tabLava Penalty Record` pr INNER JOIN `tabAdditional Salary` a
+                    ON a.employee = pr.employee
+                    AND a.payroll_date = pr.penalty_date
+                    AND a.reason LIKE CONCAT('%%Apply policy: ', pr.penalty_policy, '%%')
+                SET pr.additional_salary = a.name
+                WHERE pr.additional_salary IS NULL OR pr.additional_salary = ''
+                """)
@@ -1,28 +1,79 @@
 import datetime
 import json
 from datetime import date
-from pymysql import ProgrammingError
 import frappe
 # noinspection PyProtectedMember
 from frappe import _
 from frappe import _dict as fdict
-from frappe.utils import time_diff_in_hours, getdate, time_diff_in_seconds, to_timedelta
+from frappe.utils import getdate, now_datetime
+from payroll_lavado.batch_config import BatchConfigSnapshot
+from payroll_lavado.batch_metrics import BatchMetrics
+from payroll_lavado.batch_profiler import BatchProfiler
+from payroll_lavado.batch_progress import BatchProgress
+from payroll_lavado.batch_indexes import EmployeeChangelogIndex, PenaltyPolicyIndex, PenaltyOccurrenceWindow, \
+    PenaltyRecordIndex, AffectedAttendanceDates
+from payroll_lavado.batch_rollback import BatchRollback
+from payroll_lavado.biometric_process import BiometricRecordsProcess, batch_biometric_process_title
+from payroll_lavado.penalty_engine import PenaltyEngine
+from payroll_lavado.batch_writers import BatchObjectWriter, AttendanceFieldsWriter, get_action_log_writer
+from payroll_lavado.working_hours import ShiftTypeCache, AttendanceBreakdowns, TimesheetLogsBuilder, \
+    calc_attendance_breakdown, get_query_columns
 
 # TODO: Remove 'lava net working hours from lava_custom and all the code using.
 
 batch_process_title: str = "LavaDo Payroll Process"
-batch_biometric_process_title: str = "run_biometric_attendance_records_process"
+attendance_fields: list = ["name", "employee", "attendance_date", "status", "docstatus", "shift",
+                           "in_time", "out_time", "late_entry", "early_exit", "working_hours",
+                           "lava_entry_duration_difference", "lava_exit_duration_difference",
+                           "lava_planned_working_hours"]
+# the attendance query also computes the columns read by the vectorized breakdowns
+attendance_query_fields: list = attendance_fields + ["in_seconds", "out_seconds", "breakdown_checked"]
+attendance_query_columns: str = ", ".join(
+    [f"`{field}`" for field in attendance_fields]
+    + ["IFNULL(FLOOR(TIME_TO_SEC(TIME(in_time))), -1) AS in_seconds",
+       "IFNULL(FLOOR(TIME_TO_SEC(TIME(out_time))), -1) AS out_seconds",
+       "(status NOT IN ('Absent', 'On Leave') AND docstatus = 1) AS breakdown_checked"])
+changelog_fields: list = ["name", "employee", "company", "branch", "shift_type", "change_date", "designation",
+                          "salary_structure_assignment", "hourly_rate"]
+# the shift times and grace periods, and the auto attendance settings checked by validate_shift_types
+shift_type_fields: list = ["name", "start_time", "end_time", "late_entry_grace_period", "early_exit_grace_period",
+                           "enable_auto_attendance", "process_attendance_after", "last_sync_of_checkin"]
 
 
 class PayrollLavaDoManager:
-    penalty_policy_groups: list = []
-    penalty_policies: list = []
-    shift_types: list = []
+    batch_config: BatchConfigSnapshot = None
+    penalty_policy_groups: tuple = ()
+    penalty_policies: tuple = ()
+    penalty_policy_index: PenaltyPolicyIndex = None
+    penalty_occurrence_window: PenaltyOccurrenceWindow = None
+    penalty_record_index: PenaltyRecordIndex = None
+    additional_salary_mode: str = "Per Penalty"
+    incremental_run: bool = False
+    dry_run: bool = False
+    profile_mode: str = "Off"
+    profile_employees: int = 0
+    profiled_employees: int = 0
+    batch_profiler: BatchProfiler = None
+    profile_job_name: str = "main"
+    affected_attendance_dates: AffectedAttendanceDates = None
+    employee_penalties_deductions: dict = None
+    batch_object_writer: BatchObjectWriter = None
+    batch_progress: BatchProgress = None
+    attendance_fields_writer: AttendanceFieldsWriter = None
+    commit_policy: str = "Per Employee"
+    commit_every_employees: int = 50
+    uncommitted_employees: int = 0
+    employee_savepoint: str = "lavado_employee"
+    shift_types: list = None
+    shift_type_cache: ShiftTypeCache = None
+    vectorized_breakdowns: bool = False
+    attendance_breakdowns: AttendanceBreakdowns = None
     debug_mode: bool = False
     clear_action_log_records: bool = False
     clear_error_log_records: bool = False
     clear_batch_objects: bool = False
     run_biometric_attendance_process: bool = False
+    biometric_workers: int = 1
     run_auto_attendance_batch_options: bool = False
     payroll_activity_type: str = "payroll_activity_type"
     running_batch_id: str
@@ -32,15 +83,25 @@ class PayrollLavaDoManager:
     batch_selected_branches = None
     batch_selected_shifts = None
     batch_selected_employees = None
+    batch_shards: int = 1
+    employees_chunk_size: int = 100
+
+    def __init__(self):
+        # the loaded records are per instance, a worker may run more than one batch
+        self.shift_types = []
+        self.employee_penalties_deductions = {}
+        self.batch_metrics = BatchMetrics()
 
     def add_batch_to_background_jobs(self, company: str, start_date: date, end_date: date, batch_options):
         self.debug_mode = True if (batch_options["chk-batch-debug-mode"] == 1) else False
 
         try:
             if self.debug_mode:
-                self.create_resume_batch_process(company=company, start_date=start_date,
-                                                 end_date=end_date,
-                                                 batch_options=batch_options)
+                with self.batch_metrics.count_queries(frappe.db):
+                    self.create_resume_batch_process(company=company, start_date=start_date,
+                                                     end_date=end_date,
+                                                     batch_options=batch_options)
+                self.save_batch_metrics()
             else:
                 frappe.enqueue(method='payroll_lavado.payroll_batch.run_payroll_batch_process',
                                queue="long", timeout=36000000,
@@ -51,40 +112,17 @@ class PayrollLavaDoManager:
             frappe.log_error(
                 message=f"add the background job or run direct process; "
                         f"Error message: '{format_exception(ex)}'", title=batch_process_title)
+        finally:
+            self.save_batch_profile()
+            flush_action_logs()
 
     @staticmethod
-    def run_biometric_attendance_records_process(start_date, end_date):
-        limit_page_start = 0
-        limit_page_length = 100
-        while True:
-            try:
-                checkin_records = frappe.get_all("Lava Biometric Attendance Record",
-                                                 {
-                                                     'status': ["!=", 'Processed'],
-                                                     'timestamp': ["between", [start_date.strftime('%Y-%m-%d'),
-                                                                               end_date.strftime('%Y-%m-%d')]]
-                                                 }, limit_start=limit_page_start, limit_page_length=limit_page_length)
-            except ProgrammingError as ex:
-                if ex.args != ('DocType', 'Lava Biometric Attendance Record'):
-                    raise
-                frappe.log_error(message="'Lava Biometric Attendance Record' doctype not found. "
-                                         "Make sure lava_custom is installed or disable biometric attendance "
-                                         "processing",
-                                 title=batch_biometric_process_title)
-                break
-
-            if not checkin_records:
-                break
-
-            limit_page_start += limit_page_length
-            for checkin_record in checkin_records:
-                try:
-                    checkin_doc = frappe.get_doc("Lava Biometric Attendance Record", checkin_record.name)
-                    checkin_doc.process()
-                except Exception as ex:
-                    frappe.log_error(message=f"record id: '{checkin_record.name}', "
-                                             f"employee_biometric_id: '{checkin_record.employee_biometric_id}'. "
-                                             f"Error: '{format_exception(ex)}'", title=batch_biometric_process_title)
+    def run_biometric_attendance_records_process(start_date, end_date, workers: int = 1):
+        summary = BiometricRecordsProcess(start_date=start_date, end_date=end_date, workers=workers).run()
+        if summary:
+            add_action_log(action=f"Processed the biometric attendance records in {summary['ranges']} ranges: "
+                                  f"{summary['processed']} processed, {summary['failed']} failed, "
+                                  f"{summary['not_processed']} still not processed")
 
     def check_payroll_activity_type(self):
         if not frappe.db.exists("Activity Type", self.payroll_activity_type):
@@ -119,132 +157,105 @@ class PayrollLavaDoManager:
                              title=batch_process_title)
         return True
 
-    def get_penalty_policy_groups(self):
-        if self.penalty_policy_groups:
-            self.penalty_policy_groups.clear()
-        penalty_policy_group_records = frappe.get_all("Lava Penalty Group", filters={"docstatus": 1},
-                                                      order_by='title', fields=["name"],
-                                                      limit_start=0,
-                                                      limit_page_length=200)
-
-        for record in penalty_policy_group_records:
-            doc = frappe.get_doc("Lava Penalty Group", record.name).as_dict()
-            self.penalty_policy_groups.append(doc)
-        return
+    def get_penalty_policy_groups(self) -> list:
+        return frappe.get_all("Lava Penalty Group", filters={"docstatus": 1},
+                              order_by='title',
+                              fields=["name", "title", "reset_duration", "deduction_rule"],
+                              limit_start=0,
+                              limit_page_length=200)
 
     def get_shift_types(self):
         if self.shift_types:
             self.shift_types.clear()
-        self.shift_types = frappe.get_all("Shift Type", fields=["*"],
+        self.shift_types = frappe.get_all("Shift Type", fields=shift_type_fields,
                                           limit_start=0, limit_page_length=100)
         return
 
-    def get_policy_group_by_id(self, policy_group_id, groups=None):
-        if not groups:
-            groups = self.penalty_policy_groups
-
-        for group in groups:
-            if group.name.lower() == policy_group_id.lower():
-                return group
-        return None
+    def get_shift_type_by_id(self, shift_type_id):
+        return self.shift_type_cache.get_shift_type(shift_type_id)
 
-    def get_policy_group_by_policy_subgroup(self, policy_sub_group_name: str, policies: []):
-        for policy in policies:
-            if policy.policy_subgroup.lower() == policy_sub_group_name.lower():
-                group = self.get_policy_group_by_id(policy.penalty_group)
-                if group:
-                    return group
-        return None
-
-    def get_shift_type_by_id(self, shift_type_id, check_shift_types=None):
-        if not check_shift_types:
-            check_shift_types = self.shift_types
-
-        for shift_type in check_shift_types:
-            if shift_type.name.lower() == shift_type_id.lower():
-                return self.get_shift_type_doc(shift_type_id)
-        return None
-
-    def get_shift_type_doc(self, shift_type_id):
-        return frappe.get_doc('Shift Type', shift_type_id)
-
-    def get_policy_by_id(self, policy_id, policies=None):
+    def get_policy_by_id(self, policy_id, employee_designation: str = None):
         if not policy_id:
             frappe.throw(msg=f"get_policy_by_id: no policy id", title=batch_process_title)
 
-        if not policies:
-            policies = self.penalty_policies
-
-        for policy in policies:
-            if (policy['policy_name']).lower() == policy_id.lower():
-                return policy
-        return None
-
-    def get_policy_by_filters(self, policies, group_name, subgroup_name, occurrence_number,
-                              gap_duration_in_minutes):
-        # the policies are being assumed that they sorted by group, subgroup, tolerance_duration desc,
-        # occurrence_number desc
-        for policy in policies:
-            if policy['penalty_group'].lower() == group_name.lower() and \
-                    policy['policy_subgroup'].lower() == subgroup_name.lower() and \
-                    policy['occurrence_number'] <= occurrence_number:
-                if policy['policy_subgroup'].lower() == 'attendance check-in' or \
-                        policy['policy_subgroup'].lower() == 'attendance check-out':
-                    if policy['tolerance_duration'] <= gap_duration_in_minutes:
-                        return policy
-                else:
-                    return policy
-        return None
-
-    def get_penalty_policies(self, company):
-        if self.penalty_policies:
-            self.penalty_policies.clear()
+        if employee_designation is None:
+            return self.penalty_policy_index.get_policy(policy_id)
+        return self.penalty_policy_index.get_designation_policy(designation=employee_designation,
+                                                                policy_name=policy_id)
+
+    def capture_batch_config_snapshot(self, company: str) -> BatchConfigSnapshot:
+        shift_types = frappe.get_all("Shift Type", fields=["name", "start_time", "end_time"], order_by="name")
+        return BatchConfigSnapshot(penalty_policy_groups=self.get_penalty_policy_groups(),
+                                   penalty_policies=self.get_penalty_policies(company),
+                                   shift_types=shift_types,
+                                   payroll_activity_type=self.payroll_activity_type,
+                                   standard_working_hours=frappe.db.get_single_value("HR Settings",
+                                                                                     "standard_working_hours"))
+
+    def load_batch_config_snapshot(self, batch_id: str) -> BatchConfigSnapshot:
+        config_snapshot = frappe.db.get_value("Lava Payroll LavaDo Batch", batch_id, "config_snapshot")
+        if config_snapshot:
+            return BatchConfigSnapshot.from_json(config_snapshot)
+        # a batch created before the snapshots, it keeps the configuration of its first resume
+        batch_config = self.capture_batch_config_snapshot(self.running_batch_company)
+        frappe.db.set_value("Lava Payroll LavaDo Batch", batch_id,
+                            {"config_snapshot": batch_config.to_json(), "config_hash": batch_config.config_hash})
+        add_action_log(action=f"Batch: {batch_id} had no configuration snapshot, "
+                              f"captured {batch_config.config_hash}", level="Warning")
+        return batch_config
+
+    def apply_batch_config_snapshot(self, batch_config: BatchConfigSnapshot):
+        self.batch_config = batch_config
+        self.penalty_policy_groups = batch_config.penalty_policy_groups
+        self.penalty_policies = batch_config.penalty_policies
+        self.penalty_policy_index = PenaltyPolicyIndex(penalty_policies=self.penalty_policies,
+                                                       penalty_policy_groups=self.penalty_policy_groups)
+        self.shift_type_cache = ShiftTypeCache(batch_config.shift_types)
+        self.payroll_activity_type = batch_config.payroll_activity_type
+
+    def get_penalty_policies(self, company) -> list:
+        penalty_policies = []
+        # one query for the policies with their designations rows, ordered by the policy then its designations
         rows = frappe.db.sql("""SELECT 
                                 p.name, p.title AS policy_title, p.penalty_group, p.occurrence_number,
                                 p.deduction_factor, p.deduction_amount,
                                 p.penalty_subgroup,
                                 p.tolerance_duration,
                                 p.salary_component,
-                                g.deduction_rule, g.reset_duration
+                                g.deduction_rule, g.reset_duration,
+                                d.designation AS designation_name
                             FROM 
                                 `tabLava Penalty Policy` AS p 
                             INNER JOIN `tabLava Penalty Group` AS g
                                 ON p.penalty_group = g.name
+                            LEFT JOIN `tabPolicy Designations` AS d
+                                ON d.parent = p.name AND d.parenttype = 'Lava Penalty Policy'
                             WHERE
                                 p.docstatus=1 AND p.enabled= 1 AND p.company = %(company)s
                             ORDER BY p.penalty_group, p.penalty_subgroup, p.tolerance_duration desc,
-                             p.occurrence_number desc
+                             p.occurrence_number desc, p.name, d.designation
                                 """, {'company': company}, as_dict=1)
+        policy = None
         for row in rows:
-            policy = fdict({'policy_name': row.name,
-                            'policy_title': row.policy_title,
-                            'penalty_group': row.penalty_group.lower(),
-                            'deduction_rule': row.deduction_rule.lower(),
-                            'reset_duration': row.reset_duration,
-                            'occurrence_number': row.occurrence_number,
-                            'policy_subgroup': row.penalty_subgroup.lower(),
-                            'deduction_factor': row.deduction_factor,
-                            'deduction_amount': row.deduction_amount,
-                            'tolerance_duration': row.tolerance_duration,
-                            "salary_component": row.salary_component,
-                            'designations': []})
-            self.get_policy_designations(company=company, policy_obj=policy)
-            self.penalty_policies.append(policy)
-
-    def get_policy_designations(self, company, policy_obj):
-        rows = frappe.db.sql("""SELECT 
-                                    d.designation AS designation_name
-                                FROM 
-                                   `tabPolicy Designations` AS d
-                                WHERE
-                                    d.parent = %(policy_id)s
-                                ORDER BY designation
-                                    """, {'policy_id': policy_obj.policy_name}, as_dict=1)
-        for row in rows:
-            policy_obj['designations'].append({'designation_name': row.designation_name})
-
-    def create_resume_batch_process(self, company: str, start_date: date, end_date: date, batch_options):
-        batch_action_type = batch_options['action_type']
+            if not policy or policy.policy_name != row.name:
+                policy = fdict({'policy_name': row.name,
+                                'policy_title': row.policy_title,
+                                'penalty_group': row.penalty_group.lower(),
+                                'deduction_rule': row.deduction_rule.lower(),
+                                'reset_duration': row.reset_duration,
+                                'occurrence_number': row.occurrence_number,
+                                'policy_subgroup': row.penalty_subgroup.lower(),
+                                'deduction_factor': row.deduction_factor,
+                                'deduction_amount': row.deduction_amount,
+                                'tolerance_duration': row.tolerance_duration,
+                                "salary_component": row.salary_component,
+                                'designations': []})
+                penalty_policies.append(policy)
+            if row.designation_name:
+                policy['designations'].append({'designation_name': row.designation_name})
+        return penalty_policies
+
+    def set_batch_options(self, company: str, start_date: date, end_date: date, batch_options):
         self.batch_selected_branches = batch_options['branches']
         self.batch_selected_shifts = batch_options['shifts']
         self.batch_selected_employees = batch_options['employees']
@@ -259,8 +270,29 @@ class PayrollLavaDoManager:
         self.clear_batch_objects = True if (batch_options['chk-batch-objects'] == 1) else False
         self.run_auto_attendance_batch_options = True if (batch_options['chk-auto-attendance'] == 1) else False
         self.run_biometric_attendance_process = True if (batch_options['chk-biometric-process'] == 1) else False
+        self.batch_shards = max(1, int(batch_options.get('batch-shards') or 1))
+        self.biometric_workers = max(1, int(batch_options.get('biometric-workers') or 1))
+        get_action_log_writer().level = batch_options.get('action-log-level') or "Info"
+        self.commit_policy = batch_options.get('commit-policy') or "Per Employee"
+        self.commit_every_employees = max(1, int(batch_options.get('commit-every') or 50))
+        self.vectorized_breakdowns = True if (batch_options.get('chk-vectorized-breakdowns') == 1) else False
+        self.additional_salary_mode = batch_options.get('additional-salary-mode') or "Per Penalty"
+        self.incremental_run = True if (batch_options.get('chk-incremental-run') == 1) else False
+        self.dry_run = True if (batch_options.get('chk-dry-run') == 1) else False
+        self.profile_mode = batch_options.get('profile-mode') or "Off"
+        self.profile_employees = max(0, int(batch_options.get('profile-employees') or 0))
+
+    def create_resume_batch_process(self, company: str, start_date: date, end_date: date, batch_options):
+        batch_action_type = batch_options['action_type']
+        self.set_batch_options(company=company, start_date=start_date, end_date=end_date,
+                               batch_options=batch_options)
+        self.start_batch_profiler()
+        if self.dry_run and batch_action_type != "Resume Batch":
+            self.run_dry_run_batch()
+            return
 
         if self.clear_action_log_records and batch_action_type != "Resume Batch":
+            flush_action_logs()
             frappe.db.truncate("Lava Action Log")
             frappe.db.commit()
             add_action_log("cleared action log records", "Log")
@@ -287,14 +319,14 @@ class PayrollLavaDoManager:
 
         if self.run_biometric_attendance_process:
             add_action_log("Start processing the new and failed biometric attendance records ", "Log")
-            PayrollLavaDoManager.run_biometric_attendance_records_process(start_date=self.running_batch_start_date,
-                                                                          end_date=self.running_batch_end_date)
+            with self.batch_metrics.span("biometric processing"):
+                PayrollLavaDoManager.run_biometric_attendance_records_process(
+                    start_date=self.running_batch_start_date, end_date=self.running_batch_end_date,
+                    workers=self.biometric_workers)
             add_action_log("End processing the new and failed biometric attendance records ", "Log")
 
         add_action_log("Start batch", "Log")
 
-        self.get_penalty_policy_groups()
-        self.get_penalty_policies(company)
         self.get_shift_types()
         self.check_payroll_activity_type()
 
@@ -311,7 +343,8 @@ class PayrollLavaDoManager:
                              title=batch_process_title)
 
         if not self.batch_selected_branches and not self.batch_selected_employees and not self.batch_selected_shifts:
-            self.create_employees_first_changelog_records(self.running_batch_company)
+            with self.batch_metrics.span("changelog backfill"):
+                self.create_employees_first_changelog_records(self.running_batch_company)
             add_action_log(
                 action=f"Created the first employees changelog records if missing, "
                        f"Batch Process for Company: {self.running_batch_company}, "
@@ -328,6 +361,10 @@ class PayrollLavaDoManager:
             old_batch.status = "In Progress"
             old_batch.save()
             add_action_log(action=f"Resume batch {self.running_batch_id} for company: {self.running_batch_company}")
+            self.apply_batch_config_snapshot(self.load_batch_config_snapshot(batch_id=self.running_batch_id))
+            if old_batch.get("incremental_base_batch"):
+                self.affected_attendance_dates = self.get_affected_attendance_dates(
+                    base_batch_id=old_batch.incremental_base_batch)
             self.delete_failed_processed_employees_records(batch_id=self.running_batch_id)
         else:
             new_batch = frappe.new_doc("Lava Payroll LavaDo Batch")
@@ -337,13 +374,37 @@ class PayrollLavaDoManager:
             new_batch.batch_process_end_time = None
             new_batch.status = "In Progress"
             new_batch.end_date = self.running_batch_end_date
+            batch_config = self.capture_batch_config_snapshot(self.running_batch_company)
+            new_batch.config_snapshot = batch_config.to_json()
+            new_batch.config_hash = batch_config.config_hash
+            # taken before processing, the changes made while the batch runs are picked by the next incremental one
+            new_batch.high_water_marks = json.dumps(self.get_high_water_marks(), sort_keys=True)
+            new_batch.full_company_run = 0 if (self.batch_selected_branches or self.batch_selected_shifts
+                                               or self.batch_selected_employees) else 1
+            incremental_fallback_reason = None
+            if self.incremental_run:
+                new_batch.incremental_base_batch, incremental_fallback_reason = self.get_incremental_base_batch(
+                    config_hash=batch_config.config_hash)
             new_batch.save(ignore_permissions=True)
+            self.apply_batch_config_snapshot(batch_config)
             self.running_batch_id = new_batch.name
             add_action_log(
                 action=f"Batch: {self.running_batch_id} for Company: {self.running_batch_company} "
                        f"created")
+            if new_batch.get("incremental_base_batch"):
+                self.affected_attendance_dates = self.get_affected_attendance_dates(
+                    base_batch_id=new_batch.incremental_base_batch)
+            elif self.incremental_run:
+                add_action_log(action=f"Batch: {self.running_batch_id} {incremental_fallback_reason}, "
+                                      f"all the attendance is processed", level="Warning")
         if self.run_auto_attendance_batch_options:
-            self.run_auto_attendance_process()
+            with self.batch_metrics.span("auto attendance"):
+                self.run_auto_attendance_process()
+        if self.batch_shards > 1 and not self.debug_mode:
+            self.enqueue_batch_shards(batch_options=batch_options)
+            frappe.publish_realtime('msgprint', f'Batch {self.running_batch_id} is split into '
+                                                f'{self.batch_shards} shards...')
+            return
         self.process_employees()
         add_action_log(
             action=f"Batch: {self.running_batch_id} completed and will update the status")
@@ -351,13 +412,306 @@ class PayrollLavaDoManager:
             batch_new_status="Completed", batch_id=self.running_batch_id)
         frappe.publish_realtime('msgprint', 'Ending create_resume_batch_process...')
 
+    def run_dry_run_batch(self):
+        # the whole period through the penalty engine with the current configuration, the attendance breakdowns
+        # are computed in memory and nothing is written except the action log summary
+        add_action_log(action=f"Start dry run for Company: {self.running_batch_company}, "
+                              f"start date: {self.running_batch_start_date}, end date: {self.running_batch_end_date}")
+        self.running_batch_id = ""
+        self.apply_batch_config_snapshot(self.capture_batch_config_snapshot(self.running_batch_company))
+        self.attendance_fields_writer = None
+        employee_ids = self.get_batch_employees()
+        policies_totals = {}
+        failed_employees_number = 0
+        for chunk_start in range(0, len(employee_ids), self.employees_chunk_size):
+            employees_chunk = employee_ids[chunk_start:chunk_start + self.employees_chunk_size]
+            attendance_rows = self.get_employees_attendance_rows(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+            employees_attendance_lists = self.get_employees_attendance_lists(employee_ids=employees_chunk,
+                                                                             attendance_rows=attendance_rows)
+            employees_changelog_index = self.get_employees_changelog_index(employee_ids=employees_chunk,
+                                                                           max_date=self.running_batch_end_date)
+            self.penalty_occurrence_window = self.get_employees_penalty_occurrence_window(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+            self.penalty_record_index = self.get_employees_penalty_record_index(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+            for employee_id in employees_chunk:
+                employee_penalties = self.penalty_occurrence_window.get_employee_penalties(employee=employee_id)
+                try:
+                    penalty_decisions = self.get_employee_dry_run_penalties(
+                        employee_id=employee_id, attendance_list=employees_attendance_lists.get(employee_id, []),
+                        employees_changelog_index=employees_changelog_index)
+                except Exception as ex:
+                    self.penalty_occurrence_window.restore_employee_penalties(employee=employee_id,
+                                                                              employee_penalties=employee_penalties)
+                    failed_employees_number += 1
+                    add_action_log(action=f"Dry run failed for employee: {employee_id}, Error: '{ex}'",
+                                   level="Warning")
+                    continue
+                for penalty_decision in penalty_decisions:
+                    if penalty_decision['action'] == "Duplicate":
+                        continue
+                    add_action_log(action=f"Dry run {penalty_decision['action']} penalty: employee "
+                                          f"{penalty_decision['employee']}, date {penalty_decision['penalty_date']}, "
+                                          f"policy {penalty_decision['penalty_policy']}, occurrence "
+                                          f"{penalty_decision['occurrence_number']}, amount "
+                                          f"{penalty_decision['penalty_amount']}", level="Debug")
+                    policy_totals = policies_totals.setdefault(penalty_decision['penalty_policy'], [0, 0])
+                    policy_totals[0] += 1
+                    policy_totals[1] += penalty_decision['penalty_amount']
+            get_action_log_writer().flush_if_due()
+
+        for penalty_policy, (penalties_number, penalties_amount) in sorted(policies_totals.items()):
+            add_action_log(action=f"Dry run policy {penalty_policy}: {penalties_number} penalties, "
+                                  f"amount {round(penalties_amount, 2)}")
+        summary = f"Dry run completed for {len(employee_ids)} employees, {failed_employees_number} failed: " \
+                  f"{sum(totals[0] for totals in policies_totals.values())} penalties, amount " \
+                  f"{round(sum(totals[1] for totals in policies_totals.values()), 2)}"
+        add_action_log(action=summary)
+        frappe.publish_realtime('msgprint', summary)
+
+    def get_employee_dry_run_penalties(self, employee_id, attendance_list: list,
+                                       employees_changelog_index: EmployeeChangelogIndex) -> list:
+        attendance_changelog_records = {}
+        for attendance in attendance_list:
+            attendance_changelog_records[attendance.name] = employees_changelog_index.get_employee_changelog_record(
+                employee_id=employee_id, attendance_date=attendance.attendance_date)
+            if not attendance_changelog_records[attendance.name]:
+                frappe.throw(msg=f"Skipping {attendance.name} for the employee {attendance.employee} "
+                                 f"as he hasn't changelog for this date", title=batch_process_title)
+            self.calc_attendance_working_hours_breakdowns(attendance)
+        return self.get_penalty_engine().evaluate_employee(employee_id=employee_id, attendance_list=attendance_list,
+                                                           attendance_changelog_records=attendance_changelog_records)
+
+    def save_batch_metrics(self):
+        # merged into the metrics stored by the batch's other jobs and resumes, the batch row is locked meanwhile
+        if not self.running_batch_id or self.batch_metrics.is_empty():
+            return
+        stored_metrics = frappe.db.sql("""
+                                    SELECT phase_metrics FROM `tabLava Payroll LavaDo Batch`
+                                    WHERE name = %(batch_id)s FOR UPDATE
+                                    """, {'batch_id': self.running_batch_id})
+        batch_metrics = BatchMetrics.from_dict(json.loads(stored_metrics[0][0])) \
+            if stored_metrics and stored_metrics[0][0] else BatchMetrics()
+        batch_metrics.merge(self.batch_metrics)
+        frappe.db.set_value("Lava Payroll LavaDo Batch", self.running_batch_id, "phase_metrics",
+                            json.dumps(batch_metrics.to_dict(), sort_keys=True), update_modified=False)
+        frappe.db.commit()
+        self.batch_metrics = BatchMetrics()
+
+    def start_batch_profiler(self):
+        # the whole job is profiled, or only the processing of its first profile_employees employees
+        if self.profile_mode == "Off":
+            return
+        self.batch_profiler = BatchProfiler(mode=self.profile_mode)
+        self.batch_profiler.start()
+        if self.profile_employees:
+            self.batch_profiler.pause()
+
+    def save_batch_profile(self):
+        # attached to the batch as the profile file and its summary, one pair per job (main run or shard)
+        if not self.batch_profiler:
+            return
+        self.batch_profiler.stop()
+        file_extension, profile_content = self.batch_profiler.get_profile_file()
+        summary = self.batch_profiler.get_summary()
+        self.batch_profiler = None
+        if not self.running_batch_id:
+            add_action_log(action="Batch profile summary of a run without a batch", notes=summary)
+            return
+        file_name = f"{self.running_batch_id}-{frappe.scrub(self.profile_job_name)}-" \
+                    f"{now_datetime().strftime('%Y%m%d%H%M%S')}-profile"
+        for attachment_name, attachment_content in ((f"{file_name}.{file_extension}", profile_content),
+                                                    (f"{file_name}-summary.txt", summary.encode())):
+            frappe.get_doc({"doctype": "File", "file_name": attachment_name, "is_private": 1,
+                            "attached_to_doctype": "Lava Payroll LavaDo Batch",
+                            "attached_to_name": self.running_batch_id,
+                            "content": attachment_content}).insert(ignore_permissions=True)
+        frappe.db.commit()
+        add_action_log(action=f"Batch: {self.running_batch_id} {self.profile_mode.lower()} profile of "
+                              f"{self.profile_job_name} attached as {file_name}")
+
+    def get_high_water_marks(self) -> dict:
+        # the latest modified timestamp of every source doctype, the batch writes the attendance fields without
+        # updating modified and its own penalty records are automatic ones
+        high_water_marks = frappe.db.sql("""
+                        SELECT
+                            (SELECT MAX(modified) FROM `tabAttendance` WHERE company = %(company)s) AS attendance,
+                            (SELECT MAX(modified) FROM `tabLava Employee Payroll Changelog`
+                                WHERE company = %(company)s) AS changelog,
+                            (SELECT MAX(modified) FROM `tabLava Penalty Record` WHERE action_type = 'Manual')
+                                AS penalty_record
+                        """, {'company': self.running_batch_company}, as_dict=1)[0]
+        return {"Attendance": str(high_water_marks.attendance or ""),
+                "Lava Employee Payroll Changelog": str(high_water_marks.changelog or ""),
+                "Lava Penalty Record": str(high_water_marks.penalty_record or "")}
+
+    def get_incremental_base_batch(self, config_hash: str) -> tuple:
+        # (base batch, fallback reason): the last completed batch of the period, accepted only when it processed
+        # the whole company with the same configuration. The policies, shift types and settings have no
+        # high-water marks, and the employees outside a selected run's selection were never processed
+        base_batches = frappe.get_all("Lava Payroll LavaDo Batch",
+                                      filters={"company": self.running_batch_company,
+                                               "start_date": self.running_batch_start_date,
+                                               "end_date": self.running_batch_end_date,
+                                               "status": "Completed",
+                                               "high_water_marks": ["is", "set"]},
+                                      fields=["name", "config_hash", "full_company_run"],
+                                      order_by="creation desc", limit_page_length=1)
+        if not base_batches:
+            return None, "has no completed batch of the same period to run incrementally from"
+        base_batch = base_batches[0]
+        if not base_batch.full_company_run:
+            return None, f"can't run incrementally from {base_batch.name}, it was run for selected " \
+                         f"branches, shifts or employees"
+        if base_batch.config_hash != config_hash:
+            return None, f"can't run incrementally from {base_batch.name}, the configuration changed since " \
+                         f"(config hash {base_batch.config_hash} to {config_hash})"
+        return base_batch.name, None
+
+    def get_affected_attendance_dates(self, base_batch_id: str) -> AffectedAttendanceDates:
+        # the attendance dates changed after the base batch marks, with the dates of the following reset
+        # duration window whose penalties occurrence numbers may shift
+        high_water_marks = json.loads(frappe.db.get_value("Lava Payroll LavaDo Batch", base_batch_id,
+                                                          "high_water_marks"))
+        max_reset_duration = max([group.reset_duration or 0 for group in self.penalty_policy_groups] or [0])
+        affected_attendance_dates = AffectedAttendanceDates(downstream_days=max_reset_duration)
+        start_date, end_date = getdate(self.running_batch_start_date), getdate(self.running_batch_end_date)
+        dates_filters = {'company': self.running_batch_company,
+                         'start_date': start_date,
+                         'end_date': end_date,
+                         'history_start_date': start_date - datetime.timedelta(days=max_reset_duration)}
+
+        for row in frappe.db.sql("""
+                                SELECT employee, attendance_date FROM `tabAttendance`
+                                WHERE company = %(company)s AND modified > %(high_water_mark)s
+                                    AND attendance_date BETWEEN %(start_date)s AND %(end_date)s
+                                """, dict(dates_filters, high_water_mark=high_water_marks["Attendance"]), as_dict=1):
+            affected_attendance_dates.add_date(employee=row.employee, changed_date=row.attendance_date)
+
+        # a changelog record applies from its change date on
+        for row in frappe.db.sql("""
+                                SELECT employee, change_date FROM `tabLava Employee Payroll Changelog`
+                                WHERE company = %(company)s AND modified > %(high_water_mark)s
+                                    AND change_date <= %(end_date)s
+                                """, dict(dates_filters,
+                                          high_water_mark=high_water_marks["Lava Employee Payroll Changelog"]),
+                                 as_dict=1):
+            affected_attendance_dates.add_dates_range(employee=row.employee,
+                                                      from_date=max(row.change_date, start_date),
+                                                      to_date=end_date)
+
+        for row in frappe.db.sql("""
+                                SELECT pr.employee, pr.penalty_date
+                                FROM `tabLava Penalty Record` pr INNER JOIN `tabEmployee` e ON e.name = pr.employee
+                                WHERE e.company = %(company)s AND pr.action_type = 'Manual'
+                                    AND pr.modified > %(high_water_mark)s
+                                    AND pr.penalty_date BETWEEN %(history_start_date)s AND %(end_date)s
+                                """, dict(dates_filters, high_water_mark=high_water_marks["Lava Penalty Record"]),
+                                 as_dict=1):
+            affected_attendance_dates.add_date(employee=row.employee, changed_date=row.penalty_date)
+
+        add_action_log(action=f"Batch: {self.running_batch_id} runs incrementally from batch {base_batch_id}, "
+                              f"{len(affected_attendance_dates.get_employees())} affected employees")
+        return affected_attendance_dates
+
+    def enqueue_batch_shards(self, batch_options):
+        # the coordinator only splits the employees; every shard reports back through its
+        # "Batch Shard" object and the last finished shard updates the batch status
+        frappe.db.delete("Lava Batch Object", {"batch_id": self.running_batch_id, "object_type": "Batch Shard"})
+        employee_ids = self.get_batch_employees()
+        BatchProgress(batch_id=self.running_batch_id).start(employees_number=len(employee_ids))
+        shards_number = min(self.batch_shards, len(employee_ids))
+        if not shards_number:
+            add_action_log(action=f"Batch: {self.running_batch_id} has no employees to process")
+            PayrollLavaDoManager.update_last_running_batch_in_progress(
+                batch_new_status="Completed", batch_id=self.running_batch_id)
+            return
+
+        shards = []
+        for shard_index in range(shards_number):
+            shard_employee_ids = employee_ids[shard_index::shards_number]
+            shard_doc = self.create_batch_object_record(batch_id=self.running_batch_id,
+                                                        object_type="Batch Shard",
+                                                        object_id=f"{self.running_batch_id}-{shard_index + 1}",
+                                                        status="In progress",
+                                                        notes=f"{len(shard_employee_ids)} employees")
+            shards.append((shard_doc.name, shard_employee_ids))
+        frappe.db.commit()
+
+        for shard_name, shard_employee_ids in shards:
+            frappe.enqueue(method='payroll_lavado.payroll_batch.run_payroll_batch_shard',
+                           queue="long", timeout=36000000,
+                           batch_id=self.running_batch_id, shard_name=shard_name,
+                           employee_ids=shard_employee_ids,
+                           company=self.running_batch_company, start_date=self.running_batch_start_date,
+                           end_date=self.running_batch_end_date, batch_options=batch_options,
+                           employees_dates_ranges=self.affected_attendance_dates.get_employees_dates_ranges(
+                               shard_employee_ids) if self.affected_attendance_dates else None)
+        add_action_log(
+            action=f"Batch: {self.running_batch_id} enqueued {shards_number} shards "
+                   f"for {len(employee_ids)} employees")
+
+    def process_batch_shard(self, batch_id: str, shard_name: str, employee_ids: list,
+                            company: str, start_date: date, end_date: date, batch_options,
+                            employees_dates_ranges: dict = None):
+        self.set_batch_options(company=company, start_date=start_date, end_date=end_date,
+                               batch_options=batch_options)
+        self.running_batch_id = batch_id
+        self.profile_job_name = shard_name
+        self.start_batch_profiler()
+        if employees_dates_ranges is not None:
+            self.affected_attendance_dates = AffectedAttendanceDates(employees_dates_ranges=employees_dates_ranges)
+        shard_status = "Completed"
+        try:
+            self.apply_batch_config_snapshot(self.load_batch_config_snapshot(batch_id=batch_id))
+            self.process_employees(employee_ids=employee_ids)
+        except Exception as ex:
+            shard_status = "Failed"
+            frappe.db.rollback()
+            frappe.log_error(message=f"processing shard {shard_name} of batch {batch_id}. "
+                                     f"Error: '{format_exception(ex)}'", title=batch_process_title)
+        frappe.db.set_value("Lava Batch Object", shard_name, "status", shard_status)
+        frappe.db.commit()
+        add_action_log(action=f"Batch: {batch_id} shard {shard_name} finished with status {shard_status}")
+        PayrollLavaDoManager.complete_batch_if_shards_finished(batch_id=batch_id)
+
+    @staticmethod
+    def complete_batch_if_shards_finished(batch_id: str):
+        # lock the batch row, so only one of the concurrently finishing shards updates the status
+        batch_status = frappe.db.sql("""
+                                    SELECT status FROM `tabLava Payroll LavaDo Batch`
+                                    WHERE name = %(batch_id)s FOR UPDATE
+                                    """, {'batch_id': batch_id}, as_dict=1)
+        if not batch_status or batch_status[0].status != "In Progress":
+            return
+        if frappe.db.exists("Lava Batch Object", {"batch_id": batch_id,
+                                                  "object_type": "Batch Shard",
+                                                  "status": "In progress"}):
+            return
+
+        batch_new_status = "Completed"
+        if frappe.db.exists("Lava Batch Object", {"batch_id": batch_id,
+                                                  "object_type": "Batch Shard",
+                                                  "status": "Failed"}):
+            batch_new_status = "Incomplete"
+        add_action_log(action=f"Batch: {batch_id} all shards finished and will update the status")
+        PayrollLavaDoManager.update_last_running_batch_in_progress(batch_new_status=batch_new_status,
+                                                                   batch_id=batch_id)
+        frappe.db.commit()
+        frappe.publish_realtime('msgprint', f'Ending batch {batch_id}...')
+
     def delete_failed_processed_employees_records(self, batch_id):
-        batch_failed_processed_employees = self.get_batch_failed_processed_employees(batch_id)
-        for failed_processed_employee in batch_failed_processed_employees:
-            self.delete_employee_batch_records(employee_id=failed_processed_employee.name, batch_id=batch_id)
-            add_action_log(
-                action=f"Batch: {batch_id} for Company: {self.running_batch_company} removed the records of"
-                       " employee {failed_processed_employee}")
+        rollback_summary = BatchRollback(batch_id=batch_id).run()
+        add_action_log(
+            action=f"Batch: {batch_id} for Company: {self.running_batch_company} removed the records of "
+                   f"{rollback_summary['employees']} failed employees: {rollback_summary['objects']}")
+        if rollback_summary['left_behind']:
+            add_action_log(action=f"Batch: {batch_id} records left behind after removing the failed employees "
+                                  f"records: {rollback_summary['left_behind']}", level="Warning")
 
     def run_auto_attendance_process(self):
         add_action_log(
@@ -374,44 +728,6 @@ class PayrollLavaDoManager:
                         message=f"Auto attendance of Shift Type: '{shift_type.name}' "
                                 f"Error message: '{format_exception(ex)}'", title=batch_process_title)
 
-    def get_batch_failed_processed_employees(self, batch_id):
-        return frappe.get_all('Lava Batch Object',
-                              filters={"batch_id": batch_id,
-                                       "object_type": 'Employee',
-                                       "status": ["in", ["Failed", "In progress"]]}
-                              )
-
-    def delete_employee_batch_records(self, employee_id: str, batch_id: str):
-        batch_related_doctypes = ["Timesheet", "Lava Penalty Record", "Additional Salary"]
-        limit_page_start = 0
-        limit_page_length = 100
-        while True:
-            employee_batch_records = frappe.get_all("Lava Batch Object",
-                                                    {'object_type': ['in', batch_related_doctypes],
-                                                     'batch_id': batch_id, 'parent': employee_id,
-                                                     'parenttype': 'Employee'},
-                                                    ['object_type', 'object_id'], limit_start=limit_page_start,
-                                                    limit_page_length=limit_page_length)
-            if not employee_batch_records:
-                break
-
-            limit_page_start += limit_page_length
-            for record in employee_batch_records:
-                frappe.delete_doc(doctype=record.object_type, name=record.object_id, force=1)
-
-            frappe.db.sql(f"""
-                           delete from `tabLava Batch Object` where object_type = 'Employee' 
-                           and parent = %(employee_id)s and batch_id = %(batch_id)s
-                           """, {'employee_id': employee_id,
-                                 'batch_id': batch_id})
-            frappe.db.sql(f"""
-                           delete from `tabLava Batch Object` where parenttype= 'Employee' 
-                           and object_id = %(employee_id)s and batch_id = %(batch_id)s
-                           """, {'employee_id': employee_id,
-                                 'batch_id': batch_id})
-
-            frappe.db.commit()
-
     def validate_shift_types(self, check_shift_types):
         invalid_shift_types = []
         for shift_type in check_shift_types:
@@ -426,9 +742,108 @@ class PayrollLavaDoManager:
             exp_msg = f"Shift types ({invalid_shift_types_ids}) have missing data"
             frappe.log_error(message=f"Error message: '{exp_msg}'", title=batch_process_title)
 
-    def process_employees(self):
+    def process_employees(self, employee_ids: list = None):
+        self.batch_progress = BatchProgress(batch_id=self.running_batch_id)
+        if employee_ids is None:
+            # a shard's employees are counted by the coordinator
+            employee_ids = self.get_batch_employees()
+            self.batch_progress.start(employees_number=len(employee_ids))
+
+        self.batch_object_writer = BatchObjectWriter(batch_id=self.running_batch_id)
+        self.attendance_fields_writer = AttendanceFieldsWriter()
+        self.uncommitted_employees = 0
+        get_action_log_writer().auto_flush = False
+        try:
+            for chunk_start in range(0, len(employee_ids), self.employees_chunk_size):
+                employees_chunk = employee_ids[chunk_start:chunk_start + self.employees_chunk_size]
+                self.process_employees_chunk(employees_chunk=employees_chunk)
+        finally:
+            get_action_log_writer().auto_flush = True
+            self.attendance_fields_writer.flush()
+            self.batch_object_writer.flush()
+            self.batch_progress.publish(force=True)
+        add_action_log(action=f"Attendance computed fields: {self.attendance_fields_writer.updated_records_number} "
+                              f"updated, {self.attendance_fields_writer.unchanged_records_number} unchanged "
+                              f"into batch : {self.running_batch_id}")
+
+    def commit_batch_work(self):
+        with self.batch_metrics.span("commit"):
+            self.attendance_fields_writer.flush()
+            self.batch_object_writer.flush()
+            get_action_log_writer().flush_if_due()
+            frappe.db.commit()
+        self.uncommitted_employees = 0
+
+    def commit_employee_work(self):
+        # every employee runs inside a savepoint, the commit policy only decides how often the processed
+        # employees get committed
+        self.uncommitted_employees += 1
+        if self.commit_policy == "Per Employee" or self.uncommitted_employees >= self.commit_every_employees:
+            self.commit_batch_work()
+
+    def process_employees_chunk(self, employees_chunk: list):
+        # the employees are flagged "In progress" before processing any of them, so an interrupted chunk is
+        # resumed as failed employees
+        for employee_id in employees_chunk:
+            self.batch_object_writer.add(object_type="Employee", object_id=employee_id, status="In progress")
+        self.commit_batch_work()
+
+        with self.batch_metrics.span("attendance load"):
+            attendance_rows = self.get_employees_attendance_rows(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+            employees_attendance_lists = self.get_employees_attendance_lists(employee_ids=employees_chunk,
+                                                                             attendance_rows=attendance_rows)
+            employees_changelog_index = self.get_employees_changelog_index(employee_ids=employees_chunk,
+                                                                           max_date=self.running_batch_end_date)
+            self.penalty_occurrence_window = self.get_employees_penalty_occurrence_window(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+            self.penalty_record_index = self.get_employees_penalty_record_index(
+                employee_ids=employees_chunk, start_date=self.running_batch_start_date,
+                end_date=self.running_batch_end_date)
+        if self.vectorized_breakdowns:
+            with self.batch_metrics.span("breakdown calculation"):
+                # computed from the query result columns, the attendance rows keep their index in the result
+                self.attendance_breakdowns = AttendanceBreakdowns(
+                    columns=get_query_columns(attendance_query_fields, attendance_rows),
+                    shift_type_cache=self.shift_type_cache)
+                self.log_flagged_attendance(attendance_rows=attendance_rows)
+        if self.affected_attendance_dates is not None:
+            employees_attendance_lists = {
+                employee_id: [attendance for attendance in attendance_list
+                              if self.affected_attendance_dates.is_affected(employee=employee_id,
+                                                                            attendance_date=attendance.attendance_date)]
+                for employee_id, attendance_list in employees_attendance_lists.items()}
+        for employee_id in employees_chunk:
+            if self.affected_attendance_dates is not None and not employees_attendance_lists.get(employee_id):
+                # nothing changed on the employee's attendance dates
+                self.batch_object_writer.set_status(object_type="Employee", object_id=employee_id,
+                                                    status="Completed")
+                self.batch_progress.add_employee()
+                continue
+            self.process_employee(employee_id=employee_id,
+                                  attendance_list=employees_attendance_lists.get(employee_id, []),
+                                  employees_changelog_index=employees_changelog_index)
+            self.commit_employee_work()
+        self.commit_batch_work()
+
+    def log_flagged_attendance(self, attendance_rows):
+        # the chunk's attendance failing the breakdown validations, flagged up front from the vectorized masks;
+        # their employees still fail when the attendance is processed
+        name_index = attendance_query_fields.index("name")
+        for error, flagged_rows in (("zero late check-in", self.attendance_breakdowns.zero_entry_rows),
+                                    ("zero early check-out", self.attendance_breakdowns.zero_exit_rows),
+                                    ("negative time diff", self.attendance_breakdowns.negative_rows)):
+            if flagged_rows:
+                add_action_log(action=f"{error} in the attendance: "
+                                      f"{', '.join(attendance_rows[row][name_index] for row in flagged_rows)} "
+                                      f"for company: {self.running_batch_company} "
+                                      f"into batch : {self.running_batch_id}",
+                               level="Warning")
+
+    def get_batch_employees(self) -> list:
         # TODO: enhance saving batch's options, in initiation process, to use these options in case of the batch resume
-        # TODO: enhance the performance by considering paging
         query_str = f""" 
                         SELECT distinct
                             emp.name AS employee_id 
@@ -464,96 +879,122 @@ class PayrollLavaDoManager:
                                    'batch_id': self.running_batch_id
                                    },
                                   as_dict=1)
+        if self.affected_attendance_dates is not None:
+            affected_employees = set(self.affected_attendance_dates.get_employees())
+            return [employee.employee_id for employee in employees if employee.employee_id in affected_employees]
+        return [employee.employee_id for employee in employees]
 
-        for employee in employees:
-            self.process_employee(employee_id=employee.employee_id)
-
-    def process_employee(self, employee_id):
-        employee_batch_object_doc = self.create_batch_object_record(batch_id=self.running_batch_id,
-                                                                    object_type="Employee",
-                                                                    object_id=employee_id, status="In progress",
-                                                                    notes="")
+    def process_employee(self, employee_id, attendance_list: list, employees_changelog_index: EmployeeChangelogIndex):
         add_action_log(
             action=f"Start process employee: {employee_id} "
                    f"for company: {self.running_batch_company} "
-                   f"into batch : {self.running_batch_id}")
+                   f"into batch : {self.running_batch_id}",
+            level="Debug")
+        frappe.db.savepoint(self.employee_savepoint)
+        self.batch_metrics.start_employee(employee_id)
+        profile_employee = self.batch_profiler and self.profiled_employees < self.profile_employees
+        if profile_employee:
+            self.profiled_employees += 1
+            self.batch_profiler.resume()
+        self.employee_penalties_deductions = {}
+        employee_penalties = self.penalty_occurrence_window.get_employee_penalties(employee=employee_id)
+        employee_failed = False
         try:
-            attendance_list = self.get_attendance_list(employee_id, self.running_batch_start_date,
-                                                       self.running_batch_end_date)
             if not attendance_list:
-                employee_batch_object_doc.status = "Failed"
-                employee_batch_object_doc.save(ignore_permissions=True)
                 msg = f"no attendance records for employee: {employee_id} for company: {self.running_batch_company} " \
                       f"into batch : {self.running_batch_id}"
-                add_action_log(action=msg)
+                add_action_log(action=msg, level="Warning")
                 frappe.throw(msg=msg, title=batch_process_title)
 
-            employee_changelog_records = self.get_employee_changelog_records(max_date=self.running_batch_end_date,
-                                                                             employee_id=employee_id)
-            employee_timesheet = self.create_employee_timesheet(employee_id=employee_id,
-                                                                company=self.running_batch_company)
+            attendance_changelog_records = {
+                attendance.name: employees_changelog_index.get_employee_changelog_record(
+                    employee_id=employee_id, attendance_date=attendance.attendance_date)
+                for attendance in attendance_list}
+            timesheet_logs_builder = TimesheetLogsBuilder()
 
             for attendance in attendance_list:
-                attendance = self.process_employee_attendance(employee_id=employee_id, attendance=attendance,
-                                                              employee_changelog_records=employee_changelog_records,
-                                                              employee_timesheet=employee_timesheet)
+                attendance = self.process_employee_attendance(
+                    employee_id=employee_id, attendance=attendance,
+                    employee_changelog_record=attendance_changelog_records[attendance.name],
+                    timesheet_logs_builder=timesheet_logs_builder)
             try:
-                self.save_employee_timesheet(employee_id=employee_id, employee_timesheet=employee_timesheet)
+                # the overlaps with the logs of the employee's other timesheets are still found by the save
+                with self.batch_metrics.span("timesheet save"):
+                    self.save_employee_timesheet(employee_id=employee_id,
+                                                 timesheet_logs_builder=timesheet_logs_builder)
             except Exception as ex:
                 if "is overlapping with" in format_exception(ex):
                     frappe.log_error(message=f"saving timesheet. Error: '{str(ex)}'",
                                      title=batch_process_title)
 
-            self.add_batch_employee_penalties(employee_id=employee_id, attendance_list=attendance_list,
-                                              employee_changelog_records=employee_changelog_records)
+            with self.batch_metrics.span("penalty evaluation"):
+                self.add_batch_employee_penalties(employee_id=employee_id, attendance_list=attendance_list,
+                                                  attendance_changelog_records=attendance_changelog_records)
+            with self.batch_metrics.span("additional salary creation"):
+                self.add_employee_consolidated_additional_salaries(employee_id=employee_id)
 
-            employee_batch_object_doc.status = "Completed"
-            employee_batch_object_doc.save(ignore_permissions=True)
+            self.batch_object_writer.set_status(object_type="Employee", object_id=employee_id, status="Completed")
             add_action_log(
                 action=f"End process employee: {employee_id} "
                        f"for company: {self.running_batch_company} "
-                       f"into batch : {self.running_batch_id}")
+                       f"into batch : {self.running_batch_id}",
+                level="Debug")
         except Exception as ex:
+            # only this employee's writes are rolled back, the earlier employees of the transaction are kept
+            employee_failed = True
+            frappe.db.rollback(save_point=self.employee_savepoint)
+            self.batch_object_writer.discard_parent_records(parent_id=employee_id)
+            self.attendance_fields_writer.discard_parent_records(parent_id=employee_id)
+            self.penalty_occurrence_window.restore_employee_penalties(employee=employee_id,
+                                                                      employee_penalties=employee_penalties)
             frappe.log_error(message=f"processing employee {employee_id}. Error: '{format_exception(ex)}'",
                              title=batch_process_title)
-            employee_batch_object_doc.status = "Failed"
-            employee_batch_object_doc.save(ignore_permissions=True)
+            self.batch_object_writer.set_status(object_type="Employee", object_id=employee_id, status="Failed")
             add_action_log(
                 action=f"Failed processing employee: {employee_id} "
                        f"for company: {self.running_batch_company} "
-                       f"into batch : {self.running_batch_id}")
-
-    def add_batch_employee_penalties(self, employee_id, attendance_list, employee_changelog_records):
+                       f"into batch : {self.running_batch_id}",
+                level="Warning")
+        if profile_employee:
+            self.batch_profiler.pause()
+        self.batch_metrics.end_employee()
+        self.batch_progress.add_employee(failed=employee_failed, attendance_rows=len(attendance_list))
+
+    def add_batch_employee_penalties(self, employee_id, attendance_list, attendance_changelog_records: dict):
         add_action_log(
             action=f"Start adding penalties for employee: {employee_id} "
-                   f"for company: {self.running_batch_company} into batch : {self.running_batch_id}")
-        for attendance in attendance_list:
-            employee_changelog_record = self.get_employee_changelog_record(
-                attendance_date=attendance.attendance_date,
-                employee_change_log_records=employee_changelog_records)
-            employee_applied_policies = self.get_employee_applied_policies(
-                employee_designation=employee_changelog_record['designation'] if employee_changelog_record else "")
-            if employee_applied_policies:
-                self.add_batch_employee_attendance_penalties(employee_changelog_record, attendance,
-                                                             employee_applied_policies)
-
-    def process_employee_attendance(self, employee_id, attendance, employee_changelog_records, employee_timesheet):
-        employee_changelog_record = self.get_employee_changelog_record(
-            attendance_date=attendance.attendance_date,
-            employee_change_log_records=employee_changelog_records)
+                   f"for company: {self.running_batch_company} into batch : {self.running_batch_id}",
+            level="Debug")
+        penalty_engine = self.get_penalty_engine()
+        for penalty_decision in penalty_engine.evaluate_employee(
+                employee_id=employee_id, attendance_list=attendance_list,
+                attendance_changelog_records=attendance_changelog_records):
+            self.add_update_penalty_record(penalty_decision=penalty_decision, batch_id=self.running_batch_id)
+        for skipped_message in penalty_engine.skipped_messages:
+            frappe.log_error(message=skipped_message, title=batch_process_title)
+
+    def get_penalty_engine(self) -> PenaltyEngine:
+        return PenaltyEngine(penalty_policy_index=self.penalty_policy_index,
+                             penalty_occurrence_window=self.penalty_occurrence_window,
+                             day_working_hours=self.get_hr_settings_day_working_hours(),
+                             penalty_record_index=self.penalty_record_index)
+
+    def process_employee_attendance(self, employee_id, attendance, employee_changelog_record,
+                                    timesheet_logs_builder: TimesheetLogsBuilder):
         if not employee_changelog_record:
             exception_msg = f"Skipping {attendance.name} for the employee {attendance.employee} " \
                             f"as he hasn't changelog for this date"
             frappe.throw(msg=exception_msg, title=batch_process_title)
         try:
-            attendance = self.calc_attendance_working_hours_breakdowns(attendance)
+            with self.batch_metrics.span("breakdown calculation"):
+                attendance = self.calc_attendance_working_hours_breakdowns(attendance)
         except Exception as ex:
             frappe.throw(msg=f"calc_attendance_working_hours_breakdowns: Employee: {employee_id}, "
                              f"attendance ID: {attendance.name}; Error message: '{format_exception(ex)}'",
                          title=batch_process_title)
         try:
             if attendance.status.lower() != "absent":
-                self.add_timesheet_record(employee_timesheet=employee_timesheet,
+                self.add_timesheet_record(timesheet_logs_builder=timesheet_logs_builder,
                                           attendance=attendance,
                                           activity_type=self.payroll_activity_type)
             return attendance
@@ -561,17 +1002,31 @@ class PayrollLavaDoManager:
             frappe.throw(msg=f"add_timesheet_record: Employee: {employee_id}, attendance ID: {attendance.name}, "
                              f" Error message: '{format_exception(ex)}'", title=batch_process_title)
 
-    def save_employee_timesheet(self, employee_id, employee_timesheet):
+    def save_employee_timesheet(self, employee_id, timesheet_logs_builder: TimesheetLogsBuilder):
+        overlapping_time_logs = timesheet_logs_builder.get_overlapping_time_logs()
+        if overlapping_time_logs:
+            for attendance_name, overlapped_attendance_name in overlapping_time_logs:
+                add_action_log(action=f"Skipped the time log of attendance {attendance_name} for employee: "
+                                      f"{employee_id}, it is overlapping with attendance {overlapped_attendance_name}",
+                               level="Warning")
+            frappe.log_error(message=f"process employee: {employee_id}, save timesheet; overlapping time logs of "
+                                     f"the attendance: {', '.join(name for name, _ in overlapping_time_logs)}",
+                             title=batch_process_title)
+        time_logs = timesheet_logs_builder.get_time_logs(
+            skipped_attendance_names={attendance_name for attendance_name, _ in overlapping_time_logs})
+        if not time_logs:
+            return  # no need to save a timesheet without records
+
+        employee_timesheet = self.create_employee_timesheet(employee_id=employee_id,
+                                                            company=self.running_batch_company)
+        for time_log in time_logs:
+            employee_timesheet.append("time_logs", time_log)
         try:
-            if not hasattr(employee_timesheet, 'time_logs'):
-                return  # no need to save a timesheet without records
-
             employee_timesheet.save(ignore_permissions=True)
 
             # employee_timesheet.submit()
-            self.create_batch_object_record(batch_id=self.running_batch_id, object_type="Timesheet",
-                                            object_id=employee_timesheet.name,
-                                            status="Created", notes="", parent_id=employee_id)
+            self.batch_object_writer.add(object_type="Timesheet", object_id=employee_timesheet.name,
+                                         status="Created", parent_id=employee_id)
         except frappe.MandatoryError as mandatory_error_ex:
             if "time_logs" in str(mandatory_error_ex):  # no need to save timesheet without time_logs
                 frappe.log_error(message=f"process employee: {employee_id}, "
@@ -579,151 +1034,68 @@ class PayrollLavaDoManager:
                                          f"mandatory Error message: '{format_exception(mandatory_error_ex)}'",
                                  title=batch_process_title)
 
-    def add_batch_employee_attendance_penalties(self, employee_changelog_record, attendance, applied_policies):
-        existing_penalty_records = frappe.get_all("Lava Penalty Record",
-                                                  filters={"employee": employee_changelog_record.employee,
-                                                           "penalty_date": ['=', attendance.attendance_date]},
-                                                  fields=['*'],
-                                                  order_by='penalty_date', limit_page_length=100)
-        attendance = frappe.get_doc("Attendance", attendance.name)
-        for existing_penalty_record in existing_penalty_records:
-            policy = self.get_policy_by_id(existing_penalty_record.penalty_policy, policies=applied_policies)
-            if policy:
-                self.get_policy_and_add_penalty_record(
-                    employee_changelog_record=employee_changelog_record,
-                    attendance=attendance,
-                    policy_group_obj=self.get_policy_group_by_id(policy.penalty_group),
-                    policy_subgroup=policy.penalty_subgroup,
-                    applied_policies=applied_policies,
-                    policy_id=existing_penalty_record.penalty_policy,
-                    existing_penalty_record=existing_penalty_record)
-            else:
-                frappe.throw(msg=f"Cannot find policy '{existing_penalty_record.penalty_policy}' "
-                                 f"for penalty record '{existing_penalty_record.name}'",
-                             title=batch_process_title)
-        policy_subgroups = []
-        if attendance.status.lower() == "absent":
-            policy_subgroups.append("attendance absence")
-        if attendance.late_entry:
-            policy_subgroups.append("attendance check-in")
-        if attendance.early_exit:
-            policy_subgroups.append("attendance check-out")
-
-        for policy_subgroup in policy_subgroups:
-            policy_group_obj = self.get_policy_group_by_policy_subgroup(policy_sub_group_name=policy_subgroup,
-                                                                        policies=applied_policies)
-            if not policy_group_obj:
-                frappe.throw(msg=f"Cannot find policy group  for the auto generating penalties for attendance: "
-                                 f"'{attendance.name}'",
-                             title=batch_process_title)
-
-            self.get_policy_and_add_penalty_record(
-                employee_changelog_record=employee_changelog_record,
-                attendance=attendance,
-                policy_group_obj=policy_group_obj,
-                policy_subgroup=policy_subgroup,
-                applied_policies=applied_policies)
-
-    def get_policy_and_add_penalty_record(self, employee_changelog_record,
-                                          attendance,
-                                          policy_group_obj,
-                                          policy_subgroup,
-                                          applied_policies,
-                                          policy_id=None,
-                                          existing_penalty_record=None):
-        if not policy_group_obj:
-            frappe.log_error(message=f"error: passing no policy group to function get_policy_and_add_penalty_record. "
-                                     f"attendance: {attendance.name}, policy_subgroup: {policy_subgroup}",
-                             title=batch_process_title)
-            return None
-
-        gap_duration_in_minutes = 0
-        policy_group_id = None
-        occurred_policy = None
-
-        if policy_id:
-            occurred_policy = self.get_policy_by_id(policy_id=policy_id)
-            policy_group_id = occurred_policy.penalty_group
-            policy_subgroup = occurred_policy.policy_subgroup
-        elif policy_subgroup.lower() == "attendance check-in":
-            gap_duration_in_minutes = attendance.lava_entry_duration_difference
-            policy_group_obj = self.get_policy_group_by_policy_subgroup("attendance check-in", applied_policies)
-        elif policy_subgroup.lower() == "attendance check-out":
-            gap_duration_in_minutes = attendance.lava_exit_duration_difference
-            policy_group_obj = self.get_policy_group_by_policy_subgroup("attendance check-out", applied_policies)
-        elif policy_subgroup.lower() == "attendance absence":
-            policy_group_obj = self.get_policy_group_by_policy_subgroup("attendance absence", applied_policies)
-
-        if not policy_group_id:
-            policy_group_id = policy_group_obj.name
-
-        policy_occurrence_number = 1 + self.get_penalty_records_number_within_duration(
-            employee=employee_changelog_record.employee,
-            check_date=attendance.attendance_date,
-            duration_in_days=policy_group_obj.reset_duration,
-            policy_subgroup=policy_subgroup,
-            policy_group=policy_group_id)
-        if not occurred_policy:
-            occurred_policy = self.get_policy_by_filters(
-                policies=applied_policies,
-                group_name=policy_group_obj.name,
-                subgroup_name=policy_subgroup,
-                occurrence_number=policy_occurrence_number,
-                gap_duration_in_minutes=gap_duration_in_minutes)
-        if occurred_policy:
-            self.add_update_penalty_record(employee_changelog_record=employee_changelog_record,
-                                           batch_id=self.running_batch_id,
-                                           attendance=attendance,
-                                           policy=occurred_policy,
-                                           policy_occurrence_number=policy_occurrence_number,
-                                           existing_penalty_record=existing_penalty_record)
-        else:
-            frappe.throw(msg=f"get_policy_and_add_penalty_record. Error: unrecognized policy for "
-                             f"attendance '{attendance.name}', "
-                             f"employee_changelog_record: {employee_changelog_record.name}, "
-                             f"policy_occurrence_number: {policy_occurrence_number}",
-                         title=batch_process_title)
+    def get_employees_penalty_occurrence_window(self, employee_ids: list, start_date: date,
+                                                end_date: date) -> PenaltyOccurrenceWindow:
+        # the penalties history covering the longest reset duration before the batch start
+        max_reset_duration = max([group.reset_duration or 0 for group in self.penalty_policy_groups] or [0])
+        penalty_records = frappe.db.sql("""
+                                        SELECT pr.employee, pr.penalty_date, pr.policy_subgroup,
+                                            g.name AS penalty_group
+                                        FROM `tabLava Penalty Record` pr INNER JOIN `tabLava Penalty Policy` p
+                                            ON pr.penalty_policy = p.name
+                                        INNER JOIN `tabLava Penalty Group` g
+                                            ON p.penalty_group = g.name
+                                        WHERE
+                                            pr.occurrence_number >= 0
+                                            AND pr.employee IN %(employee_ids)s
+                                            AND pr.penalty_date >= %(from_date)s
+                                            AND pr.penalty_date <= %(to_date)s
+                                        """, {'employee_ids': tuple(employee_ids),
+                                              'from_date': start_date - datetime.timedelta(days=max_reset_duration),
+                                              'to_date': end_date}, as_dict=1)
+        return PenaltyOccurrenceWindow(penalty_records)
+
+    def get_employees_penalty_record_index(self, employee_ids: list, start_date: date,
+                                           end_date: date) -> PenaltyRecordIndex:
+        # a link to a deleted Additional Salary doesn't count as linked. The records are updated through their
+        # docs, only the columns read by the index and the penalty engine are selected
+        penalty_records = frappe.db.sql("""
+                                        SELECT pr.name, pr.employee, pr.penalty_date, pr.penalty_policy,
+                                            pr.occurrence_number, pr.action_type,
+                                            a.name AS linked_additional_salary
+                                        FROM `tabLava Penalty Record` pr LEFT JOIN `tabAdditional Salary` a
+                                            ON a.name = pr.additional_salary
+                                        WHERE
+                                            pr.employee IN %(employee_ids)s
+                                            AND pr.penalty_date >= %(from_date)s
+                                            AND pr.penalty_date <= %(to_date)s
+                                        ORDER BY pr.penalty_date, pr.creation
+                                        """, {'employee_ids': tuple(employee_ids), 'from_date': start_date,
+                                              'to_date': end_date}, as_dict=1)
+        return PenaltyRecordIndex(penalty_records)
+
+    def get_employees_attendance_rows(self, employee_ids: list, start_date: date, end_date: date) -> tuple:
+        # the query result tuples in the attendance_query_fields order
+        if not employee_ids:
+            return ()
+        return frappe.db.sql(f"""
+                            SELECT {attendance_query_columns}
+                            FROM `tabAttendance`
+                            WHERE employee IN %(employee_ids)s
+                                AND attendance_date BETWEEN %(start_date)s AND %(end_date)s
+                            ORDER BY employee ASC, attendance_date ASC
+                            """, {'employee_ids': tuple(employee_ids), 'start_date': start_date,
+                                  'end_date': end_date})
 
-    def get_penalty_records_number_within_duration(self, employee, check_date, duration_in_days, policy_subgroup,
-                                                   policy_group):
-        from_date = check_date - datetime.timedelta(days=duration_in_days)
-        penalty_records_number_within_duration = frappe.db.sql(
-            f"""SELECT COUNT(pr.name) AS 'records_number'
-            FROM `tabLava Penalty Record` pr INNER JOIN `tabLava Penalty Policy` p
-                ON pr.penalty_policy = p.name
-            INNER JOIN `tabLava Penalty Group` g
-                ON p.penalty_group = g.name and g.name = %(policy_group)s
-            WHERE
-                pr.occurrence_number >= 0 
-                AND LOWER(pr.policy_subgroup) = %(policy_subgroup)s
-                AND LOWER(pr.employee) = %(employee)s
-                AND pr.penalty_date >= %(from_date)s
-                AND pr.penalty_date <= %(to_date)s
-            """
-            , {'policy_subgroup': policy_subgroup.lower(),
-               'policy_group': policy_group.lower(),
-               'employee': employee,
-               'from_date': from_date,
-               'to_date': check_date}, as_dict=1)
-        result = penalty_records_number_within_duration[0].records_number
-        return result
-
-    def get_employee_applied_policies(self, employee_designation):
-        if not employee_designation:
-            frappe.throw(
-                "error: passing empty string of employee_designation to function get_employee_applied_policies")
-        applied_policies = []
-        for policy in self.penalty_policies:
-            for designation in policy['designations']:
-                if (designation['designation_name']).lower() == employee_designation.lower():
-                    applied_policies.append(policy)
-                    break
-        return applied_policies
-
-    def get_attendance_list(self, employee: str, start_date: date, end_date: date):
-        return frappe.get_all("Attendance", filters={'employee': employee,
-                                                     'attendance_date': ['between', (start_date, end_date)]},
-                              fields=['*'], order_by="attendance_date asc", limit_page_length=365)
+    @staticmethod
+    def get_employees_attendance_lists(employee_ids: list, attendance_rows: tuple) -> dict:
+        # every attendance keeps its row index in the query result, the vectorized breakdowns are read by it
+        employees_attendance_lists = {employee_id: [] for employee_id in employee_ids}
+        for attendance_row_index, attendance_row in enumerate(attendance_rows):
+            attendance = fdict(zip(attendance_query_fields, attendance_row))
+            attendance.attendance_row = attendance_row_index
+            employees_attendance_lists.setdefault(attendance.employee, []).append(attendance)
+        return employees_attendance_lists
 
     def create_employees_first_changelog_records(self, company: str):
         rows = frappe.db.sql("""
@@ -773,17 +1145,13 @@ class PayrollLavaDoManager:
                       "structure assignment and/or shift."
             frappe.log_error(message=f"Error message: '{exp_msg}'", title=batch_process_title)
 
-    def get_employee_changelog_records(self, max_date: date, employee_id: str):
-        employee_changelogs = frappe.get_all("Lava Employee Payroll Changelog",
-                                             filters={'employee': employee_id, 'change_date': ['<=', max_date]},
-                                             order_by="change_date desc", fields=['*'], limit_page_length=100)
-        return employee_changelogs
-
-    def get_employee_changelog_record(self, attendance_date: date, employee_change_log_records):
-        for record in employee_change_log_records:
-            if record['change_date'] <= attendance_date:
-                return record
-        return None
+    def get_employees_changelog_index(self, employee_ids: list, max_date: date) -> EmployeeChangelogIndex:
+        employees_changelogs = frappe.get_all("Lava Employee Payroll Changelog",
+                                              filters={'employee': ['in', employee_ids],
+                                                       'change_date': ['<=', max_date]},
+                                              order_by="employee asc, change_date asc, creation asc",
+                                              fields=changelog_fields)
+        return EmployeeChangelogIndex(employees_changelogs)
 
     def create_batch_object_record(self, batch_id, object_type, object_id, status=None, notes=None, parent_id=None):
         batch_object_record = frappe.new_doc("Lava Batch Object")
@@ -811,73 +1179,57 @@ class PayrollLavaDoManager:
         return timesheet
 
     def calc_attendance_working_hours_breakdowns(self, attendance):
-        attendance_doc = frappe.get_doc("Attendance", attendance.name)
-        if attendance_doc.shift:
+        if attendance.shift:
             shift_type = self.get_shift_type_by_id(attendance.shift)
-            if attendance_doc.status != 'Absent' and attendance_doc.status != 'On Leave' and attendance_doc.docstatus == 1:
-                if attendance_doc.late_entry:
-                    attendance_doc.lava_entry_duration_difference = int(time_diff_in_seconds(
-                        attendance_doc.in_time.strftime("%H:%M:%S"),
-                        str(shift_type.start_time)) / 60)
-                    if attendance_doc.lava_entry_duration_difference == 0:
-                        frappe.throw(msg=f"attendance_working_hours_breakdowns: "
-                                         f"zero late check-in of attendance: {attendance.name}"
-                                     , title=batch_process_title)
-                if attendance_doc.early_exit:
-                    attendance_doc.lava_exit_duration_difference = int(time_diff_in_seconds(
-                        str(shift_type.end_time),
-                        attendance_doc.out_time.strftime("%H:%M:%S")) / 60)
-                    if attendance_doc.lava_exit_duration_difference == 0:
-                        frappe.throw(msg=f"calc_attendance_working_hours_breakdowns: "
-                                         f"zero early check-out of attendance: {attendance.name}"
-                                     , title=batch_process_title)
-                if attendance_doc.lava_entry_duration_difference < 0 \
-                        or attendance_doc.lava_exit_duration_difference < 0:
-                    frappe.throw(title=batch_process_title,
-                                 msg=f"Negative time diff in attendance {attendance_doc.name}")
-            shift_time_diff = time_diff_in_seconds(str(shift_type.end_time),
-                                                   str(shift_type.start_time)) / 60
-            if shift_time_diff >= 0:
-                attendance_doc.lava_planned_working_hours = time_diff_in_hours(shift_type.end_time,
-                                                                               shift_type.start_time)
-            else:
-                attendance_doc.lava_planned_working_hours = time_diff_in_hours(
-                    str(to_timedelta("23:59:59")),
-                    str(shift_type.start_time))
-                attendance_doc.lava_planned_working_hours += time_diff_in_hours(
-                    str(shift_type.end_time),
-                    str(to_timedelta("00:00:00")))
-            attendance_doc.save(ignore_permissions=True)
-            frappe.db.commit()
-            return attendance_doc
-        elif not attendance_doc.shift and attendance_doc.status == "On Leave":
-            return attendance_doc
+            if not shift_type:
+                frappe.throw(msg=f"calc_attendance_working_hours_breakdowns: "
+                                 f"shift type '{attendance.shift}' of attendance: {attendance.name} "
+                                 f"is not loaded or has no start/end time"
+                             , title=batch_process_title)
+            breakdown = self.attendance_breakdowns.get_breakdown(attendance.attendance_row) \
+                if self.attendance_breakdowns else None
+            if not breakdown:
+                breakdown = calc_attendance_breakdown(attendance, shift_type)
+            entry_duration_difference, exit_duration_difference, planned_working_hours, error = breakdown
+            if error == "zero-entry":
+                frappe.throw(msg=f"attendance_working_hours_breakdowns: "
+                                 f"zero late check-in of attendance: {attendance.name}"
+                             , title=batch_process_title)
+            if error == "zero-exit":
+                frappe.throw(msg=f"calc_attendance_working_hours_breakdowns: "
+                                 f"zero early check-out of attendance: {attendance.name}"
+                             , title=batch_process_title)
+            if error == "negative":
+                frappe.throw(title=batch_process_title,
+                             msg=f"Negative time diff in attendance {attendance.name}")
+            attendance_values = {"lava_entry_duration_difference": entry_duration_difference,
+                                 "lava_exit_duration_difference": exit_duration_difference,
+                                 "lava_planned_working_hours": planned_working_hours}
+            if self.attendance_fields_writer:
+                self.attendance_fields_writer.add(attendance=attendance, values=attendance_values,
+                                                  parent_id=attendance.employee)
+            attendance.update(attendance_values)
+            return attendance
+        elif not attendance.shift and attendance.status == "On Leave":
+            return attendance
         else:
             frappe.throw(msg=f"calc_attendance_working_hours_breakdowns: "
                              f"unrecognized shift type of attendance: {attendance.name}"
                          , title=batch_process_title)
 
     def get_hr_settings_day_working_hours(self):
-        doc = frappe.get_single("HR Settings")
-        return doc.standard_working_hours
+        return self.batch_config.standard_working_hours
 
-    def add_timesheet_record(self, employee_timesheet, attendance, activity_type):
+    def add_timesheet_record(self, timesheet_logs_builder: TimesheetLogsBuilder, attendance, activity_type):
         if attendance.working_hours == 0:
             return
-        frappe.db.delete("Timesheet Detail", filters={
-            "parenttype": "Timesheet",
-            "parentfield": "time_logs",
-            "parent": employee_timesheet.name,
-            "activity_type": activity_type,
-            "from_time": attendance.in_time
-        })
         working_hours = 0
         if attendance.status == "Half Day":
             working_hours = 0.5 * self.get_hr_settings_day_working_hours()
         else:
             working_hours = attendance.working_hours
 
-        employee_timesheet.append("time_logs", {
+        timesheet_logs_builder.add(attendance_name=attendance.name, time_log={
             "activity_type": activity_type,
             "hours": working_hours,
             "expected_hours": attendance.lava_planned_working_hours,
@@ -886,84 +1238,69 @@ class PayrollLavaDoManager:
             "description": "Created by Payroll LavaDo Batch Process"
         })
 
-    def add_update_penalty_record(self, employee_changelog_record, batch_id,
-                                  attendance, policy,
-                                  policy_occurrence_number,
-                                  existing_penalty_record):
-        if not policy:
-            frappe.throw(msg=f"add_update_penalty_record: invalid inputs "
-                             f"employee_changelog_record: {employee_changelog_record.name}", title=batch_process_title)
-        if existing_penalty_record:
-            existing_penalty_record = frappe.get_doc("Lava Penalty Record", existing_penalty_record.name)
-        penalty_record = existing_penalty_record
-        if not penalty_record:
-            penalty_record = frappe.new_doc("Lava Penalty Record")
-
-        deduction_in_days_amount = employee_changelog_record.hourly_rate * policy['deduction_factor'] * \
-                                   self.get_hr_settings_day_working_hours()
-        deduction_absolute_amount = policy.get('deduction_amount', 0)
-        deduction_times_time_gap = 0
-        deduction_factor = policy['deduction_factor']
-        if policy['policy_subgroup'] == "attendance check-in":
-            deduction_times_time_gap = (attendance.lava_entry_duration_difference / 60) * \
-                                       employee_changelog_record.hourly_rate * deduction_factor
-        elif policy['policy_subgroup'] == "attendance check-out":
-            deduction_times_time_gap = (attendance.lava_exit_duration_difference / 60) * \
-                                       employee_changelog_record.hourly_rate * deduction_factor
-
-        deductions = [deduction_absolute_amount, deduction_in_days_amount, deduction_times_time_gap]
-        applied_penalty_deduction_amount: float = 0
-        if policy['deduction_rule'] == "biggest":
-            applied_penalty_deduction_amount = max(deductions)
-        elif policy['deduction_rule'] == "smallest":
-            applied_penalty_deduction_amount = min(deductions)
-        elif policy['deduction_rule'] == "absolute amount":
-            applied_penalty_deduction_amount = deduction_absolute_amount
-        elif policy['deduction_rule'] == "deduction in days":
-            applied_penalty_deduction_amount = deduction_in_days_amount
-        elif policy['deduction_rule'] == "times time gap":
-            applied_penalty_deduction_amount = deduction_times_time_gap
+    def add_update_penalty_record(self, penalty_decision: dict, batch_id):
+        if penalty_decision['action'] == "Duplicate":
+            return  # the existing automatic record of the date has its own additional salary
+        if penalty_decision['action'] == "Update":
+            penalty_record = frappe.get_doc("Lava Penalty Record", penalty_decision['existing_penalty_record'])
         else:
-            exp_msg = f"add_penalty_record: Unknown deduction rule. subgroup '{policy['policy_subgroup']}' " \
-                      f"of this deduction rule '{policy.deduction_rule}'" \
-                      f" for attendance date {attendance.attendance_date} " \
-                      f"for employee {employee_changelog_record.employee}"
-            frappe.throw(msg=exp_msg, title=batch_process_title)
-
-        penalty_record.occurrence_number = policy_occurrence_number
-        penalty_record.penalty_amount = applied_penalty_deduction_amount
-        if not existing_penalty_record:
-            penalty_record.employee = employee_changelog_record.employee
-            penalty_record.penalty_policy = policy['policy_name']
-            penalty_record.policy_subgroup = policy['policy_subgroup']
-            penalty_record.penalty_date = attendance.attendance_date
+            penalty_record = frappe.new_doc("Lava Penalty Record")
+            penalty_record.employee = penalty_decision['employee']
+            penalty_record.penalty_policy = penalty_decision['penalty_policy']
+            penalty_record.policy_subgroup = penalty_decision['policy_subgroup']
+            penalty_record.penalty_date = penalty_decision['penalty_date']
             penalty_record.action_type = "Automatic"
             penalty_record.notes = ""
             penalty_record.lava_payroll_batch = batch_id
-
-        if not existing_penalty_record and not frappe.db.exists(
-                "Lava Penalty Record",
-                {"action_type": "Automatic",
-                 "penalty_date": attendance.attendance_date,
-                 "penalty_policy": policy['policy_name'],
-                 "employee": attendance.employee}):
-            penalty_record.save(ignore_permissions=True)
-            self.create_batch_object_record(batch_id=batch_id, object_type="Lava Penalty Record",
-                                            object_id=penalty_record.name,
-                                            status="Created", notes="", parent_id=employee_changelog_record.employee)
-        elif existing_penalty_record:
-            penalty_record.save(ignore_permissions=True)
-
-        frappe.db.commit()
-
-        if applied_penalty_deduction_amount > 0:
-            self.add_additional_salary(penalty_record, batch_id)
+        penalty_record.occurrence_number = penalty_decision['occurrence_number']
+        penalty_record.penalty_amount = penalty_decision['penalty_amount']
+        penalty_record.save(ignore_permissions=True)
+        if penalty_decision['action'] == "Create":
+            self.batch_object_writer.add(object_type="Lava Penalty Record", object_id=penalty_record.name,
+                                         status="Created", parent_id=penalty_decision['employee'])
+
+        if penalty_decision['penalty_amount'] > 0:
+            if self.additional_salary_mode == "Consolidated":
+                self.add_consolidated_penalty_deduction(penalty_record, penalty_decision['salary_component'])
+            else:
+                with self.batch_metrics.span("additional salary creation"):
+                    self.add_additional_salary(penalty_record, batch_id)
+
+    def add_consolidated_penalty_deduction(self, penalty_record, salary_component: str):
+        if self.penalty_record_index.is_linked_to_additional_salary(penalty_record.name):
+            return  # already deducted by an earlier additional salary
+        self.employee_penalties_deductions.setdefault(salary_component, []).append(
+            (penalty_record.name, penalty_record.penalty_amount))
+
+    def add_employee_consolidated_additional_salaries(self, employee_id):
+        # one additional salary per salary component for the batch period, the summed penalty records link to it
+        for salary_component, penalties_deductions in self.employee_penalties_deductions.items():
+            penalty_record_names = [penalty_record_name for penalty_record_name, _ in penalties_deductions]
+            additional_salary_record = frappe.new_doc("Additional Salary")
+            additional_salary_record.employee = employee_id
+            additional_salary_record.payroll_date = self.running_batch_end_date
+            additional_salary_record.overwrite_salary_structure_amount = 0
+            additional_salary_record.amount = sum(amount for _, amount in penalties_deductions)
+            additional_salary_record.salary_component = salary_component
+            additional_salary_record.reason = f"Apply policies: {len(penalty_record_names)} penalties " \
+                                              f"from {self.running_batch_start_date} " \
+                                              f"to {self.running_batch_end_date}, " \
+                                              f"batch ref.: {self.running_batch_id}"
+            additional_salary_record.save(ignore_permissions=True)
+            frappe.db.sql("""
+                        UPDATE `tabLava Penalty Record` SET additional_salary = %(additional_salary)s
+                        WHERE name IN %(penalty_record_names)s
+                        """, {'additional_salary': additional_salary_record.name,
+                              'penalty_record_names': tuple(penalty_record_names)})
+            for penalty_record_name in penalty_record_names:
+                self.penalty_record_index.add_additional_salary_link(penalty_record_name)
+            self.batch_object_writer.add(object_type="Additional Salary", object_id=additional_salary_record.name,
+                                         status="Created", notes=f"{len(penalty_record_names)} penalty records",
+                                         parent_id=employee_id)
+        self.employee_penalties_deductions = {}
 
     def add_additional_salary(self, penalty_record, batch_id):
-        if frappe.db.exists("Additional Salary", {"employee": penalty_record.employee,
-                                                  "payroll_date": penalty_record.penalty_date,
-                                                  "reason": ["like",
-                                                             f"%Apply policy: {penalty_record.penalty_policy}%"]}):
+        if self.penalty_record_index.is_linked_to_additional_salary(penalty_record.name):
             return  # no need to create salary addition for the already created record of the same penalty
 
         additional_salary_record = frappe.new_doc("Additional Salary")
@@ -979,9 +1316,10 @@ class PayrollLavaDoManager:
                                           f" and penalty ref.: {penalty_record.name}"
         additional_salary_record.save(ignore_permissions=True)
         # additional_salary_record.submit()
-        self.create_batch_object_record(batch_id=batch_id, object_type="Additional Salary",
-                                        object_id=additional_salary_record.name,
-                                        status="Created", notes="", parent_id=penalty_record.employee)
+        penalty_record.db_set("additional_salary", additional_salary_record.name, update_modified=False)
+        self.penalty_record_index.add_additional_salary_link(penalty_record.name)
+        self.batch_object_writer.add(object_type="Additional Salary", object_id=additional_salary_record.name,
+                                     status="Created", parent_id=penalty_record.employee)
 
     @staticmethod
     def parse_batch_options(doc: str):
@@ -997,7 +1335,18 @@ class PayrollLavaDoManager:
             "action_type": doc_dict['action_type'],
             "branches": doc_dict['branches'],
             "shifts": doc_dict['shifts'],
-            "employees": doc_dict['employees']
+            "employees": doc_dict['employees'],
+            "batch-shards": doc_dict.get('batch-shards') or 1,
+            "biometric-workers": doc_dict.get('biometric-workers') or 1,
+            "action-log-level": doc_dict.get('action-log-level') or "Info",
+            "commit-policy": doc_dict.get('commit-policy') or "Per Employee",
+            "commit-every": doc_dict.get('commit-every') or 50,
+            "chk-vectorized-breakdowns": doc_dict.get('chk-vectorized-breakdowns') or 0,
+            "additional-salary-mode": doc_dict.get('additional-salary-mode') or "Per Penalty",
+            "chk-incremental-run": doc_dict.get('chk-incremental-run') or 0,
+            "chk-dry-run": doc_dict.get('chk-dry-run') or 0,
+            "profile-mode": doc_dict.get('profile-mode') or "Off",
+            "profile-employees": doc_dict.get('profile-employees') or 0
         }
 
 
@@ -1027,10 +1376,36 @@ def run_payroll_lavado_batch(doc: str):
 
 def run_payroll_batch_process(company: str, start_date: date, end_date: date, batch_options):
     payroll_lavado_manager = PayrollLavaDoManager()
-    payroll_lavado_manager.create_resume_batch_process(company=company,
-                                                       start_date=start_date,
-                                                       end_date=end_date,
-                                                       batch_options=batch_options)
+    try:
+        with payroll_lavado_manager.batch_metrics.count_queries(frappe.db):
+            payroll_lavado_manager.create_resume_batch_process(company=company,
+                                                               start_date=start_date,
+                                                               end_date=end_date,
+                                                               batch_options=batch_options)
+    except Exception:
+        # keep the buffered action log lines of the failed job, the job's own changes are rolled back
+        frappe.db.rollback()
+        raise
+    finally:
+        payroll_lavado_manager.save_batch_metrics()
+        payroll_lavado_manager.save_batch_profile()
+        flush_action_logs()
+
+
+def run_payroll_batch_shard(batch_id: str, shard_name: str, employee_ids: list, company: str, start_date: date,
+                            end_date: date, batch_options, employees_dates_ranges: dict = None):
+    payroll_lavado_manager = PayrollLavaDoManager()
+    try:
+        with payroll_lavado_manager.batch_metrics.count_queries(frappe.db):
+            payroll_lavado_manager.process_batch_shard(batch_id=batch_id, shard_name=shard_name,
+                                                       employee_ids=employee_ids, company=company,
+                                                       start_date=start_date, end_date=end_date,
+                                                       batch_options=batch_options,
+                                                       employees_dates_ranges=employees_dates_ranges)
+    finally:
+        payroll_lavado_manager.save_batch_metrics()
+        payroll_lavado_manager.save_batch_profile()
+        flush_action_logs()
 
 
 def format_exception(ex: Exception) -> str:
@@ -1040,13 +1415,13 @@ def format_exception(ex: Exception) -> str:
     return f'{error}\n{trace}'
 
 
-def add_action_log(action: str, action_type: str = "LOG", notes: str = None):
-    new_doc = frappe.new_doc("Lava Action Log")
-    new_doc.action = action
-    new_doc.action_type = action_type
-    new_doc.notes = notes
-    new_doc.insert(ignore_permissions=True)
-    # new_doc.commit
+def add_action_log(action: str, action_type: str = "LOG", notes: str = None, level: str = "Info"):
+    get_action_log_writer().add(action=action, action_type=action_type, notes=notes, level=level)
+
+
+def flush_action_logs():
+    get_action_log_writer().flush()
+    frappe.db.commit()
 
 
 def get_changes(doctype_name: str, doc_old_version, doc_new_version):
@@ -40,6 +40,9 @@ MyPage = Class.extend({
 
         $('#btn-refresh').click(function(){
             get_batches();
+        });
+        frappe.realtime.on("lavado_batch_progress", function(progress){
+            render_batch_progress(progress);
         });
 		$('#btn-run-batch').click(function(){
 		    let action_type = "New Batch";
@@ -77,6 +80,17 @@ function get_validate_inputs(batch_id, action_type){
     let chk_auto_attendance = (($("#chk-auto-attendance").is(":checked"))? 1 : 0);
     let chk_biometric_process = (($("#chk-biometric-process").is(":checked"))? 1 : 0);
     let chk_batch_objects = (($("#chk-batch-objects").is(":checked"))? 1 : 0);
+    let chk_incremental_run = (($("#chk-incremental-run").is(":checked"))? 1 : 0);
+    let chk_dry_run = (($("#chk-dry-run").is(":checked"))? 1 : 0);
+    let chk_vectorized_breakdowns = (($("#chk-vectorized-breakdowns").is(":checked"))? 1 : 0);
+    let batch_shards = parseInt($("#txt-batch-shards").val()) || 1;
+    let biometric_workers = parseInt($("#txt-biometric-workers").val()) || 1;
+    let action_log_level = $("#select-action-log-level").val();
+    let commit_policy = $("#select-commit-policy").val();
+    let additional_salary_mode = $("#select-additional-salary-mode").val();
+    let commit_every = parseInt($("#txt-commit-every").val()) || 50;
+    let profile_mode = $("#select-profile-mode").val();
+    let profile_employees = parseInt($("#txt-profile-employees").val()) || 0;
     let error_msg = "";
     if (action_type == "New Batch"){
         if (isNaN(batch_end_date) || isNaN(batch_start_date)){
@@ -87,6 +101,22 @@ function get_validate_inputs(batch_id, action_type){
         }
     }
 
+    if (batch_shards < 1){
+        error_msg += ", parallel shards must be >= 1";
+    }
+
+    if (biometric_workers < 1){
+        error_msg += ", biometric workers must be >= 1";
+    }
+
+    if (commit_every < 1){
+        error_msg += ", commit every must be >= 1";
+    }
+
+    if (profile_employees < 0){
+        error_msg += ", profiled employees must be >= 0";
+    }
+
     if (error_msg.length >0){
         frappe.msgprint(__("error message: " + error_msg));
         return;
@@ -104,6 +134,17 @@ function get_validate_inputs(batch_id, action_type){
         "chk-batch-objects": chk_batch_objects,
         "chk-auto-attendance": chk_auto_attendance,
         "chk-biometric-process": chk_biometric_process,
+        "chk-vectorized-breakdowns": chk_vectorized_breakdowns,
+        "chk-incremental-run": chk_incremental_run,
+        "chk-dry-run": chk_dry_run,
+        "batch-shards": batch_shards,
+        "biometric-workers": biometric_workers,
+        "action-log-level": action_log_level,
+        "commit-policy": commit_policy,
+        "commit-every": commit_every,
+        "additional-salary-mode": additional_salary_mode,
+        "profile-mode": profile_mode,
+        "profile-employees": profile_employees,
         "batch_id": batch_id,
         "action_type": action_type
     }
@@ -159,6 +200,62 @@ function get_batches(batch_company){
         })
 }
 
+function show_batch_metrics(batch_id){
+    frappe.call({
+            method:
+                "payroll_lavado.payroll_lavado.page.lavado_batch_admin_page.lavado_batch_admin_page.get_payroll_lavado_batch_metrics",
+            args: {
+                batch_id: batch_id,
+            },
+            callback: function (r) {
+            if (r.message.message == "Success") {
+                render_batch_metrics(batch_id, r.message.result);
+            } else {
+                frappe.throw(__(r.message.message));
+            }
+            }
+        })
+}
+
+function render_batch_metrics(batch_id, summary){
+    if (!summary.phases){
+        frappe.msgprint(__(`No metrics stored for batch ${batch_id}`));
+        return;
+    }
+    let html = `<p>${summary.employees} employees, per employee p50: ${summary.employee_p50}s, `
+        + `p95: ${summary.employee_p95}s, max: ${summary.employee_max}s</p>`;
+    html += '<table><tr><th>Phase</th><th>Seconds</th><th>Queries</th><th>Rows written</th><th>Calls</th>'
+        + '<th>Employee p50</th><th>Employee p95</th><th>Employee max</th></tr>';
+    for (let phase of summary.phases){
+        html += `<tr><td>${phase.phase}</td><td>${phase.seconds}</td><td>${phase.queries}</td>`
+            + `<td>${phase.rows_written}</td><td>${phase.calls}</td><td>${phase.employee_p50 ?? ""}</td>`
+            + `<td>${phase.employee_p95 ?? ""}</td><td>${phase.employee_max ?? ""}</td></tr>`;
+    }
+    html += '</table><p>Slowest employees</p><table>';
+    for (let [employee_id, seconds] of summary.slowest_employees){
+        html += `<tr><td>${employee_id}</td><td>${seconds}s</td></tr>`;
+    }
+    html += '</table>';
+    frappe.msgprint({title: __(`Batch ${batch_id} metrics`), message: html, wide: true});
+}
+
+function render_batch_progress(progress){
+    let eta = (progress.eta_seconds == null)? "-" : format_duration(progress.eta_seconds);
+    $("#div-batch-progress").html(
+        `Batch ${progress.batch_id}: ${progress.done} done, ${progress.failed} failed, `
+        + `${progress.remaining} remaining of ${progress.total} employees, `
+        + `${progress.employees_per_second} employees/s, ${progress.rows_per_second} attendance rows/s, ETA ${eta}`);
+    if (progress.remaining == 0){
+        get_batches($("#select-company :selected").text());
+    }
+}
+
+function format_duration(seconds){
+    let hours = Math.floor(seconds / 3600);
+    let minutes = Math.floor((seconds % 3600) / 60);
+    return (hours? hours + "h " : "") + minutes + "m " + (seconds % 60) + "s";
+}
+
 function get_employees_by_filters(){
     $("#select-employee").empty();
     let batch_company = $("#select-company :selected").text();
@@ -274,10 +371,13 @@ function render_batches_data(records){
        $(`#tr${rowIndex}`).append(`<td>${record.status}</td>`);
        $(`#tr${rowIndex}`).append(`<td>${record.batch_process_start_time}</td>`);
        $(`#tr${rowIndex}`).append(`<td>${record.batch_process_end_time}</td>`);
+       $(`#tr${rowIndex}`).append(`<td>${record.slowest_phase}</td>`);
+       $(`#tr${rowIndex}`).append(`<td>${record.slowest_employees}</td>`);
+       let buttons_tag = '<td><button onclick="show_batch_metrics(batch_id=`'+ record.batch_id +  '`)">Metrics</button>'
        if (record.status != "Completed"){
-           let button_tag = '<td><button onclick="process_batch_action(action_type=`Resume Batch`, batch_id=`'+ record.batch_id +  '`)">Resume</button></td>'
-           $(`#tr${rowIndex}`).append($(button_tag));
+           buttons_tag += '<button onclick="process_batch_action(action_type=`Resume Batch`, batch_id=`'+ record.batch_id +  '`)">Resume</button>'
        }
+       $(`#tr${rowIndex}`).append($(buttons_tag + '</td>'));
        rowIndex += 1;
     }
 }
\ No newline at end of file
@@ -2,6 +2,8 @@ import json
 
 import frappe
 
+from payroll_lavado.batch_metrics import BatchMetrics
+
 
 @frappe.whitelist()
 def get_branches_by_company(filters: str = None):
@@ -94,15 +96,44 @@ def get_payroll_lavado_batches(filters: str = None):
                                     select name as 'batch_id',
                                     company, start_date, end_Date , status,
                                     batch_process_start_time,
-                                    batch_process_end_time
+                                    batch_process_end_time,
+                                    phase_metrics
                                     from `tabLava Payroll LavaDo Batch`
                                     where company = %(company)s
                                     order by name desc, start_date desc,
                                     modified desc
                                     LIMIT 50
                                 """, {'company': filters_dict['company']}, as_dict=1)
+        for batch in result:
+            batch.update(get_batch_metrics_columns(batch.pop('phase_metrics')))
         message = "Success"
     except Exception as ex:
         message = "During getting the batches, Error occurred: '{}'".format(str(ex))
     finally:
         return {'result': result, 'message': message}
+
+
+def get_batch_metrics_columns(phase_metrics: str) -> dict:
+    # the slowest phase and the slowest employees of a batch, as short texts for the batches table
+    if not phase_metrics:
+        return {'slowest_phase': "", 'slowest_employees': ""}
+    summary = BatchMetrics.from_dict(json.loads(phase_metrics)).get_summary()
+    slowest_phase = summary['phases'][0] if summary['phases'] else None
+    return {'slowest_phase': f"{slowest_phase['phase']}: {slowest_phase['seconds']}s, "
+                             f"{slowest_phase['queries']} queries" if slowest_phase else "",
+            'slowest_employees': ", ".join(f"{employee_id} {seconds}s"
+                                           for employee_id, seconds in summary['slowest_employees'][:3])}
+
+
+@frappe.whitelist()
+def get_payroll_lavado_batch_metrics(batch_id: str = None):
+    result = {}
+    message = ""
+    try:
+        phase_metrics = frappe.db.get_value("Lava Payroll LavaDo Batch", batch_id, "phase_metrics")
+        result = BatchMetrics.from_dict(json.loads(phase_metrics)).get_summary() if phase_metrics else {}
+        message = "Success"
+    except Exception as ex:
+        message = "During getting the batch metrics, Error occurred: '{}'".format(str(ex))
+    finally:
+        return {'result': result, 'message': message}
@@ -1,7 +1,14 @@
+import datetime
+
 import frappe
 from erpnext.setup.doctype.employee.employee import Employee
-from payroll_lavado.employee_change_log import create_employee_change_log
+from payroll_lavado.employee_change_log import queue_employee_change_log
 
 
 def employee_create_employee_change_log(doc: Employee, method):
-    create_employee_change_log(employee_id=doc.name, source_doctype=doc.doctype, source_id=doc.name)
+    employee_old_doc = doc.get_doc_before_save()
+    if employee_old_doc and employee_old_doc.designation == doc.designation and \
+            employee_old_doc.company == doc.company and employee_old_doc.branch == doc.branch:
+        return
+    queue_employee_change_log(employee_id=doc.name, source_doctype=doc.doctype, source_id=doc.name,
+                              change_date=datetime.date.today())
@@ -1,8 +1,7 @@
 import frappe
 from hrms.payroll.doctype.salary_structure_assignment.salary_structure_assignment import SalaryStructureAssignment
-from payroll_lavado.employee_change_log import create_employee_change_log
+from payroll_lavado.employee_change_log import queue_employee_change_log
 
 
 def salary_structure_assignment_create_employee_change_log(doc: SalaryStructureAssignment, method):
-    employee_id = frappe.db.get_value("Employee", doc.employee)
-    create_employee_change_log(employee_id=employee_id, source_doctype=doc.doctype, source_id=doc.name)
+    queue_employee_change_log(employee_id=doc.employee, source_doctype=doc.doctype, source_id=doc.name)
@@ -0,0 +1,177 @@
+import datetime
+
+from payroll_lavado.batch_indexes import PenaltyPolicyIndex, PenaltyOccurrenceWindow, PenaltyRecordIndex
+
+deduction_rules: tuple = ("biggest", "smallest", "absolute amount", "deduction in days", "times time gap")
+
+
+def calc_penalty_deduction_amount(policy, hourly_rate: float, day_working_hours: float,
+                                  entry_duration_difference, exit_duration_difference) -> float:
+    # the policy's deduction rule applied to its absolute amount, its deduction in days and its time gap amounts
+    deduction_factor = policy['deduction_factor']
+    deduction_in_days_amount = hourly_rate * deduction_factor * day_working_hours
+    deduction_absolute_amount = policy.get('deduction_amount', 0)
+    deduction_times_time_gap = 0
+    if policy['policy_subgroup'] == "attendance check-in":
+        deduction_times_time_gap = (entry_duration_difference / 60) * hourly_rate * deduction_factor
+    elif policy['policy_subgroup'] == "attendance check-out":
+        deduction_times_time_gap = (exit_duration_difference / 60) * hourly_rate * deduction_factor
+
+    deductions = [deduction_absolute_amount, deduction_in_days_amount, deduction_times_time_gap]
+    if policy['deduction_rule'] == "biggest":
+        return max(deductions)
+    if policy['deduction_rule'] == "smallest":
+        return min(deductions)
+    if policy['deduction_rule'] == "absolute amount":
+        return deduction_absolute_amount
+    if policy['deduction_rule'] == "deduction in days":
+        return deduction_in_days_amount
+    if policy['deduction_rule'] == "times time gap":
+        return deduction_times_time_gap
+    raise ValueError(f"Unknown deduction rule '{policy['deduction_rule']}' of the policy '{policy['policy_name']}' "
+                     f"subgroup '{policy['policy_subgroup']}'")
+
+
+def get_attendance_policy_subgroups(attendance) -> list:
+    policy_subgroups = []
+    if attendance['status'].lower() == "absent":
+        policy_subgroups.append("attendance absence")
+    if attendance['late_entry']:
+        policy_subgroups.append("attendance check-in")
+    if attendance['early_exit']:
+        policy_subgroups.append("attendance check-out")
+    return policy_subgroups
+
+
+class PenaltyEngine:
+    # the penalties of the attendance records computed from plain records, without reading or writing the
+    # database: the policies come from the index, the occurrence numbers from the penalties window and the
+    # existing penalty records of the dates from the record index. Every decision updates the window and the
+    # index the same way the saved penalty record would, the caller saves the decisions or only reports them
+    def __init__(self, penalty_policy_index: PenaltyPolicyIndex, penalty_occurrence_window: PenaltyOccurrenceWindow,
+                 day_working_hours: float, penalty_record_index: PenaltyRecordIndex = None):
+        self.penalty_policy_index = penalty_policy_index
+        self.penalty_occurrence_window = penalty_occurrence_window
+        self.day_working_hours = day_working_hours
+        self.penalty_record_index = penalty_record_index or PenaltyRecordIndex([])
+        self.skipped_messages = []
+
+    def evaluate_employee(self, employee_id: str, attendance_list: list, attendance_changelog_records: dict) -> list:
+        decisions = []
+        for attendance in attendance_list:
+            changelog_record = attendance_changelog_records[attendance['name']]
+            designation = changelog_record['designation'] if changelog_record else ""
+            if not designation:
+                raise ValueError(f"no designation for the employee {employee_id} on the attendance "
+                                 f"'{attendance['name']}'")
+            if self.penalty_policy_index.get_designation_policies(designation):
+                decisions.extend(self.evaluate_attendance(changelog_record=changelog_record, attendance=attendance,
+                                                          designation=designation))
+        return decisions
+
+    def evaluate_attendance(self, changelog_record, attendance, designation: str) -> list:
+        decisions = []
+        for existing_penalty_record in self.penalty_record_index.get_date_penalty_records(
+                employee=changelog_record['employee'], penalty_date=attendance['attendance_date']):
+            policy = self.penalty_policy_index.get_designation_policy(
+                designation=designation, policy_name=existing_penalty_record['penalty_policy'])
+            if not policy:
+                raise ValueError(f"Cannot find policy '{existing_penalty_record['penalty_policy']}' "
+                                 f"for penalty record '{existing_penalty_record['name']}'")
+            decision = self.evaluate_existing_penalty(changelog_record=changelog_record, attendance=attendance,
+                                                      existing_penalty_record=existing_penalty_record)
+            if decision:
+                decisions.append(decision)
+
+        for policy_subgroup in get_attendance_policy_subgroups(attendance):
+            policy_group = self.penalty_policy_index.get_designation_subgroup_group(designation=designation,
+                                                                                    subgroup_name=policy_subgroup)
+            if not policy_group:
+                raise ValueError(f"Cannot find policy group  for the auto generating penalties for attendance: "
+                                 f"'{attendance['name']}'")
+            decisions.append(self.evaluate_new_penalty(changelog_record=changelog_record, attendance=attendance,
+                                                       policy_group=policy_group, policy_subgroup=policy_subgroup,
+                                                       designation=designation))
+        return decisions
+
+    def get_occurrence_number(self, employee: str, check_date, policy_group, policy_subgroup: str) -> int:
+        from_date = check_date - datetime.timedelta(days=policy_group['reset_duration'])
+        return 1 + self.penalty_occurrence_window.count_penalties(employee=employee,
+                                                                  policy_group=policy_group['name'],
+                                                                  policy_subgroup=policy_subgroup,
+                                                                  from_date=from_date, to_date=check_date)
+
+    def evaluate_existing_penalty(self, changelog_record, attendance, existing_penalty_record) -> dict:
+        policy = self.penalty_policy_index.get_policy(existing_penalty_record['penalty_policy'])
+        policy_group = self.penalty_policy_index.get_group(policy['penalty_group'])
+        if not policy_group:
+            self.skipped_messages.append(f"no policy group '{policy['penalty_group']}' for the penalty record "
+                                         f"'{existing_penalty_record['name']}' of attendance: {attendance['name']}")
+            return None
+        occurrence_number = self.get_occurrence_number(employee=changelog_record['employee'],
+                                                       check_date=attendance['attendance_date'],
+                                                       policy_group=policy_group,
+                                                       policy_subgroup=policy['policy_subgroup'])
+        decision = self.make_decision(changelog_record=changelog_record, attendance=attendance, policy=policy,
+                                      occurrence_number=occurrence_number, action="Update",
+                                      existing_penalty_record=existing_penalty_record)
+        # a negative occurrence number excludes the record from the occurrences count till it gets updated
+        if (existing_penalty_record['occurrence_number'] or 0) < 0:
+            self.add_penalty(decision)
+        return decision
+
+    def evaluate_new_penalty(self, changelog_record, attendance, policy_group, policy_subgroup: str,
+                             designation: str) -> dict:
+        gap_duration_in_minutes = 0
+        if policy_subgroup == "attendance check-in":
+            gap_duration_in_minutes = attendance['lava_entry_duration_difference']
+        elif policy_subgroup == "attendance check-out":
+            gap_duration_in_minutes = attendance['lava_exit_duration_difference']
+        occurrence_number = self.get_occurrence_number(employee=changelog_record['employee'],
+                                                       check_date=attendance['attendance_date'],
+                                                       policy_group=policy_group, policy_subgroup=policy_subgroup)
+        policy = self.penalty_policy_index.find_policy(designation=designation, group_name=policy_group['name'],
+                                                       subgroup_name=policy_subgroup,
+                                                       occurrence_number=occurrence_number,
+                                                       gap_duration_in_minutes=gap_duration_in_minutes)
+        if not policy:
+            raise ValueError(f"unrecognized policy for attendance '{attendance['name']}', "
+                             f"employee_changelog_record: {changelog_record['name']}, "
+                             f"policy_occurrence_number: {occurrence_number}")
+        # an automatic record of the same policy already exists on the date, it was updated with the existing ones
+        if self.penalty_record_index.has_automatic_penalty(employee=attendance['employee'],
+                                                           penalty_date=attendance['attendance_date'],
+                                                           penalty_policy=policy['policy_name']):
+            return self.make_decision(changelog_record=changelog_record, attendance=attendance, policy=policy,
+                                      occurrence_number=occurrence_number, action="Duplicate")
+        decision = self.make_decision(changelog_record=changelog_record, attendance=attendance, policy=policy,
+                                      occurrence_number=occurrence_number, action="Create")
+        self.penalty_record_index.add_automatic_penalty(employee=attendance['employee'],
+                                                        penalty_date=attendance['attendance_date'],
+                                                        penalty_policy=policy['policy_name'])
+        self.add_penalty(decision)
+        return decision
+
+    def make_decision(self, changelog_record, attendance, policy, occurrence_number: int, action: str,
+                      existing_penalty_record=None) -> dict:
+        return {"action": action,
+                "employee": changelog_record['employee'],
+                "attendance": attendance['name'],
+                "penalty_date": attendance['attendance_date'],
+                "penalty_policy": policy['policy_name'],
+                "penalty_group": policy['penalty_group'],
+                "policy_subgroup": policy['policy_subgroup'],
+                "salary_component": policy['salary_component'],
+                "occurrence_number": occurrence_number,
+                "penalty_amount": calc_penalty_deduction_amount(
+                    policy=policy, hourly_rate=changelog_record['hourly_rate'],
+                    day_working_hours=self.day_working_hours,
+                    entry_duration_difference=attendance['lava_entry_duration_difference'],
+                    exit_duration_difference=attendance['lava_exit_duration_difference']),
+                "existing_penalty_record": existing_penalty_record['name'] if existing_penalty_record else None}
+
+    def add_penalty(self, decision: dict):
+        self.penalty_occurrence_window.add_penalty(employee=decision['employee'],
+                                                   policy_group=decision['penalty_group'],
+                                                   policy_subgroup=decision['policy_subgroup'],
+                                                   penalty_date=decision['penalty_date'])
@@ -0,0 +1,87 @@
+"""
+Penalty groups and policies in the shape of PayrollLavaDoManager.get_penalty_policy_groups and get_penalty_policies,
+ordered like the policies query, with the baseline linear lookups the batch indexes replaced.
+"""
+import random
+
+tolerance_subgroups: tuple = ("attendance check-in", "attendance check-out")
+
+penalty_policy_groups: list = [
+    {"name": "Late Entry", "title": "Late Entry", "reset_duration": 30, "deduction_rule": "Biggest"},
+    {"name": "Early Exit", "title": "Early Exit", "reset_duration": 7, "deduction_rule": "Smallest"},
+    {"name": "Absence", "title": "Absence", "reset_duration": 10, "deduction_rule": "Deduction in days"},
+    # a group without policies
+    {"name": "Overtime", "title": "Overtime", "reset_duration": 30, "deduction_rule": "Absolute Amount"},
+]
+groups_subgroups: dict = {"Late Entry": "attendance check-in", "Early Exit": "attendance check-out",
+                          "Absence": "attendance absence"}
+
+
+def make_penalty_policies(seed: int, designations: list, full_designations: list = ()) -> list:
+    # random tolerance tiers and occurrence ladders per group, the full designations get every policy so their
+    # lookups always find one at the first occurrence and no tolerance
+    randomizer = random.Random(seed)
+    groups = {group["name"]: group for group in penalty_policy_groups}
+    penalty_policies = []
+    for group_name, subgroup in groups_subgroups.items():
+        tolerances = sorted({0, *randomizer.sample([15, 30, 60], randomizer.randint(0, 3))}) \
+            if subgroup in tolerance_subgroups else [0]
+        for tolerance_duration in tolerances:
+            for occurrence_number in range(1, randomizer.randint(1, 4) + 1):
+                policy_designations = set(full_designations) | {
+                    designation for designation in designations if randomizer.random() < 0.6}
+                penalty_policies.append({
+                    "policy_name": f"{group_name} T{tolerance_duration} O{occurrence_number}",
+                    "policy_title": f"{group_name} T{tolerance_duration} O{occurrence_number}",
+                    "penalty_group": group_name.lower(),
+                    "deduction_rule": groups[group_name]["deduction_rule"].lower(),
+                    "reset_duration": groups[group_name]["reset_duration"],
+                    "occurrence_number": occurrence_number,
+                    "policy_subgroup": subgroup,
+                    "deduction_factor": 0.25 * occurrence_number,
+                    "deduction_amount": 10 * occurrence_number + tolerance_duration,
+                    "tolerance_duration": tolerance_duration,
+                    "salary_component": "Penalty",
+                    "designations": [{"designation_name": designation}
+                                     for designation in sorted(policy_designations)]})
+    # the policies query order
+    return sorted(penalty_policies, key=lambda policy: (policy["penalty_group"], policy["policy_subgroup"],
+                                                        -policy["tolerance_duration"],
+                                                        -policy["occurrence_number"], policy["policy_name"]))
+
+
+def get_baseline_applied_policies(penalty_policies: list, designation: str) -> list:
+    return [policy for policy in penalty_policies
+            if any(policy_designation['designation_name'].lower() == designation.lower()
+                   for policy_designation in policy['designations'])]
+
+
+def get_baseline_group(group_name: str):
+    for group in penalty_policy_groups:
+        if group['name'].lower() == group_name.lower():
+            return group
+    return None
+
+
+def get_baseline_subgroup_group(subgroup_name: str, applied_policies: list):
+    for policy in applied_policies:
+        if policy['policy_subgroup'].lower() == subgroup_name.lower():
+            group = get_baseline_group(policy['penalty_group'])
+            if group:
+                return group
+    return None
+
+
+def get_baseline_policy_by_filters(applied_policies: list, group_name: str, subgroup_name: str,
+                                   occurrence_number: int, gap_duration_in_minutes):
+    # the first matching policy in the (tolerance_duration desc, occurrence_number desc) order
+    for policy in applied_policies:
+        if policy['penalty_group'].lower() == group_name.lower() and \
+                policy['policy_subgroup'].lower() == subgroup_name.lower() and \
+                policy['occurrence_number'] <= occurrence_number:
+            if policy['policy_subgroup'].lower() in tolerance_subgroups:
+                if policy['tolerance_duration'] <= gap_duration_in_minutes:
+                    return policy
+            else:
+                return policy
+    return None
@@ -0,0 +1,84 @@
+import datetime
+import pickle
+import unittest
+
+from payroll_lavado.batch_config import BatchConfigSnapshot
+from payroll_lavado.tests.penalty_policies import make_penalty_policies, penalty_policy_groups
+from payroll_lavado.working_hours import ShiftTypeCache
+
+shift_types: list = [
+    {"name": "Morning", "start_time": datetime.timedelta(hours=8), "end_time": datetime.timedelta(hours=16)},
+    {"name": "Night", "start_time": datetime.timedelta(hours=22, minutes=30), "end_time": datetime.timedelta(hours=6)},
+]
+
+
+def make_batch_config(**changes) -> BatchConfigSnapshot:
+    config = {"penalty_policy_groups": penalty_policy_groups,
+              "penalty_policies": make_penalty_policies(seed=1, designations=["Driver", "Engineer"]),
+              "shift_types": shift_types, "payroll_activity_type": "Payroll", "standard_working_hours": 8}
+    config.update(changes)
+    return BatchConfigSnapshot(**config)
+
+
+class TestBatchConfigSnapshot(unittest.TestCase):
+    def test_same_configuration_same_hash(self):
+        batch_config = make_batch_config()
+        self.assertEqual(make_batch_config().config_hash, batch_config.config_hash)
+        # the records' keys order doesn't change the canonical json
+        reordered_groups = [dict(reversed(list(group.items()))) for group in penalty_policy_groups]
+        self.assertEqual(make_batch_config(penalty_policy_groups=reordered_groups).config_hash,
+                         batch_config.config_hash)
+        self.assertEqual(make_batch_config(), batch_config)
+
+    def test_changed_configuration_changes_hash(self):
+        config_hash = make_batch_config().config_hash
+        penalty_policies = make_penalty_policies(seed=1, designations=["Driver", "Engineer"])
+        penalty_policies[0] = dict(penalty_policies[0], deduction_amount=penalty_policies[0]["deduction_amount"] + 1)
+        self.assertNotEqual(make_batch_config(penalty_policies=penalty_policies).config_hash, config_hash)
+        self.assertNotEqual(make_batch_config(shift_types=shift_types[:1]).config_hash, config_hash)
+        self.assertNotEqual(make_batch_config(standard_working_hours=7.5).config_hash, config_hash)
+
+    def test_json_and_pickle_round_trips(self):
+        batch_config = make_batch_config()
+        for restored_batch_config in (BatchConfigSnapshot.from_json(batch_config.to_json()),
+                                      pickle.loads(pickle.dumps(batch_config))):
+            self.assertEqual(restored_batch_config.config_hash, batch_config.config_hash)
+            self.assertEqual(restored_batch_config.penalty_policies, batch_config.penalty_policies)
+
+    def test_records_match_the_live_configuration(self):
+        # the batch computes from the snapshot records what it computed from the live records
+        penalty_policies = make_penalty_policies(seed=1, designations=["Driver", "Engineer"])
+        batch_config = make_batch_config(penalty_policies=penalty_policies)
+        self.assertEqual(len(batch_config.penalty_policies), len(penalty_policies))
+        for snapshot_policy, policy in zip(batch_config.penalty_policies, penalty_policies):
+            self.assertEqual(snapshot_policy.policy_name, policy["policy_name"])
+            self.assertEqual(snapshot_policy["occurrence_number"], policy["occurrence_number"])
+            self.assertEqual([designation.designation_name for designation in snapshot_policy.designations],
+                             [designation["designation_name"] for designation in policy["designations"]])
+        self.assertEqual(batch_config.shift_types[1].start_time, "22:30:00")
+        live_shift_type_cache = ShiftTypeCache(shift_types)
+        snapshot_shift_type_cache = ShiftTypeCache(batch_config.shift_types)
+        for shift_type in shift_types:
+            snapshot_shift_type = snapshot_shift_type_cache.get_shift_type(shift_type["name"])
+            live_shift_type = live_shift_type_cache.get_shift_type(shift_type["name"])
+            self.assertEqual((snapshot_shift_type.start_seconds, snapshot_shift_type.end_seconds,
+                              snapshot_shift_type.planned_working_hours),
+                             (live_shift_type.start_seconds, live_shift_type.end_seconds,
+                              live_shift_type.planned_working_hours))
+        self.assertEqual(batch_config.standard_working_hours, 8)
+
+    def test_read_only(self):
+        batch_config = make_batch_config()
+        with self.assertRaises(TypeError):
+            batch_config.config_hash = "changed"
+        with self.assertRaises(TypeError):
+            batch_config.penalty_policies[0]["deduction_amount"] = 0
+        with self.assertRaises(TypeError):
+            batch_config.penalty_policies[0].update(deduction_amount=0)
+        with self.assertRaises(AttributeError):
+            batch_config.penalty_policies[0].designations.append({"designation_name": "Designer"})
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            BatchConfigSnapshot(penalty_policy_groups=[], penalty_policies=[], shift_types=[],
+                                payroll_activity_type="Payroll", standard_working_hours=8, version=2)
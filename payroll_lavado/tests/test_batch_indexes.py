@@ -0,0 +1,353 @@
+import datetime
+import random
+import unittest
+
+from payroll_lavado.batch_indexes import EmployeeChangelogIndex, PenaltyPolicyIndex, PenaltyPolicyLadder, \
+    PenaltyOccurrenceWindow, PenaltyRecordIndex, AffectedAttendanceDates
+from payroll_lavado.tests.penalty_policies import get_baseline_applied_policies, get_baseline_policy_by_filters, \
+    get_baseline_subgroup_group, groups_subgroups, make_penalty_policies, penalty_policy_groups
+
+first_date = datetime.date(2024, 1, 1)
+
+
+def get_baseline_changelog_record(attendance_date, employee_changelog_records: list):
+    # the per attendance scan of the employee's changelog records ordered by change_date desc
+    for record in sorted(employee_changelog_records, key=lambda changelog: changelog['change_date'], reverse=True):
+        if record['change_date'] <= attendance_date:
+            return record
+    return None
+
+
+class TestEmployeeChangelogIndex(unittest.TestCase):
+    def test_matches_the_changelog_scan(self):
+        randomizer = random.Random(3)
+        employees_changelog_records = {}
+        for employee_number in range(20):
+            employee_id = f"HR-EMP-{employee_number:05d}"
+            change_dates = randomizer.sample(range(-30, 60), randomizer.randint(0, 5))
+            employees_changelog_records[employee_id] = [
+                {"name": f"{employee_id}-{change_day}", "employee": employee_id,
+                 "change_date": first_date + datetime.timedelta(days=change_day)} for change_day in change_dates]
+        changelog_records = [record for records in employees_changelog_records.values() for record in records]
+        randomizer.shuffle(changelog_records)
+        changelog_index = EmployeeChangelogIndex(changelog_records)
+
+        for employee_id, employee_changelog_records in employees_changelog_records.items():
+            for day in range(-40, 70):
+                attendance_date = first_date + datetime.timedelta(days=day)
+                self.assertIs(changelog_index.get_employee_changelog_record(employee_id=employee_id,
+                                                                            attendance_date=attendance_date),
+                              get_baseline_changelog_record(attendance_date, employee_changelog_records))
+
+    def test_change_date_boundaries(self):
+        changelog_index = EmployeeChangelogIndex([
+            {"name": "second", "employee": "HR-EMP-00001", "change_date": datetime.date(2024, 1, 10)},
+            {"name": "first", "employee": "HR-EMP-00001", "change_date": datetime.date(2024, 1, 1)}])
+        self.assertIsNone(changelog_index.get_employee_changelog_record("HR-EMP-00001", datetime.date(2023, 12, 31)))
+        self.assertEqual(changelog_index.get_employee_changelog_record(
+            "HR-EMP-00001", datetime.date(2024, 1, 1))['name'], "first")
+        self.assertEqual(changelog_index.get_employee_changelog_record(
+            "HR-EMP-00001", datetime.date(2024, 1, 9))['name'], "first")
+        self.assertEqual(changelog_index.get_employee_changelog_record(
+            "HR-EMP-00001", datetime.date(2024, 1, 10))['name'], "second")
+        self.assertIsNone(changelog_index.get_employee_changelog_record("HR-EMP-00002", datetime.date(2024, 1, 10)))
+
+    def test_the_last_created_record_of_a_date_applies(self):
+        # the records come ordered by creation, the same date keeps that order
+        changelog_index = EmployeeChangelogIndex([
+            {"name": "created first", "employee": "HR-EMP-00001", "change_date": datetime.date(2024, 1, 1)},
+            {"name": "created last", "employee": "HR-EMP-00001", "change_date": datetime.date(2024, 1, 1)}])
+        self.assertEqual(changelog_index.get_employee_changelog_record(
+            "HR-EMP-00001", datetime.date(2024, 1, 5))['name'], "created last")
+
+
+class TestPenaltyPolicyIndex(unittest.TestCase):
+    designations: list = ["Designer", "Driver", "Engineer"]
+
+    def test_matches_the_policies_scan(self):
+        for seed in range(10):
+            penalty_policies = make_penalty_policies(seed=seed, designations=self.designations)
+            penalty_policy_index = PenaltyPolicyIndex(penalty_policies=penalty_policies,
+                                                      penalty_policy_groups=penalty_policy_groups)
+            for designation in self.designations + ["Nobody"]:
+                applied_policies = get_baseline_applied_policies(penalty_policies, designation)
+                self.assertEqual([policy['policy_name'] for policy in
+                                  penalty_policy_index.get_designation_policies(designation.upper())],
+                                 [policy['policy_name'] for policy in applied_policies])
+                for group in penalty_policy_groups:
+                    subgroup = groups_subgroups.get(group['name'], "overtime")
+                    self.assertIs(penalty_policy_index.get_designation_subgroup_group(designation, subgroup),
+                                  get_baseline_subgroup_group(subgroup, applied_policies))
+                    for occurrence_number in range(-1, 6):
+                        for gap_duration_in_minutes in (0, 1, 14, 15, 16, 30, 59, 60, 120):
+                            self.assertIs(
+                                penalty_policy_index.find_policy(designation=designation, group_name=group['name'],
+                                                                 subgroup_name=subgroup,
+                                                                 occurrence_number=occurrence_number,
+                                                                 gap_duration_in_minutes=gap_duration_in_minutes),
+                                get_baseline_policy_by_filters(applied_policies=applied_policies,
+                                                               group_name=group['name'], subgroup_name=subgroup,
+                                                               occurrence_number=occurrence_number,
+                                                               gap_duration_in_minutes=gap_duration_in_minutes),
+                                f"seed {seed}, {designation}, {group['name']}, occurrence {occurrence_number}, "
+                                f"gap {gap_duration_in_minutes}")
+
+    def test_policy_lookups(self):
+        penalty_policies = make_penalty_policies(seed=1, designations=[], full_designations=["Driver"])
+        penalty_policy_index = PenaltyPolicyIndex(penalty_policies=penalty_policies,
+                                                  penalty_policy_groups=penalty_policy_groups)
+        policy = penalty_policies[0]
+        self.assertIs(penalty_policy_index.get_policy(policy['policy_name'].upper()), policy)
+        self.assertIs(penalty_policy_index.get_designation_policy("driver", policy['policy_name']), policy)
+        self.assertIsNone(penalty_policy_index.get_designation_policy("Designer", policy['policy_name']))
+        self.assertIs(penalty_policy_index.get_group("late entry"), penalty_policy_groups[0])
+
+    def test_empty_policy_group(self):
+        # the group without policies is known but no designation subgroup maps to it
+        penalty_policy_index = PenaltyPolicyIndex(
+            penalty_policies=make_penalty_policies(seed=1, designations=[], full_designations=["Driver"]),
+            penalty_policy_groups=penalty_policy_groups)
+        self.assertIsNotNone(penalty_policy_index.get_group("Overtime"))
+        self.assertIsNone(penalty_policy_index.get_designation_subgroup_group("Driver", "overtime"))
+        self.assertIsNone(penalty_policy_index.find_policy(designation="Driver", group_name="Overtime",
+                                                           subgroup_name="overtime", occurrence_number=1,
+                                                           gap_duration_in_minutes=0))
+
+    def test_policy_of_a_missing_group(self):
+        # the subgroup maps to the group of its first policy having a known group
+        penalty_policy_index = PenaltyPolicyIndex(penalty_policies=make_penalty_policies(
+            seed=1, designations=[], full_designations=["Driver"]), penalty_policy_groups=penalty_policy_groups[1:])
+        self.assertIsNone(penalty_policy_index.get_designation_subgroup_group("Driver", "attendance check-in"))
+        self.assertIs(penalty_policy_index.get_designation_subgroup_group("Driver", "attendance check-out"),
+                      penalty_policy_groups[1])
+
+
+class TestPenaltyPolicyLadder(unittest.TestCase):
+    def test_tolerance_tiers_and_occurrences(self):
+        policies = [{"policy_name": name, "tolerance_duration": tolerance_duration,
+                     "occurrence_number": occurrence_number}
+                    for name, tolerance_duration, occurrence_number in (("T0 O1", 0, 1), ("T0 O3", 0, 3),
+                                                                        ("T30 O1", 30, 1), ("T30 O2", 30, 2))]
+        ladder = PenaltyPolicyLadder(policies)
+
+        def find_policy_name(occurrence_number: int, gap_duration_in_minutes=None):
+            policy = ladder.find_policy(occurrence_number=occurrence_number,
+                                        gap_duration_in_minutes=gap_duration_in_minutes)
+            return policy['policy_name'] if policy else None
+
+        self.assertEqual(find_policy_name(1, 29), "T0 O1")
+        self.assertEqual(find_policy_name(2, 29), "T0 O1")
+        self.assertEqual(find_policy_name(5, 29), "T0 O3")
+        # the tolerance is reached at its exact duration
+        self.assertEqual(find_policy_name(1, 30), "T30 O1")
+        self.assertEqual(find_policy_name(5, 90), "T30 O2")
+        # no occurrence is below the first
+        self.assertIsNone(find_policy_name(0, 30))
+        self.assertIsNone(find_policy_name(-1, 30))
+        # without a gap the tolerance tiers are tried in order
+        self.assertEqual(find_policy_name(1), "T30 O1")
+        self.assertIsNone(PenaltyPolicyLadder([]).find_policy(occurrence_number=1))
+
+
+def count_baseline_penalties(penalty_records: list, employee: str, policy_group: str, policy_subgroup: str,
+                             from_date, to_date) -> int:
+    # the baseline count query of the penalties inside the reset duration window
+    return sum(1 for record in penalty_records
+               if record['occurrence_number'] >= 0 and record['employee'].lower() == employee.lower()
+               and record['penalty_group'].lower() == policy_group.lower()
+               and record['policy_subgroup'].lower() == policy_subgroup.lower()
+               and from_date <= record['penalty_date'] <= to_date)
+
+
+class TestPenaltyOccurrenceWindow(unittest.TestCase):
+    groups_subgroups: tuple = tuple(groups_subgroups.items())
+
+    def make_penalty_records(self, randomizer: random.Random, records_number: int) -> list:
+        penalty_records = []
+        for _ in range(records_number):
+            policy_group, policy_subgroup = randomizer.choice(self.groups_subgroups)
+            penalty_records.append({"employee": randomizer.choice(["HR-EMP-00001", "hr-emp-00002"]),
+                                    "penalty_group": policy_group, "policy_subgroup": policy_subgroup,
+                                    "penalty_date": first_date + datetime.timedelta(days=randomizer.randint(0, 60)),
+                                    "occurrence_number": randomizer.choice([-1, 1, 2, 3])})
+        return penalty_records
+
+    def test_matches_the_count_query(self):
+        randomizer = random.Random(6)
+        penalty_records = self.make_penalty_records(randomizer, 300)
+        # the window is loaded with the records the count query counts
+        penalty_occurrence_window = PenaltyOccurrenceWindow([record for record in penalty_records
+                                                             if record['occurrence_number'] >= 0])
+        for employee in ("hr-emp-00001", "HR-EMP-00002", "HR-EMP-00003"):
+            for policy_group, policy_subgroup in self.groups_subgroups:
+                for day in range(-5, 70):
+                    to_date = first_date + datetime.timedelta(days=day)
+                    for reset_duration in (0, 1, 7, 30):
+                        from_date = to_date - datetime.timedelta(days=reset_duration)
+                        self.assertEqual(
+                            penalty_occurrence_window.count_penalties(
+                                employee=employee, policy_group=policy_group.upper(), policy_subgroup=policy_subgroup,
+                                from_date=from_date, to_date=to_date),
+                            count_baseline_penalties(penalty_records, employee=employee, policy_group=policy_group,
+                                                     policy_subgroup=policy_subgroup, from_date=from_date,
+                                                     to_date=to_date))
+
+    def test_added_penalties_are_counted(self):
+        randomizer = random.Random(7)
+        penalty_records = [record for record in self.make_penalty_records(randomizer, 50)
+                           if record['occurrence_number'] >= 0]
+        penalty_occurrence_window = PenaltyOccurrenceWindow(penalty_records[:10])
+        for penalty_record in penalty_records[10:]:
+            penalty_occurrence_window.add_penalty(employee=penalty_record['employee'],
+                                                  policy_group=penalty_record['penalty_group'],
+                                                  policy_subgroup=penalty_record['policy_subgroup'],
+                                                  penalty_date=penalty_record['penalty_date'])
+        for policy_group, policy_subgroup in self.groups_subgroups:
+            from_date = first_date + datetime.timedelta(days=10)
+            to_date = first_date + datetime.timedelta(days=40)
+            self.assertEqual(penalty_occurrence_window.count_penalties(
+                employee="HR-EMP-00001", policy_group=policy_group, policy_subgroup=policy_subgroup,
+                from_date=from_date, to_date=to_date),
+                count_baseline_penalties(penalty_records, employee="HR-EMP-00001", policy_group=policy_group,
+                                         policy_subgroup=policy_subgroup, from_date=from_date, to_date=to_date))
+
+    def test_reset_duration_boundaries(self):
+        # a penalty exactly reset_duration days before the checked date is still inside the window
+        penalty_occurrence_window = PenaltyOccurrenceWindow([
+            {"employee": "HR-EMP-00001", "penalty_group": "Late Entry", "policy_subgroup": "attendance check-in",
+             "penalty_date": datetime.date(2024, 1, 1)}])
+        check_date = datetime.date(2024, 1, 31)
+
+        def count_penalties(reset_duration: int) -> int:
+            return penalty_occurrence_window.count_penalties(
+                employee="HR-EMP-00001", policy_group="Late Entry", policy_subgroup="attendance check-in",
+                from_date=check_date - datetime.timedelta(days=reset_duration), to_date=check_date)
+
+        self.assertEqual(count_penalties(30), 1)
+        self.assertEqual(count_penalties(29), 0)
+        self.assertEqual(penalty_occurrence_window.count_penalties(
+            employee="HR-EMP-00001", policy_group="Late Entry", policy_subgroup="attendance check-in",
+            from_date=datetime.date(2023, 12, 1), to_date=datetime.date(2023, 12, 31)), 0)
+
+    def test_restore_employee_penalties(self):
+        penalty_occurrence_window = PenaltyOccurrenceWindow([
+            {"employee": employee, "penalty_group": "Absence", "policy_subgroup": "attendance absence",
+             "penalty_date": datetime.date(2024, 1, 1)} for employee in ("HR-EMP-00001", "HR-EMP-00002")])
+        employee_penalties = penalty_occurrence_window.get_employee_penalties("HR-EMP-00001")
+        for employee in ("HR-EMP-00001", "HR-EMP-00002"):
+            penalty_occurrence_window.add_penalty(employee=employee, policy_group="Absence",
+                                                  policy_subgroup="attendance absence",
+                                                  penalty_date=datetime.date(2024, 1, 2))
+        penalty_occurrence_window.add_penalty(employee="HR-EMP-00001", policy_group="Late Entry",
+                                              policy_subgroup="attendance check-in",
+                                              penalty_date=datetime.date(2024, 1, 2))
+        penalty_occurrence_window.restore_employee_penalties(employee="HR-EMP-00001",
+                                                             employee_penalties=employee_penalties)
+
+        def count_penalties(employee: str, policy_group: str, policy_subgroup: str) -> int:
+            return penalty_occurrence_window.count_penalties(
+                employee=employee, policy_group=policy_group, policy_subgroup=policy_subgroup,
+                from_date=datetime.date(2024, 1, 1), to_date=datetime.date(2024, 1, 31))
+
+        self.assertEqual(count_penalties("HR-EMP-00001", "Absence", "attendance absence"), 1)
+        self.assertEqual(count_penalties("HR-EMP-00001", "Late Entry", "attendance check-in"), 0)
+        self.assertEqual(count_penalties("HR-EMP-00002", "Absence", "attendance absence"), 2)
+
+
+def has_baseline_automatic_penalty(penalty_records: list, employee: str, penalty_date, penalty_policy: str) -> bool:
+    # the baseline exists query before saving a new automatic record, compared case-insensitively by the database
+    return any(record['action_type'] == "Automatic" and record['employee'].lower() == employee.lower()
+               and record['penalty_date'] == penalty_date and record['penalty_policy'].lower() == penalty_policy.lower()
+               for record in penalty_records)
+
+
+class TestPenaltyRecordIndex(unittest.TestCase):
+    def make_penalty_records(self, randomizer: random.Random, records_number: int) -> list:
+        return [{"name": f"PR-{record_number:05d}", "employee": randomizer.choice(["HR-EMP-00001", "HR-EMP-00002"]),
+                 "penalty_date": first_date + datetime.timedelta(days=randomizer.randint(0, 10)),
+                 "penalty_policy": randomizer.choice(["Late Entry O1", "Late Entry O2", "Absence O1"]),
+                 "occurrence_number": randomizer.choice([-1, 1, 2]),
+                 "action_type": randomizer.choice(["Automatic", "Manual"]),
+                 # the left joined Additional Salary, missing when it was deleted
+                 "linked_additional_salary": randomizer.choice([None, f"HR-ADS-{record_number:05d}"])}
+                for record_number in range(records_number)]
+
+    def test_matches_the_exists_queries(self):
+        randomizer = random.Random(14)
+        penalty_records = self.make_penalty_records(randomizer, 60)
+        penalty_record_index = PenaltyRecordIndex(penalty_records)
+        for employee in ("HR-EMP-00001", "hr-emp-00002"):
+            for day in range(12):
+                penalty_date = first_date + datetime.timedelta(days=day)
+                self.assertEqual(
+                    [record['name'] for record in penalty_record_index.get_date_penalty_records(employee,
+                                                                                                penalty_date)],
+                    [record['name'] for record in penalty_records
+                     if record['employee'].lower() == employee.lower() and record['penalty_date'] == penalty_date])
+                for penalty_policy in ("late entry o1", "Late Entry O2", "Absence O1"):
+                    self.assertEqual(penalty_record_index.has_automatic_penalty(
+                        employee=employee, penalty_date=penalty_date, penalty_policy=penalty_policy),
+                        has_baseline_automatic_penalty(penalty_records, employee=employee,
+                                                       penalty_date=penalty_date, penalty_policy=penalty_policy))
+        for penalty_record in penalty_records:
+            self.assertEqual(penalty_record_index.is_linked_to_additional_salary(penalty_record['name']),
+                             bool(penalty_record['linked_additional_salary']))
+
+    def test_added_penalties_and_links(self):
+        penalty_record_index = PenaltyRecordIndex([])
+        self.assertFalse(penalty_record_index.has_automatic_penalty(employee="HR-EMP-00001", penalty_date=first_date,
+                                                                    penalty_policy="Absence O1"))
+        penalty_record_index.add_automatic_penalty(employee="HR-EMP-00001", penalty_date=first_date,
+                                                   penalty_policy="Absence O1")
+        self.assertTrue(penalty_record_index.has_automatic_penalty(employee="hr-emp-00001", penalty_date=first_date,
+                                                                   penalty_policy="ABSENCE O1"))
+        self.assertFalse(penalty_record_index.has_automatic_penalty(
+            employee="HR-EMP-00001", penalty_date=first_date + datetime.timedelta(days=1),
+            penalty_policy="Absence O1"))
+        self.assertFalse(penalty_record_index.is_linked_to_additional_salary("PR-00001"))
+        penalty_record_index.add_additional_salary_link("PR-00001")
+        self.assertTrue(penalty_record_index.is_linked_to_additional_salary("PR-00001"))
+
+
+class TestAffectedAttendanceDates(unittest.TestCase):
+    def test_matches_the_affected_dates_set(self):
+        randomizer = random.Random(18)
+        for downstream_days in (0, 1, 7):
+            affected_attendance_dates = AffectedAttendanceDates(downstream_days=downstream_days)
+            affected_dates = {}
+            for _ in range(100):
+                employee = randomizer.choice(["HR-EMP-00001", "HR-EMP-00002"])
+                from_day = randomizer.randint(0, 60)
+                from_date = first_date + datetime.timedelta(days=from_day)
+                if randomizer.random() < 0.5:
+                    affected_attendance_dates.add_date(employee=employee, changed_date=from_date)
+                    to_day = from_day + downstream_days
+                else:
+                    to_day = from_day + randomizer.randint(0, 5)
+                    affected_attendance_dates.add_dates_range(employee=employee, from_date=from_date,
+                                                              to_date=first_date + datetime.timedelta(days=to_day))
+                affected_dates.setdefault(employee, set()).update(
+                    first_date + datetime.timedelta(days=day) for day in range(from_day, to_day + 1))
+            for employee in ("HR-EMP-00001", "HR-EMP-00002", "HR-EMP-00003"):
+                for day in range(-2, 75):
+                    attendance_date = first_date + datetime.timedelta(days=day)
+                    self.assertEqual(affected_attendance_dates.is_affected(employee=employee,
+                                                                           attendance_date=attendance_date),
+                                     attendance_date in affected_dates.get(employee, set()))
+                # the ranges stay sorted without overlaps
+                dates_ranges = affected_attendance_dates.get_employees_dates_ranges([employee]).get(employee, [])
+                for (from_date, to_date), (next_from_date, _) in zip(dates_ranges, dates_ranges[1:]):
+                    self.assertLessEqual(from_date, to_date)
+                    self.assertLess(to_date, next_from_date)
+            self.assertEqual(affected_attendance_dates.get_employees(), sorted(affected_dates))
+
+    def test_stored_ranges_are_merged(self):
+        affected_attendance_dates = AffectedAttendanceDates(employees_dates_ranges={"HR-EMP-00001": [
+            (datetime.date(2024, 1, 10), datetime.date(2024, 1, 12)),
+            (datetime.date(2024, 1, 1), datetime.date(2024, 1, 3)),
+            (datetime.date(2024, 1, 3), datetime.date(2024, 1, 5))]})
+        self.assertEqual(affected_attendance_dates.get_employees_dates_ranges(["HR-EMP-00001", "HR-EMP-00002"]),
+                         {"HR-EMP-00001": [(datetime.date(2024, 1, 1), datetime.date(2024, 1, 5)),
+                                           (datetime.date(2024, 1, 10), datetime.date(2024, 1, 12))]})
+        self.assertFalse(affected_attendance_dates.is_affected("HR-EMP-00001", datetime.date(2024, 1, 6)))
+        self.assertTrue(affected_attendance_dates.is_affected("HR-EMP-00001", datetime.date(2024, 1, 12)))
@@ -0,0 +1,72 @@
+import math
+import random
+import unittest
+from unittest import mock
+
+import frappe
+
+from payroll_lavado.batch_writers import AttendanceFieldsWriter
+
+
+def is_baseline_stored(stored_values: dict, values: dict) -> bool:
+    # the baseline saved every attendance, a skipped row must already hold the computed values
+    return all(stored_values.get(field) == values.get(field) or (
+            stored_values.get(field) is not None and values.get(field) is not None
+            and math.isclose(stored_values[field], values[field], abs_tol=AttendanceFieldsWriter.tolerance))
+               for field in AttendanceFieldsWriter.fields)
+
+
+class TestAttendanceFieldsWriter(unittest.TestCase):
+    def test_is_changed(self):
+        attendance_fields_writer = AttendanceFieldsWriter()
+        self.assertFalse(attendance_fields_writer.is_changed(5, 5))
+        self.assertTrue(attendance_fields_writer.is_changed(5, 6))
+        self.assertFalse(attendance_fields_writer.is_changed(None, None))
+        self.assertTrue(attendance_fields_writer.is_changed(None, 0))
+        self.assertTrue(attendance_fields_writer.is_changed(0, None))
+        self.assertFalse(attendance_fields_writer.is_changed(8.0, 8.0000000001))
+        self.assertTrue(attendance_fields_writer.is_changed(8.0, 7.99))
+        self.assertFalse(attendance_fields_writer.is_changed(8, 8.0))
+
+    def test_skips_only_the_stored_rows(self):
+        randomizer = random.Random(12)
+        attendance_fields_writer = AttendanceFieldsWriter()
+        changed_names = set()
+        for row_number in range(500):
+            stored_values = {field: randomizer.choice([None, 0, 5, 7.5, 8.0])
+                             for field in AttendanceFieldsWriter.fields}
+            values = {field: randomizer.choice([stored_values[field]] * 4 + [0, 5, 8.0000000001, 7.99])
+                      for field in AttendanceFieldsWriter.fields}
+            attendance = frappe._dict(stored_values, name=f"HR-ATT-{row_number:05d}")
+            added = attendance_fields_writer.add(attendance=attendance, values=values, parent_id="HR-EMP-00001")
+            self.assertEqual(added, not is_baseline_stored(stored_values, values), f"{stored_values} {values}")
+            if added:
+                changed_names.add(attendance.name)
+        self.assertEqual(set(attendance_fields_writer.pending_records), changed_names)
+        self.assertEqual(attendance_fields_writer.unchanged_records_number, 500 - len(changed_names))
+
+    def test_discard_parent_records(self):
+        attendance_fields_writer = AttendanceFieldsWriter()
+        for employee in ("HR-EMP-00001", "HR-EMP-00002"):
+            attendance_fields_writer.add(attendance=frappe._dict(name=f"{employee}-ATT"),
+                                         values={"lava_planned_working_hours": 8}, parent_id=employee)
+        attendance_fields_writer.discard_parent_records(parent_id="HR-EMP-00001")
+        self.assertEqual(list(attendance_fields_writer.pending_records), ["HR-EMP-00002-ATT"])
+
+    def test_flush_updates_the_changed_rows_in_chunks(self):
+        attendance_fields_writer = AttendanceFieldsWriter(chunk_size=2)
+        for row_number in range(3):
+            attendance_fields_writer.add(attendance=frappe._dict(name=f"HR-ATT-{row_number}"), parent_id="HR-EMP-00001",
+                                         values={"lava_entry_duration_difference": row_number,
+                                                 "lava_exit_duration_difference": 0,
+                                                 "lava_planned_working_hours": 8})
+        with mock.patch.object(frappe, "db") as db:
+            attendance_fields_writer.flush()
+        self.assertEqual(db.sql.call_count, 2)
+        query, values = db.sql.call_args_list[0].args
+        self.assertEqual(query.count("WHEN %s THEN %s"), 2 * len(AttendanceFieldsWriter.fields))
+        self.assertEqual(values[:4], ["HR-ATT-0", 0, "HR-ATT-1", 1])
+        self.assertEqual(values[-1], ("HR-ATT-0", "HR-ATT-1"))
+        self.assertEqual(db.sql.call_args_list[1].args[1][-1], ("HR-ATT-2",))
+        self.assertEqual(attendance_fields_writer.updated_records_number, 3)
+        self.assertFalse(attendance_fields_writer.pending_records)
@@ -0,0 +1,135 @@
+import datetime
+import unittest
+from unittest import mock
+
+import frappe
+from frappe.utils.redis_wrapper import RedisWrapper
+
+from payroll_lavado import employee_change_log
+from payroll_lavado.employee_change_log import queue_employee_change_log, process_employee_change_log_queue
+
+
+def get_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class MemoryRedisWrapper(RedisWrapper):
+    # the site's cache wrapper with its redis commands answered from memory, the wrapped methods run unchanged
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def execute_command(self, *args, **options):
+        command, arguments = args[0].upper(), args[1:]
+        if command == "DEL":
+            return sum(self.values.pop(get_bytes(key), None) is not None for key in arguments)
+        key = get_bytes(arguments[0])
+        if command == "RPUSH":
+            self.values.setdefault(key, []).extend(get_bytes(value) for value in arguments[1:])
+            return len(self.values[key])
+        if command == "LPOP":
+            values = self.values.get(key)
+            value = values.pop(0) if values else None
+            if values == []:
+                del self.values[key]
+            return value
+        if command == "LLEN":
+            return len(self.values.get(key, []))
+        if command == "SET":
+            if "NX" in arguments[2:] and key in self.values:
+                return None
+            self.values[key] = get_bytes(arguments[1])
+            return True
+        if command == "GET":
+            return self.values.get(key)
+        if command == "EXPIRE":
+            return int(key in self.values)
+        raise NotImplementedError(command)
+
+
+class TestEmployeeChangeLogQueue(unittest.TestCase):
+    def setUp(self):
+        self.cache = MemoryRedisWrapper()
+        self.applied_sources = []
+        self.failed_employee_id = None
+        self.now = 1000.0
+        for patch in (mock.patch.object(frappe, "cache", lambda: self.cache),
+                      mock.patch.object(frappe, "db", mock.Mock()),
+                      mock.patch.object(frappe, "log_error", mock.Mock()),
+                      mock.patch.object(employee_change_log.time, "time", lambda: self.now),
+                      mock.patch.object(employee_change_log, "EmployeeChangelogResolver", self.get_resolver)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get_resolver(self, employee_id: str):
+        # records the sources the queue applies per employee instead of creating the changelog records
+        resolver = mock.Mock()
+
+        def apply_sources(sources: list):
+            if employee_id == self.failed_employee_id:
+                raise ValueError("the employee can't be resolved")
+            self.applied_sources.append((employee_id, sources))
+
+        resolver.apply_sources.side_effect = apply_sources
+        return resolver
+
+    def queue_changes(self):
+        queue_employee_change_log(employee_id="HR-EMP-00001", source_doctype="Employee", source_id="HR-EMP-00001")
+        queue_employee_change_log(employee_id="HR-EMP-00002", source_doctype="Shift Assignment", source_id="SA-0001")
+        queue_employee_change_log(employee_id="HR-EMP-00001", source_doctype="Salary Structure Assignment",
+                                  source_id="SSA-0001")
+        queue_employee_change_log(employee_id="HR-EMP-00001", source_doctype="Employee", source_id="HR-EMP-00001",
+                                  change_date=datetime.date(2024, 1, 5))
+
+    def test_queue_processed_once_due(self):
+        self.queue_changes()
+        self.assertEqual(self.cache.llen(f"{employee_change_log.changelog_queue_key_prefix}|employees"), 2)
+
+        # queued in the debounce interval, left to the next run
+        self.now += 10
+        process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=300)
+        self.assertEqual(self.applied_sources, [])
+
+        self.now += 30
+        process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=300)
+        # every employee once with its coalesced sources, a source saved twice at its last position
+        self.assertEqual(self.applied_sources, [
+            ("HR-EMP-00001", [("Salary Structure Assignment", "SSA-0001", None),
+                              ("Employee", "HR-EMP-00001", "2024-01-05")]),
+            ("HR-EMP-00002", [("Shift Assignment", "SA-0001", None)])])
+        self.assertEqual(frappe.db.commit.call_count, 2)
+        # the queued lists, the lock and the first change time are removed
+        self.assertEqual(list(self.cache.values), [employee_change_log.get_queue_key("last_change_time")])
+
+        # nothing left to apply
+        self.now += 60
+        process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=300)
+        self.assertEqual(len(self.applied_sources), 2)
+
+    def test_queue_due_by_max_wait(self):
+        # changes queued every few seconds are processed once the oldest one waited for the max wait
+        for _ in range(12):
+            queue_employee_change_log(employee_id="HR-EMP-00001", source_doctype="Shift Assignment",
+                                      source_id="SA-0001")
+            process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=45)
+            self.now += 10
+        self.assertEqual(self.applied_sources, [("HR-EMP-00001", [("Shift Assignment", "SA-0001", None)])] * 2)
+
+    def test_locked_queue(self):
+        self.queue_changes()
+        self.now += 60
+        self.cache.set(employee_change_log.get_queue_key("lock"), 1)
+        process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=300)
+        self.assertEqual(self.applied_sources, [])
+
+    def test_failed_employee(self):
+        # the failing employee is rolled back and logged, the next employees are still applied
+        self.queue_changes()
+        self.failed_employee_id = "HR-EMP-00001"
+        self.now += 60
+        process_employee_change_log_queue(debounce_seconds=30, max_wait_seconds=300)
+        self.assertEqual(self.applied_sources, [("HR-EMP-00002", [("Shift Assignment", "SA-0001", None)])])
+        frappe.db.rollback.assert_called_once()
+        frappe.log_error.assert_called_once()
+        # the queued lists, the lock and the first change time are removed
+        self.assertEqual(list(self.cache.values), [employee_change_log.get_queue_key("last_change_time")])
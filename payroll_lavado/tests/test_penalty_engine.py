@@ -0,0 +1,280 @@
+import datetime
+import random
+import unittest
+
+from payroll_lavado.batch_indexes import PenaltyPolicyIndex, PenaltyOccurrenceWindow, PenaltyRecordIndex
+from payroll_lavado.penalty_engine import PenaltyEngine
+from payroll_lavado.tests.penalty_policies import get_baseline_applied_policies, get_baseline_group, \
+    get_baseline_policy_by_filters, get_baseline_subgroup_group, make_penalty_policies, penalty_policy_groups
+
+first_date = datetime.date(2024, 1, 1)
+day_working_hours: float = 8.0
+
+
+class BaselinePenalties:
+    # the baseline batch's penalties over plain records: the designation's policies scanned per attendance, the
+    # occurrences counted over the saved penalty records and every new penalty saved before the next one
+    def __init__(self, penalty_policies: list, penalty_records: list):
+        self.penalty_policies = penalty_policies
+        self.penalty_records = [dict(penalty_record) for penalty_record in penalty_records]
+
+    def get_policy(self, policy_name: str, policies: list = None):
+        for policy in policies or self.penalty_policies:
+            if policy['policy_name'].lower() == policy_name.lower():
+                return policy
+        return None
+
+    def count_penalties(self, employee: str, check_date, duration_in_days: int, policy_subgroup: str,
+                        policy_group: str) -> int:
+        from_date = check_date - datetime.timedelta(days=duration_in_days)
+        return sum(1 for record in self.penalty_records
+                   if record['occurrence_number'] >= 0 and record['policy_subgroup'].lower() == policy_subgroup.lower()
+                   and record['employee'].lower() == employee.lower()
+                   and self.get_policy(record['penalty_policy'])['penalty_group'].lower() == policy_group.lower()
+                   and from_date <= record['penalty_date'] <= check_date)
+
+    @staticmethod
+    def get_penalty_amount(changelog_record, attendance, policy) -> float:
+        deduction_in_days_amount = changelog_record['hourly_rate'] * policy['deduction_factor'] * day_working_hours
+        deduction_absolute_amount = policy.get('deduction_amount', 0)
+        deduction_times_time_gap = 0
+        if policy['policy_subgroup'] == "attendance check-in":
+            deduction_times_time_gap = (attendance['lava_entry_duration_difference'] / 60) * \
+                                       changelog_record['hourly_rate'] * policy['deduction_factor']
+        elif policy['policy_subgroup'] == "attendance check-out":
+            deduction_times_time_gap = (attendance['lava_exit_duration_difference'] / 60) * \
+                                       changelog_record['hourly_rate'] * policy['deduction_factor']
+        deductions = [deduction_absolute_amount, deduction_in_days_amount, deduction_times_time_gap]
+        return {"biggest": max(deductions), "smallest": min(deductions),
+                "absolute amount": deduction_absolute_amount, "deduction in days": deduction_in_days_amount,
+                "times time gap": deduction_times_time_gap}[policy['deduction_rule']]
+
+    def evaluate_employee(self, attendance_list: list, attendance_changelog_records: dict) -> list:
+        decisions = []
+        for attendance in attendance_list:
+            changelog_record = attendance_changelog_records[attendance['name']]
+            if not changelog_record or not changelog_record['designation']:
+                raise ValueError(f"no designation on the attendance '{attendance['name']}'")
+            applied_policies = get_baseline_applied_policies(self.penalty_policies, changelog_record['designation'])
+            if applied_policies:
+                decisions.extend(self.evaluate_attendance(changelog_record, attendance, applied_policies))
+        return decisions
+
+    def evaluate_attendance(self, changelog_record, attendance, applied_policies: list) -> list:
+        decisions = []
+        existing_penalty_records = [record for record in self.penalty_records
+                                    if record['employee'] == changelog_record['employee']
+                                    and record['penalty_date'] == attendance['attendance_date']]
+        for existing_penalty_record in existing_penalty_records:
+            policy = self.get_policy(existing_penalty_record['penalty_policy'], policies=applied_policies)
+            if not policy:
+                raise ValueError(f"Cannot find policy '{existing_penalty_record['penalty_policy']}'")
+            policy_group = get_baseline_group(policy['penalty_group'])
+            occurrence_number = 1 + self.count_penalties(
+                employee=changelog_record['employee'], check_date=attendance['attendance_date'],
+                duration_in_days=policy_group['reset_duration'], policy_subgroup=policy['policy_subgroup'],
+                policy_group=policy['penalty_group'])
+            existing_penalty_record['occurrence_number'] = occurrence_number
+            decisions.append(("Update", policy['policy_name'], occurrence_number,
+                              self.get_penalty_amount(changelog_record, attendance, policy),
+                              existing_penalty_record['name']))
+
+        policy_subgroups = []
+        if attendance['status'].lower() == "absent":
+            policy_subgroups.append("attendance absence")
+        if attendance['late_entry']:
+            policy_subgroups.append("attendance check-in")
+        if attendance['early_exit']:
+            policy_subgroups.append("attendance check-out")
+        for policy_subgroup in policy_subgroups:
+            policy_group = get_baseline_subgroup_group(policy_subgroup, applied_policies)
+            if not policy_group:
+                raise ValueError(f"Cannot find policy group for the attendance '{attendance['name']}'")
+            gap_duration_in_minutes = 0
+            if policy_subgroup == "attendance check-in":
+                gap_duration_in_minutes = attendance['lava_entry_duration_difference']
+            elif policy_subgroup == "attendance check-out":
+                gap_duration_in_minutes = attendance['lava_exit_duration_difference']
+            occurrence_number = 1 + self.count_penalties(
+                employee=changelog_record['employee'], check_date=attendance['attendance_date'],
+                duration_in_days=policy_group['reset_duration'], policy_subgroup=policy_subgroup,
+                policy_group=policy_group['name'])
+            policy = get_baseline_policy_by_filters(applied_policies=applied_policies, group_name=policy_group['name'],
+                                                    subgroup_name=policy_subgroup, occurrence_number=occurrence_number,
+                                                    gap_duration_in_minutes=gap_duration_in_minutes)
+            if not policy:
+                raise ValueError(f"unrecognized policy for the attendance '{attendance['name']}'")
+            action = "Create"
+            if any(record['action_type'] == "Automatic" and record['employee'] == changelog_record['employee']
+                   and record['penalty_date'] == attendance['attendance_date']
+                   and record['penalty_policy'] == policy['policy_name'] for record in self.penalty_records):
+                action = "Duplicate"
+            else:
+                self.penalty_records.append({"name": None, "employee": changelog_record['employee'],
+                                             "penalty_date": attendance['attendance_date'],
+                                             "penalty_policy": policy['policy_name'],
+                                             "policy_subgroup": policy_subgroup,
+                                             "occurrence_number": occurrence_number, "action_type": "Automatic"})
+            decisions.append((action, policy['policy_name'], occurrence_number,
+                              self.get_penalty_amount(changelog_record, attendance, policy), None))
+        return decisions
+
+
+def evaluate_engine_penalties(penalty_policies: list, penalty_records: list, attendance_list: list,
+                              attendance_changelog_records: dict) -> list:
+    # the engine loaded like the batch loads its indexes from the saved records
+    policies_groups = {policy['policy_name']: policy['penalty_group'] for policy in penalty_policies}
+    penalty_engine = PenaltyEngine(
+        penalty_policy_index=PenaltyPolicyIndex(penalty_policies=penalty_policies,
+                                                penalty_policy_groups=penalty_policy_groups),
+        penalty_occurrence_window=PenaltyOccurrenceWindow([
+            dict(record, penalty_group=policies_groups[record['penalty_policy']]) for record in penalty_records
+            if record['occurrence_number'] >= 0]),
+        day_working_hours=day_working_hours,
+        penalty_record_index=PenaltyRecordIndex([dict(record, linked_additional_salary=None)
+                                                 for record in penalty_records]))
+    employee_id = attendance_list[0]['employee'] if attendance_list else None
+    return [(decision['action'], decision['penalty_policy'], decision['occurrence_number'],
+             decision['penalty_amount'], decision['existing_penalty_record'])
+            for decision in penalty_engine.evaluate_employee(employee_id=employee_id, attendance_list=attendance_list,
+                                                             attendance_changelog_records=attendance_changelog_records)]
+
+
+def make_attendance(day: int, status: str = "Present", entry_difference: int = 0, exit_difference: int = 0,
+                    employee: str = "HR-EMP-00001") -> dict:
+    return {"name": f"{employee}-ATT-{day:03d}", "employee": employee,
+            "attendance_date": first_date + datetime.timedelta(days=day), "status": status,
+            "late_entry": int(entry_difference > 0), "early_exit": int(exit_difference > 0),
+            "lava_entry_duration_difference": entry_difference, "lava_exit_duration_difference": exit_difference}
+
+
+class TestPenaltyEngine(unittest.TestCase):
+    designations: list = ["Designer", "Driver", "Engineer"]
+
+    def assert_same_penalties(self, penalty_policies: list, penalty_records: list, attendance_list: list,
+                              attendance_changelog_records: dict) -> list:
+        # the same decisions or the same failure as the baseline
+        baseline_error = engine_error = None
+        baseline_decisions = engine_decisions = None
+        try:
+            baseline_decisions = BaselinePenalties(penalty_policies, penalty_records).evaluate_employee(
+                attendance_list=attendance_list, attendance_changelog_records=attendance_changelog_records)
+        except ValueError as ex:
+            baseline_error = ex
+        try:
+            engine_decisions = evaluate_engine_penalties(penalty_policies, penalty_records, attendance_list,
+                                                         attendance_changelog_records)
+        except ValueError as ex:
+            engine_error = ex
+        self.assertEqual(engine_error is None, baseline_error is None, f"engine: {engine_error}, "
+                                                                       f"baseline: {baseline_error}")
+        if baseline_error is None:
+            self.assertEqual(len(engine_decisions), len(baseline_decisions))
+            for engine_decision, baseline_decision in zip(engine_decisions, baseline_decisions):
+                self.assertEqual(engine_decision[:3] + engine_decision[4:],
+                                 baseline_decision[:3] + baseline_decision[4:])
+                self.assertAlmostEqual(engine_decision[3], baseline_decision[3])
+        return engine_decisions
+
+    def test_matches_the_baseline_penalties(self):
+        randomizer = random.Random(20)
+        failed_scenarios = 0
+        for seed in range(60):
+            penalty_policies = make_penalty_policies(seed=seed, designations=["Designer"],
+                                                     full_designations=["Driver", "Engineer"])
+            employee = "HR-EMP-00001"
+            change_day = randomizer.randint(0, 40)
+            designations = [randomizer.choice(self.designations), randomizer.choice(self.designations)]
+            attendance_list = []
+            attendance_changelog_records = {}
+            for day in range(0, 45):
+                status = randomizer.choices(["Present", "Absent", "Half Day"], weights=[80, 10, 10])[0]
+                attendance = make_attendance(
+                    day=day, status=status, employee=employee,
+                    entry_difference=randomizer.choice([0, 0, 5, 15, 30, 45, 90]) if status != "Absent" else 0,
+                    exit_difference=randomizer.choice([0, 0, 0, 10, 60]) if status != "Absent" else 0)
+                attendance_list.append(attendance)
+                attendance_changelog_records[attendance['name']] = {
+                    "name": f"CHANGELOG-{int(day >= change_day)}", "employee": employee,
+                    "designation": designations[int(day >= change_day)], "hourly_rate": 10 + 5 * (day >= change_day)}
+            penalty_records = []
+            for record_number in range(randomizer.randint(0, 12)):
+                # the history before the period and the saved records of the period's dates
+                day = randomizer.randint(-30, 44)
+                designation = designations[int(day >= change_day)]
+                policy = randomizer.choice(get_baseline_applied_policies(penalty_policies, designation)
+                                           or penalty_policies)
+                penalty_records.append({"name": f"PR-{record_number:05d}", "employee": employee,
+                                        "penalty_date": first_date + datetime.timedelta(days=day),
+                                        "penalty_policy": policy['policy_name'],
+                                        "policy_subgroup": policy['policy_subgroup'],
+                                        "occurrence_number": randomizer.choice([-1, 1, 2, 3]),
+                                        "action_type": randomizer.choice(["Automatic", "Manual"])})
+            # the period's records are the ones the batch reads per date, the history only counts
+            penalty_records.sort(key=lambda record: record['penalty_date'])
+            if self.assert_same_penalties(penalty_policies, penalty_records, attendance_list,
+                                          attendance_changelog_records) is None:
+                failed_scenarios += 1
+        # most scenarios compute penalties rather than failing the same way
+        self.assertLess(failed_scenarios, 30)
+
+    def test_reset_duration_boundaries(self):
+        # the early exit group resets after 7 days: a penalty 7 days back still counts, 8 days back it doesn't
+        penalty_policies = make_penalty_policies(seed=2, designations=[], full_designations=["Driver"])
+        attendance_list = [make_attendance(day=day, exit_difference=30) for day in (0, 7, 15, 16)]
+        attendance_changelog_records = {attendance['name']: {"name": "CHANGELOG", "employee": "HR-EMP-00001",
+                                                             "designation": "Driver", "hourly_rate": 10}
+                                        for attendance in attendance_list}
+        decisions = self.assert_same_penalties(penalty_policies, [], attendance_list, attendance_changelog_records)
+        self.assertEqual([decision[2] for decision in decisions], [1, 2, 1, 2])
+
+    def test_negative_occurrence_number(self):
+        # a record with a negative occurrence number is left out of the occurrences till the batch updates it
+        penalty_policies = make_penalty_policies(seed=3, designations=[], full_designations=["Driver"])
+        absence_policy = next(policy for policy in penalty_policies
+                              if policy['policy_subgroup'] == "attendance absence" and policy['occurrence_number'] == 1)
+        penalty_records = [{"name": f"PR-{day}", "employee": "HR-EMP-00001",
+                            "penalty_date": first_date + datetime.timedelta(days=day),
+                            "penalty_policy": absence_policy['policy_name'],
+                            "policy_subgroup": "attendance absence", "occurrence_number": -1,
+                            "action_type": "Manual"} for day in (-2, 1)]
+        attendance_list = [make_attendance(day=day, status="Absent") for day in (0, 1, 2)]
+        attendance_changelog_records = {attendance['name']: {"name": "CHANGELOG", "employee": "HR-EMP-00001",
+                                                             "designation": "Driver", "hourly_rate": 10}
+                                        for attendance in attendance_list}
+        decisions = self.assert_same_penalties(penalty_policies, penalty_records, attendance_list,
+                                               attendance_changelog_records)
+        self.assertEqual([(decision[0], decision[2]) for decision in decisions],
+                         [("Create", 1), ("Update", 2), ("Create", 3), ("Create", 4)])
+
+    def test_duplicate_automatic_penalty(self):
+        # the saved automatic record counts as the first occurrence, the new penalty falls on its second
+        # occurrence policy which is already saved for the date
+        penalty_policies = make_penalty_policies(seed=4, designations=[], full_designations=["Driver"])
+        absence_policy = next(policy for policy in penalty_policies
+                              if policy['policy_subgroup'] == "attendance absence" and policy['occurrence_number'] == 2)
+        penalty_records = [{"name": "PR-1", "employee": "HR-EMP-00001", "penalty_date": first_date,
+                            "penalty_policy": absence_policy['policy_name'], "policy_subgroup": "attendance absence",
+                            "occurrence_number": -1, "action_type": "Automatic"}]
+        attendance_list = [make_attendance(day=0, status="Absent")]
+        decisions = self.assert_same_penalties(
+            penalty_policies, penalty_records, attendance_list,
+            {attendance_list[0]['name']: {"name": "CHANGELOG", "employee": "HR-EMP-00001", "designation": "Driver",
+                                          "hourly_rate": 10}})
+        self.assertEqual([decision[0] for decision in decisions], ["Update", "Duplicate"])
+
+    def test_designation_without_subgroup_policies(self):
+        # the late entry group has no policy for the designation, a late attendance can't be penalized
+        penalty_policies = [policy for policy in make_penalty_policies(seed=5, designations=[],
+                                                                       full_designations=["Driver"])
+                            if policy['penalty_group'] != "late entry"]
+        attendance_list = [make_attendance(day=0, entry_difference=20)]
+        attendance_changelog_records = {attendance_list[0]['name']: {"name": "CHANGELOG", "employee": "HR-EMP-00001",
+                                                                     "designation": "Driver", "hourly_rate": 10}}
+        self.assert_same_penalties(penalty_policies, [], attendance_list, attendance_changelog_records)
+        with self.assertRaises(ValueError):
+            evaluate_engine_penalties(penalty_policies, [], attendance_list, attendance_changelog_records)
+        # a designation without policies is skipped
+        self.assertEqual(evaluate_engine_penalties(penalty_policies, [], attendance_list, {
+            attendance_list[0]['name']: {"name": "CHANGELOG", "employee": "HR-EMP-00001", "designation": "Designer",
+                                         "hourly_rate": 10}}), [])
@@ -0,0 +1,194 @@
+import datetime
+import random
+import unittest
+
+from payroll_lavado.working_hours import ShiftTypeCache, AttendanceBreakdowns, TimesheetLogsBuilder, \
+    calc_attendance_breakdown, get_query_columns
+
+first_time = datetime.datetime(2024, 1, 1, 8)
+# the columns of the batch's attendance query read by the breakdowns, in/out seconds -1 for an empty time
+attendance_query_fields: list = ["name", "shift", "status", "docstatus", "in_time", "out_time", "late_entry",
+                                 "early_exit", "lava_entry_duration_difference", "lava_exit_duration_difference",
+                                 "in_seconds", "out_seconds", "breakdown_checked"]
+shift_types: list = [
+    {"name": "Morning", "start_time": datetime.timedelta(hours=8), "end_time": datetime.timedelta(hours=16)},
+    {"name": "Evening", "start_time": datetime.timedelta(hours=14, minutes=30),
+     "end_time": datetime.timedelta(hours=22, minutes=45)},
+    {"name": "Night", "start_time": datetime.timedelta(hours=22), "end_time": datetime.timedelta(hours=6)},
+]
+
+
+def is_overlapping(time_log: dict, other_time_log: dict) -> bool:
+    # the overlap conditions of the timesheet validation, touching logs don't overlap
+    return (other_time_log['from_time'] < time_log['from_time'] < other_time_log['to_time']) or \
+        (other_time_log['from_time'] < time_log['to_time'] < other_time_log['to_time']) or \
+        (time_log['from_time'] <= other_time_log['from_time'] and time_log['to_time'] >= other_time_log['to_time'])
+
+
+def get_baseline_skipped_logs(attendances_time_logs: list) -> set:
+    # every log checked against all the kept logs, in the start time order
+    kept_time_logs = []
+    skipped_attendance_names = set()
+    for attendance_name, time_log in sorted(attendances_time_logs,
+                                            key=lambda item: (item[1]['from_time'], item[1]['to_time'])):
+        if any(is_overlapping(time_log, kept_time_log) for kept_time_log in kept_time_logs):
+            skipped_attendance_names.add(attendance_name)
+        else:
+            kept_time_logs.append(time_log)
+    return skipped_attendance_names
+
+
+def make_time_log(from_hours: float, to_hours: float) -> dict:
+    return {"from_time": first_time + datetime.timedelta(hours=from_hours),
+            "to_time": first_time + datetime.timedelta(hours=to_hours), "hours": to_hours - from_hours}
+
+
+class TestTimesheetLogsBuilder(unittest.TestCase):
+    def test_matches_the_pairwise_overlap_check(self):
+        randomizer = random.Random(16)
+        for _ in range(200):
+            timesheet_logs_builder = TimesheetLogsBuilder()
+            attendances_time_logs = []
+            for attendance_number in range(randomizer.randint(0, 12)):
+                from_hours = randomizer.randint(0, 40)
+                time_log = make_time_log(from_hours, from_hours + randomizer.randint(1, 10))
+                attendances_time_logs.append((f"HR-ATT-{attendance_number:05d}", time_log))
+                timesheet_logs_builder.add(attendance_name=f"HR-ATT-{attendance_number:05d}", time_log=time_log)
+            overlapping_time_logs = timesheet_logs_builder.get_overlapping_time_logs()
+            skipped_attendance_names = {attendance_name for attendance_name, _ in overlapping_time_logs}
+            self.assertEqual(skipped_attendance_names, get_baseline_skipped_logs(attendances_time_logs))
+            time_logs = timesheet_logs_builder.get_time_logs(skipped_attendance_names=skipped_attendance_names)
+            for time_log_index, time_log in enumerate(time_logs):
+                for other_time_log in time_logs[time_log_index + 1:]:
+                    self.assertFalse(is_overlapping(time_log, other_time_log))
+                    self.assertFalse(is_overlapping(other_time_log, time_log))
+
+    def test_touching_logs_do_not_overlap(self):
+        timesheet_logs_builder = TimesheetLogsBuilder()
+        timesheet_logs_builder.add(attendance_name="evening", time_log=make_time_log(8, 16))
+        timesheet_logs_builder.add(attendance_name="morning", time_log=make_time_log(0, 8))
+        timesheet_logs_builder.add(attendance_name="night", time_log=make_time_log(16, 24))
+        self.assertEqual(timesheet_logs_builder.get_overlapping_time_logs(), [])
+        # the logs keep their attendance order
+        self.assertEqual([time_log['hours'] for time_log in timesheet_logs_builder.get_time_logs()], [8, 8, 8])
+
+    def test_overlapped_log_is_the_kept_one(self):
+        timesheet_logs_builder = TimesheetLogsBuilder()
+        timesheet_logs_builder.add(attendance_name="long", time_log=make_time_log(0, 10))
+        timesheet_logs_builder.add(attendance_name="nested", time_log=make_time_log(2, 4))
+        timesheet_logs_builder.add(attendance_name="same", time_log=make_time_log(0, 10))
+        timesheet_logs_builder.add(attendance_name="after", time_log=make_time_log(10, 12))
+        timesheet_logs_builder.add(attendance_name="crossing", time_log=make_time_log(11, 14))
+        self.assertEqual(sorted(timesheet_logs_builder.get_overlapping_time_logs()),
+                         [("crossing", "after"), ("nested", "long"), ("same", "long")])
+
+    def test_logs_without_times_are_not_checked(self):
+        timesheet_logs_builder = TimesheetLogsBuilder()
+        timesheet_logs_builder.add(attendance_name="complete", time_log=make_time_log(0, 8))
+        timesheet_logs_builder.add(attendance_name="no check-out", time_log=dict(make_time_log(2, 4), to_time=None))
+        self.assertEqual(timesheet_logs_builder.get_overlapping_time_logs(), [])
+        self.assertEqual(len(timesheet_logs_builder.get_time_logs()), 2)
+
+
+def get_day_seconds(time_value: datetime.datetime) -> int:
+    return -1 if time_value is None else time_value.hour * 3600 + time_value.minute * 60 + time_value.second
+
+
+def make_attendance_row(randomizer: random.Random, row_number: int) -> tuple:
+    # the check-in/out around the shift start/end: on time, a few seconds or minutes late/early, before/after it
+    shift_name = randomizer.choice(["Morning", "Evening", "Night", "night", "Unknown"])
+    shift_type = next((shift_type for shift_type in shift_types if shift_type['name'].lower() == shift_name.lower()),
+                      shift_types[0])
+    shift_start = first_time.replace(hour=0) + shift_type['start_time']
+    shift_end = first_time.replace(hour=0) + shift_type['end_time']
+    if shift_end < shift_start:
+        shift_end += datetime.timedelta(days=1)
+    offsets = [0, 0, 30, 59, 60, 61, 600, -30, -60, -600, randomizer.randint(-7200, 7200)]
+    in_time = None if randomizer.random() < 0.05 else \
+        shift_start + datetime.timedelta(seconds=randomizer.choice(offsets))
+    out_time = None if randomizer.random() < 0.05 else \
+        shift_end - datetime.timedelta(seconds=randomizer.choice(offsets))
+    status = randomizer.choice(["Present"] * 6 + ["Half Day", "Absent", "On Leave", "Work From Home"])
+    docstatus = randomizer.choice([1] * 8 + [0, 2])
+    stored_differences = [None, 0, 0, 5, -3]
+    return (f"HR-ATT-{row_number:05d}", shift_name, status, docstatus, in_time, out_time,
+            int(randomizer.random() < 0.4), int(randomizer.random() < 0.3), randomizer.choice(stored_differences),
+            randomizer.choice(stored_differences), get_day_seconds(in_time), get_day_seconds(out_time),
+            int(status not in ("Absent", "On Leave") and docstatus == 1))
+
+
+class TestAttendanceBreakdowns(unittest.TestCase):
+    def test_matches_the_scalar_path(self):
+        randomizer = random.Random(11)
+        shift_type_cache = ShiftTypeCache(shift_types)
+        computed_rows_number = 0
+        for chunk_number in range(20):
+            rows = [make_attendance_row(randomizer, row_number) for row_number in range(randomizer.randint(0, 300))]
+            attendance_breakdowns = AttendanceBreakdowns(columns=get_query_columns(attendance_query_fields, rows),
+                                                         shift_type_cache=shift_type_cache)
+            scalar_errors = {"zero-entry": [], "zero-exit": [], "negative": []}
+            for row_index, row in enumerate(rows):
+                attendance = dict(zip(attendance_query_fields, row))
+                shift_type = shift_type_cache.get_shift_type(attendance['shift'])
+                breakdown = attendance_breakdowns.get_breakdown(row_index)
+                missing_values = shift_type is None or any(
+                    attendance[field] is None for field in ("in_time", "out_time", "lava_entry_duration_difference",
+                                                            "lava_exit_duration_difference"))
+                if breakdown is None:
+                    # an unknown shift or a missing value needed by the row, left to the scalar path
+                    self.assertTrue(missing_values, attendance)
+                    continue
+                scalar_breakdown = calc_attendance_breakdown(attendance, shift_type)
+                self.assertEqual(breakdown, scalar_breakdown, attendance)
+                if scalar_breakdown[3]:
+                    scalar_errors[scalar_breakdown[3]].append(row_index)
+                computed_rows_number += 1
+            # the masks flag the rows failing the scalar validations
+            self.assertEqual(attendance_breakdowns.zero_entry_rows, scalar_errors["zero-entry"])
+            self.assertEqual(attendance_breakdowns.zero_exit_rows, scalar_errors["zero-exit"])
+            self.assertEqual(attendance_breakdowns.negative_rows, scalar_errors["negative"])
+        self.assertGreater(computed_rows_number, 1000)
+
+    def test_edge_cases(self):
+        shift_type_cache = ShiftTypeCache(shift_types)
+        night_start = datetime.datetime(2024, 1, 1, 22)
+        rows = [
+            # late by 59 seconds truncates to a zero late check-in, which stops before the early check-out
+            ("HR-ATT-1", "Morning", "Present", 1, first_time + datetime.timedelta(seconds=59),
+             first_time + datetime.timedelta(hours=7), 1, 1, 0, 0),
+            # an overnight shift, late by 30 minutes and leaving an hour early after midnight
+            ("HR-ATT-2", "Night", "Present", 1, night_start + datetime.timedelta(minutes=30),
+             night_start + datetime.timedelta(hours=7), 1, 1, 0, 0),
+            # a late flag with an early check-in gives a negative difference
+            ("HR-ATT-3", "Morning", "Present", 1, first_time - datetime.timedelta(minutes=10),
+             first_time + datetime.timedelta(hours=8), 1, 0, 0, 0),
+            # on time by the exit, leaving on the shift end
+            ("HR-ATT-4", "Morning", "Present", 1, first_time, first_time + datetime.timedelta(hours=8), 0, 1, 0, 0),
+            # absent and a draft, the stored differences are kept
+            ("HR-ATT-5", "Morning", "Absent", 1, None, None, 1, 1, 7, -2),
+            ("HR-ATT-6", "Evening", "Present", 0, None, None, 1, 1, 3, 4),
+        ]
+        rows = [row + (get_day_seconds(row[4]), get_day_seconds(row[5]),
+                       int(row[2] not in ("Absent", "On Leave") and row[3] == 1)) for row in rows]
+        attendance_breakdowns = AttendanceBreakdowns(columns=get_query_columns(attendance_query_fields, rows),
+                                                     shift_type_cache=shift_type_cache)
+        self.assertEqual([attendance_breakdowns.get_breakdown(row_index) for row_index in range(len(rows))], [
+            (0, 0, None, "zero-entry"),
+            (30, 60, 8 - 1 / 3600, None),
+            (-10, 0, None, "negative"),
+            (0, 0, None, "zero-exit"),
+            (7, -2, 8, None),
+            (3, 4, 8.25, None)])
+        self.assertEqual((attendance_breakdowns.zero_entry_rows, attendance_breakdowns.zero_exit_rows,
+                          attendance_breakdowns.negative_rows), ([0], [3], [2]))
+        for row_index, row in enumerate(rows):
+            attendance = dict(zip(attendance_query_fields, row))
+            shift_type = shift_type_cache.get_shift_type(attendance['shift'])
+            self.assertEqual(attendance_breakdowns.get_breakdown(row_index),
+                             calc_attendance_breakdown(attendance, shift_type))
+
+    def test_empty_chunk(self):
+        attendance_breakdowns = AttendanceBreakdowns(columns=get_query_columns(attendance_query_fields, []),
+                                                     shift_type_cache=ShiftTypeCache(shift_types))
+        self.assertIsNone(attendance_breakdowns.get_breakdown(0))
+        self.assertEqual(attendance_breakdowns.zero_entry_rows, [])
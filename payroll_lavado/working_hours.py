@@ -0,0 +1,219 @@
+import datetime
+import operator
+
+import numpy
+
+day_seconds: int = 24 * 60 * 60
+
+
+def get_time_seconds(time_value) -> int:
+    # seconds since midnight of a Time field value, as timedelta (database), time or "HH:MM:SS" string
+    if time_value is None:
+        return None
+    if isinstance(time_value, datetime.timedelta):
+        return int(time_value.total_seconds()) % day_seconds
+    if isinstance(time_value, (datetime.time, datetime.datetime)):
+        return time_value.hour * 3600 + time_value.minute * 60 + time_value.second
+    hours, minutes, seconds = (str(time_value).split(".")[0].split(":") + ["0", "0"])[:3]
+    return (int(hours) * 3600 + int(minutes) * 60 + int(seconds)) % day_seconds
+
+
+def get_planned_working_hours(start_seconds: int, end_seconds: int) -> float:
+    if end_seconds >= start_seconds:
+        return (end_seconds - start_seconds) / 3600
+    # overnight shift, the hours till "23:59:59" plus the hours after midnight
+    return (day_seconds - 1 - start_seconds) / 3600 + end_seconds / 3600
+
+
+class ParsedShiftType:
+    def __init__(self, name: str, start_seconds: int, end_seconds: int):
+        self.name = name
+        self.start_seconds = start_seconds
+        self.end_seconds = end_seconds
+        self.is_overnight = end_seconds < start_seconds
+        self.planned_working_hours = get_planned_working_hours(start_seconds=start_seconds,
+                                                               end_seconds=end_seconds)
+
+
+class ShiftTypeCache:
+    # the shift types parsed once per batch, the attendance breakdowns read the start/end offsets and the
+    # planned working hours from here instead of loading and parsing the shift type per attendance
+    def __init__(self, shift_types: list):
+        self.shift_types = {}
+        for shift_type in shift_types:
+            if shift_type['start_time'] is None or shift_type['end_time'] is None:
+                continue
+            self.shift_types.setdefault(shift_type['name'].lower(), ParsedShiftType(
+                name=shift_type['name'],
+                start_seconds=get_time_seconds(shift_type['start_time']),
+                end_seconds=get_time_seconds(shift_type['end_time'])))
+
+    def get_shift_type(self, shift_type_name: str) -> ParsedShiftType:
+        if not shift_type_name:
+            return None
+        return self.shift_types.get(shift_type_name.lower())
+
+
+def get_entry_duration_difference(in_time, shift_type: ParsedShiftType) -> int:
+    # late check-in minutes, by the time of day of the check-in
+    return int((get_time_seconds(in_time) - shift_type.start_seconds) / 60)
+
+
+def get_exit_duration_difference(out_time, shift_type: ParsedShiftType) -> int:
+    # early check-out minutes, by the time of day of the check-out
+    return int((shift_type.end_seconds - get_time_seconds(out_time)) / 60)
+
+
+def calc_attendance_breakdown(attendance, shift_type: ParsedShiftType) -> tuple:
+    # the scalar path: (entry difference, exit difference, planned working hours, error) of one attendance,
+    # the not late/early differences keep their stored values
+    entry_difference = attendance['lava_entry_duration_difference']
+    exit_difference = attendance['lava_exit_duration_difference']
+    if attendance['status'] not in ("Absent", "On Leave") and attendance['docstatus'] == 1:
+        if attendance['late_entry']:
+            entry_difference = get_entry_duration_difference(in_time=attendance['in_time'], shift_type=shift_type)
+            if entry_difference == 0:
+                return entry_difference, exit_difference, None, "zero-entry"
+        if attendance['early_exit']:
+            exit_difference = get_exit_duration_difference(out_time=attendance['out_time'], shift_type=shift_type)
+            if exit_difference == 0:
+                return entry_difference, exit_difference, None, "zero-exit"
+        if entry_difference < 0 or exit_difference < 0:
+            return entry_difference, exit_difference, None, "negative"
+    return entry_difference, exit_difference, shift_type.planned_working_hours, None
+
+
+def calc_working_hours_breakdowns(in_seconds, out_seconds, shift_start_seconds, shift_end_seconds,
+                                  entry_differences, exit_differences, late_entries, early_exits, checked) -> tuple:
+    # the vectorized path over arrays of the same length, checked flags the submitted not absent/on leave rows;
+    # returns the differences, the planned hours and the zero entry, zero exit and negative difference masks
+    late_entries = checked & late_entries
+    entry_differences = numpy.where(late_entries, numpy.trunc((in_seconds - shift_start_seconds) / 60),
+                                    entry_differences).astype(numpy.int64)
+    zero_entries = late_entries & (entry_differences == 0)
+    # like the scalar path, a zero late check-in stops before the early check-out is computed
+    early_exits = checked & early_exits & ~zero_entries
+    exit_differences = numpy.where(early_exits, numpy.trunc((shift_end_seconds - out_seconds) / 60),
+                                   exit_differences).astype(numpy.int64)
+    planned_working_hours = numpy.where(shift_end_seconds >= shift_start_seconds,
+                                        (shift_end_seconds - shift_start_seconds) / 3600,
+                                        (day_seconds - 1 - shift_start_seconds) / 3600 + shift_end_seconds / 3600)
+    zero_exits = early_exits & (exit_differences == 0)
+    negatives = checked & ((entry_differences < 0) | (exit_differences < 0)) & ~zero_entries & ~zero_exits
+    return entry_differences, exit_differences, planned_working_hours, zero_entries, zero_exits, negatives
+
+
+# the columns of the attendance query result read by the vectorized breakdowns. The query computes the in/out
+# seconds of the day (-1 for an empty time) and the checked flag of the submitted not absent/on leave rows
+attendance_breakdown_columns: tuple = ("shift", "breakdown_checked", "late_entry", "early_exit", "in_seconds",
+                                       "out_seconds", "lava_entry_duration_difference",
+                                       "lava_exit_duration_difference")
+
+
+def get_query_columns(fields: list, rows, column_names: tuple = attendance_breakdown_columns) -> dict:
+    # the named columns of query result tuples, taken column by column without reading the rows one by one
+    return {column_name: list(map(operator.itemgetter(fields.index(column_name)), rows))
+            for column_name in column_names}
+
+
+def get_int_column(column: list, dtype=numpy.int64) -> numpy.ndarray:
+    return numpy.fromiter(column, dtype=dtype, count=len(column))
+
+
+class AttendanceBreakdowns:
+    # the breakdowns of the rows of an attendance query result computed in one vectorized pass over its columns,
+    # the batch reads a row's breakdown by its index in the query result. The rows without a loaded shift type
+    # or missing a needed value are not computed, the caller computes those with the scalar path
+    errors: tuple = (None, "zero-entry", "zero-exit", "negative")
+
+    def __init__(self, columns: dict, shift_type_cache: ShiftTypeCache):
+        self.row_errors = []
+        self.zero_entry_rows = []
+        self.zero_exit_rows = []
+        self.negative_rows = []
+        rows_number = len(columns["shift"])
+        if not rows_number:
+            return
+
+        # the shift offsets of every row taken by the row's shift index, nan for the shifts not loaded
+        shifts_indexes = {shift_name: shift_index for shift_index, shift_name in enumerate(set(columns["shift"]))}
+        shift_types = [shift_type_cache.get_shift_type(shift_name) for shift_name in shifts_indexes]
+        row_shifts_indexes = numpy.fromiter(map(shifts_indexes.__getitem__, columns["shift"]), dtype=numpy.int64,
+                                            count=rows_number)
+        shift_start_seconds = numpy.array([shift_type.start_seconds if shift_type else numpy.nan
+                                           for shift_type in shift_types], dtype=numpy.float64)[row_shifts_indexes]
+        shift_end_seconds = numpy.array([shift_type.end_seconds if shift_type else numpy.nan
+                                         for shift_type in shift_types], dtype=numpy.float64)[row_shifts_indexes]
+
+        in_seconds = get_int_column(columns["in_seconds"], dtype=numpy.float64)
+        out_seconds = get_int_column(columns["out_seconds"], dtype=numpy.float64)
+        # the stored differences may be empty, numpy.array reads those as nan
+        entry_differences_column = numpy.array(columns["lava_entry_duration_difference"], dtype=numpy.float64)
+        exit_differences_column = numpy.array(columns["lava_exit_duration_difference"], dtype=numpy.float64)
+        late_entries = get_int_column(columns["late_entry"], dtype=bool)
+        early_exits = get_int_column(columns["early_exit"], dtype=bool)
+        checked = get_int_column(columns["breakdown_checked"], dtype=bool)
+
+        entry_differences, exit_differences, planned_working_hours, zero_entries, zero_exits, negatives = \
+            calc_working_hours_breakdowns(in_seconds=in_seconds, out_seconds=out_seconds,
+                                          shift_start_seconds=numpy.nan_to_num(shift_start_seconds),
+                                          shift_end_seconds=numpy.nan_to_num(shift_end_seconds),
+                                          entry_differences=numpy.nan_to_num(entry_differences_column),
+                                          exit_differences=numpy.nan_to_num(exit_differences_column),
+                                          late_entries=late_entries, early_exits=early_exits, checked=checked)
+        # a zero late check-in keeps the stored exit difference, like the scalar path it isn't computed
+        complete = ~numpy.isnan(shift_start_seconds) \
+            & numpy.where(checked & late_entries, in_seconds >= 0, ~numpy.isnan(entry_differences_column)) \
+            & numpy.where(checked & early_exits & ~zero_entries, out_seconds >= 0,
+                          ~numpy.isnan(exit_differences_column))
+        zero_entries &= complete
+        zero_exits &= complete
+        negatives &= complete
+        self.entry_differences = entry_differences.tolist()
+        self.exit_differences = exit_differences.tolist()
+        self.planned_working_hours = planned_working_hours.tolist()
+        # -1 for the rows not computed
+        self.row_errors = numpy.where(complete, zero_entries * 1 + zero_exits * 2 + negatives * 3, -1).tolist()
+        self.zero_entry_rows = numpy.flatnonzero(zero_entries).tolist()
+        self.zero_exit_rows = numpy.flatnonzero(zero_exits).tolist()
+        self.negative_rows = numpy.flatnonzero(negatives).tolist()
+
+    def get_breakdown(self, row_index: int) -> tuple:
+        # same (entry difference, exit difference, planned working hours, error) as calc_attendance_breakdown
+        if row_index is None or row_index >= len(self.row_errors) or self.row_errors[row_index] < 0:
+            return None
+        error = self.row_errors[row_index]
+        return (self.entry_differences[row_index], self.exit_differences[row_index],
+                None if error else self.planned_working_hours[row_index], self.errors[error])
+
+
+class TimesheetLogsBuilder:
+    # an employee's timesheet time logs per attendance, the overlapping logs are found with a sorted sweep
+    # before the timesheet is saved instead of failing its validation
+    def __init__(self):
+        self.attendances_time_logs = []
+
+    def add(self, attendance_name: str, time_log: dict):
+        self.attendances_time_logs.append((attendance_name, time_log))
+
+    def get_overlapping_time_logs(self) -> list:
+        # (attendance name, overlapped attendance name) of the logs starting before an earlier log ends,
+        # the overlapped one is the earlier log ending last
+        overlapping_time_logs = []
+        sorted_time_logs = sorted(((time_log['from_time'], time_log['to_time'], attendance_name)
+                                   for attendance_name, time_log in self.attendances_time_logs
+                                   if time_log['from_time'] and time_log['to_time']),
+                                  key=lambda interval: interval[:2])
+        last_to_time = None
+        last_attendance_name = None
+        for from_time, to_time, attendance_name in sorted_time_logs:
+            if last_to_time and from_time < last_to_time:
+                overlapping_time_logs.append((attendance_name, last_attendance_name))
+                continue  # the skipped log doesn't extend the kept intervals
+            last_to_time = to_time
+            last_attendance_name = attendance_name
+        return overlapping_time_logs
+
+    def get_time_logs(self, skipped_attendance_names=()) -> list:
+        return [time_log for attendance_name, time_log in self.attendances_time_logs
+                if attendance_name not in skipped_attendance_names]